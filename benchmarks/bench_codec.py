@@ -0,0 +1,103 @@
+"""
+Micro-benchmark for the packet codec: packets/sec for encoding and decoding a
+light state packet, using the original per-call `struct` code ("before") and
+the precompiled codecs ("after"). "build_packet" is the generic builder that
+`Lifx.send` falls back to for packet types without a codec. "decode+read" also
+reads the fields that `Lifx._on_light_state` does (by unpacking the record, as
+it does), as the receive path does for every packet.
+
+Run from the repository root:
+
+    python benchmarks/bench_codec.py
+"""
+from __future__ import print_function
+
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import lazylights  # noqa
+from lazylights import (BASE_FORMAT, COMMAND_PROTOCOL, RESP_LIGHT_STATE,
+                        Header)  # noqa
+
+
+GATEWAY = b'\x99\x88\x77\x66\x55\x44'
+BULB = b'\x11\x22\x33\x44\x55\x66'
+FMT, NAMES = '6H32s8s', lazylights._PAYLOADS[RESP_LIGHT_STATE][1:]
+ARGS = (0x1234, 0xffff, 0x8000, 3500, 0, 0xffff, b'Kitchen', b'')
+
+
+def build_before():
+    packet_fmt = BASE_FORMAT + FMT
+    packet_size = struct.calcsize(packet_fmt)
+    return struct.pack(packet_fmt, packet_size, COMMAND_PROTOCOL, BULB,
+                       GATEWAY, 0, RESP_LIGHT_STATE, *ARGS)
+
+
+def parse_before(data):
+    size = struct.calcsize(BASE_FORMAT)
+    header = Header(*struct.unpack(BASE_FORMAT, data[:size]))
+    payload = dict(zip(NAMES, struct.unpack('<' + FMT, data[size:])))
+    return header, payload
+
+
+CODEC = lazylights.get_codec(RESP_LIGHT_STATE)
+PACKET = build_before()
+BUFFER = bytearray(CODEC.size)
+
+
+def build_after():
+    return CODEC.pack(GATEWAY, BULB, *ARGS)
+
+
+def build_packet():
+    return lazylights.build_packet(RESP_LIGHT_STATE, GATEWAY, BULB, FMT,
+                                   *ARGS)
+
+
+def build_into_after():
+    return CODEC.pack_into(BUFFER, 0, GATEWAY, BULB, *ARGS)
+
+
+def parse_after(data):
+    return CODEC.unpack_from(data)
+
+
+def read_before(data):
+    _, payload = parse_before(data)
+    return (payload['label'], payload['tags'], payload['hue'],
+            payload['sat'], payload['bright'], payload['kelvin'],
+            payload['power'])
+
+
+def read_after(data):
+    _, payload = parse_after(data)
+    hue, sat, bright, kelvin, _, power, label, tags = payload
+    return (label, tags, hue, sat, bright, kelvin, power)
+
+
+CASES = [
+    ('encode', 'before', build_before),
+    ('encode', 'build_packet', build_packet),
+    ('encode', 'after', build_after),
+    ('encode', 'after (pack_into)', build_into_after),
+    ('decode', 'before', lambda: parse_before(PACKET)),
+    ('decode', 'after', lambda: parse_after(PACKET)),
+    ('decode+read', 'before', lambda: read_before(PACKET)),
+    ('decode+read', 'after', lambda: read_after(PACKET)),
+]
+
+
+def main(number=200000, repeat=3):
+    assert build_after() == PACKET
+    for operation, variant, func in CASES:
+        best = min(timeit.repeat(func, number=number, repeat=repeat))
+        print('%-11s %-20s %12.0f packets/sec' % (operation, variant,
+                                                  number / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Benchmark suite: packet codec throughput, callback dispatch rate, and
+end-to-end `set_light_state` latency against a simulated gateway on
+localhost (see `lazylights_sim`), for fleets of 1, 10, 100 and 1000 bulbs.
+Results are written as JSON, so runs can be compared by machine.
+
+Run from the repository root:
+
+    python benchmarks/bench_suite.py --output results.json
+"""
+from __future__ import print_function
+
+import argparse
+from contextlib import closing
+import json
+import os
+import platform
+import socket
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import lazylights  # noqa
+from lazylights import (RESP_LIGHT_STATE, ConnectException, build_packet,
+                        parse_packet, parse_payload)  # noqa
+from lazylights_sim import Simulator  # noqa
+
+
+# Receive buffer for the end-to-end runs, big enough for the burst of replies
+# to discovery from a thousand simulated bulbs.
+RCVBUF = 4 * 1024 * 1024
+
+GATEWAY = b'\x99\x88\x77\x66\x55\x44'
+BULB = b'\x11\x22\x33\x44\x55\x66'
+FMT = '6H32s8s'
+NAMES = lazylights._PAYLOADS[RESP_LIGHT_STATE][1:]
+ARGS = (0x1234, 0xffff, 0x8000, 3500, 0, 0xffff, b'Kitchen', b'')
+PACKET = build_packet(RESP_LIGHT_STATE, GATEWAY, BULB, FMT, *ARGS)
+PAYLOAD = parse_packet(PACKET)[1]
+
+CODEC_CASES = [
+    ('build_packet',
+     lambda: build_packet(RESP_LIGHT_STATE, GATEWAY, BULB, FMT, *ARGS)),
+    ('parse_packet', lambda: parse_packet(PACKET)),
+    ('parse_payload', lambda: parse_payload(PAYLOAD, '<' + FMT, *NAMES)),
+]
+
+
+def bench_codec(number, repeat):
+    """
+    Returns a dictionary mapping each codec function to the number of calls
+    per second it manages, at best.
+    """
+    results = {}
+    for name, func in CODEC_CASES:
+        best = min(timeit.repeat(func, number=number, repeat=repeat))
+        results[name] = {'ops_per_sec': number / best}
+    return results
+
+
+def bench_dispatch(events, workers=0):
+    """
+    Returns the number of events per second that go through a `Callbacks`
+    queue to a (trivial) registered handler.
+    """
+    callbacks = lazylights.Callbacks(lazylights.Logger(False), workers)
+    handled = []
+    callbacks.register(RESP_LIGHT_STATE, handled.append, inline=not workers)
+    header, payload = lazylights.get_codec(RESP_LIGHT_STATE).unpack_from(
+        PACKET)
+
+    started = lazylights._monotonic()
+    thr = lazylights._spawn(callbacks.run)
+    for _ in range(events):
+        callbacks.put(RESP_LIGHT_STATE, header)
+    callbacks.stop()
+    thr.join()
+    elapsed = lazylights._monotonic() - started
+    assert len(handled) == events
+    return {'events': events, 'workers': workers,
+            'events_per_sec': events / elapsed}
+
+
+def _free_port():
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bench_end_to_end(num_bulbs, samples, timeout, rate):
+    """
+    Connects to a simulated gateway with `num_bulbs` bulbs, then times
+    `samples` calls to `set_light_state_raw` (each for one bulb, in turn,
+    waiting for its confirmation). Returns latency percentiles in
+    milliseconds, and the number of calls that timed out. If connecting
+    fails, returns the error instead, so the other fleet sizes still run.
+
+    Each call sends two packets to its bulb, so with small fleets the
+    sender's per-bulb rate limit (`rate` packets per second; None for no
+    limit) dominates the latency.
+    """
+    port = _free_port()
+    sim = Simulator(num_bulbs, reply_port=port)
+    sim_thr = lazylights._spawn(sim.run)
+    lifx = lazylights.Lifx(num_bulbs, discover=False)
+    lifx.sender.scheduler.rate = rate
+    lifx.receiver = lazylights.PacketReceiver(('127.0.0.1', port),
+                                              lifx.callbacks, rcvbuf=RCVBUF)
+    broadcast = lazylights.BROADCAST_ADDRESS
+    lazylights.BROADCAST_ADDRESS = sim.addr
+    latencies = []
+    timeouts = 0
+    try:
+        started = lazylights._monotonic()
+        with lifx.run():
+            connect_time = lazylights._monotonic() - started
+            macs = sorted(lifx.bulbs)
+            for num in range(samples):
+                mac = macs[num % len(macs)]
+                sent = lazylights._monotonic()
+                responses = lifx.set_light_state_raw(num & 0xffff, 0, 0,
+                                                     3500, mac, timeout)
+                if mac in responses:
+                    latencies.append(lazylights._monotonic() - sent)
+                else:
+                    timeouts += 1
+    except ConnectException as exc:
+        return {'bulbs': num_bulbs, 'samples': samples, 'rate': rate,
+                'error': str(exc)}
+    finally:
+        lazylights.BROADCAST_ADDRESS = broadcast
+        sim.stop()
+        sim_thr.join()
+
+    latencies.sort()
+    return {'bulbs': num_bulbs, 'samples': samples, 'timeouts': timeouts,
+            'rate': rate,
+            'connect_ms': connect_time * 1000,
+            'p50_ms': _ms(lazylights._percentile(latencies, 50)),
+            'p99_ms': _ms(lazylights._percentile(latencies, 99)),
+            'max_ms': _ms(latencies[-1] if latencies else None)}
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help='file to write JSON results to '
+                        '(default: standard output)')
+    parser.add_argument('--number', type=int, default=100000,
+                        help='calls per codec timing run')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='codec timing runs (the best is kept)')
+    parser.add_argument('--events', type=int, default=100000,
+                        help='events per dispatch run')
+    parser.add_argument('--samples', type=int, default=200,
+                        help='set_light_state calls per fleet size')
+    parser.add_argument('--timeout', type=float, default=1.0,
+                        help='seconds to wait for each confirmation')
+    parser.add_argument('--rate', type=float,
+                        default=lazylights.SendScheduler().rate,
+                        help='packets per second per bulb (0: no limit)')
+    parser.add_argument('--bulbs', type=int, nargs='+',
+                        default=[1, 10, 100, 1000], help='fleet sizes')
+    args = parser.parse_args(argv)
+
+    results = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'codec': bench_codec(args.number, args.repeat),
+        'dispatch': [bench_dispatch(args.events),
+                     bench_dispatch(args.events, workers=4)],
+        'end_to_end': [bench_end_to_end(num, args.samples, args.timeout,
+                                        args.rate or None)
+                       for num in args.bulbs],
+    }
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
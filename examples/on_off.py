@@ -1,3 +1,4 @@
+from __future__ import print_function
 from lazylights import Lifx
 import time
 
@@ -5,7 +6,7 @@ lifx = Lifx(num_bulbs=2)  # so it knows how many to wait for when connecting
 
 @lifx.on_connected
 def _connected():
-    print "Connected!"
+    print("Connected!")
 
 with lifx.run():
     lifx.set_power_state(True)
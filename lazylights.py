@@ -1,15 +1,68 @@
+from __future__ import print_function
+
+from array import array
+import binascii
+import bisect
 from contextlib import closing, contextmanager
+import errno
+from functools import partial
+import json
+import logging
+import math
+import numbers
+import os
+import re
+import select
 import socket
 import struct
+import time
 from threading import Thread, Event, Lock
-from collections import namedtuple
-import Queue
+from collections import deque, namedtuple
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    from concurrent.futures import Future
+except ImportError:
+    Future = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
 
 
 BASE_FORMAT = '<HHxxxx6sxx6sxxQHxx'
-_FORMAT_SIZE = struct.calcsize(BASE_FORMAT)
+_HEADER = struct.Struct(BASE_FORMAT)
+_FORMAT_SIZE = _HEADER.size
+
+# The packet type is the last field of the common header, and the target
+# bulb is the third.
+_PACKET_TYPE = struct.Struct('<H')
+_PACKET_TYPE_OFFSET = _FORMAT_SIZE - 4
+_TARGET = struct.Struct('<6s')
+_TARGET_OFFSET = 8
+_SITE = struct.Struct('<6s')
+_SITE_OFFSET = 16
+_ROUTE = struct.Struct('<14s')
+
+# The light state's tags field is a bitmask, one bit per tag.
+_TAGS = struct.Struct('<Q')
 
-ALL_BULBS = '\x00' * 6
+ALL_BULBS = b'\x00' * 6
 
 LIFX_PORT = 56700
 BROADCAST_ADDRESS = ('255.255.255.255', LIFX_PORT)
@@ -36,31 +89,76 @@ _PAYLOADS = {
                        'power', 'label', 'tags')
 }
 
+# How a change to bulb state is confirmed: by asking just the bulbs that were
+# changed for their new state, by asking all bulbs (as earlier versions did),
+# or not at all, assuming the change took effect.
+REFRESH_TARGETED = 'targeted'
+REFRESH_ALL = 'all'
+REFRESH_NONE = 'none'
+
+# Packet types where a newer packet for a bulb supersedes an older one.
+_COALESCED_TYPES = frozenset([REQ_SET_LIGHT_STATE, REQ_SET_POWER_STATE])
+
+# Packet types where a newer packet for a bulb makes an older one redundant,
+# but has to be sent after anything queued in between (so that a request for
+# a bulb's state sees the changes made before it).
+_REQUEUED_TYPES = frozenset([REQ_GET_LIGHT_STATE])
+
+# How long after a transition should be over to ask a bulb for the state it
+# ended in, in seconds (allowing for the time the change spent being sent).
+_SETTLE_TIME = 0.1
+
 _SHUTDOWN = object()
 
+_monotonic = getattr(time, 'monotonic', time.time)
+
 EVENT_DISCOVERED = 'discovered'
 EVENT_CONNECTED = 'connected'
 EVENT_BULBS_FOUND = 'bulbs_found'
 EVENT_UNKNOWN = 'unknown'
 EVENT_LIGHT_STATE = 'light_state'
 EVENT_POWER_STATE = 'power_state'
+EVENT_BULB_ADDED = 'bulb_added'
+EVENT_BULB_REMOVED = 'bulb_removed'
+EVENT_METRICS = 'metrics'
+
+# Key under which received datagrams too short to be packets are counted.
+RUNT = 'runt'
+
+# Upper bounds (in seconds) of the round-trip time histogram buckets.
+_RTT_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0,
+               2.0, 5.0)
 
 Header = namedtuple('Header', 'size protocol mac gateway time packet_type')
 Bulb = namedtuple('Bulb', 'label mac')
 Gateway = namedtuple('Gateway', 'addr port mac')
+LightColumns = namedtuple('LightColumns',
+                          'macs hue sat bright kelvin dim power time')
+
+
+_STRUCTS = {}
+
+
+def _struct(fmt):
+    """
+    Returns a precompiled `struct.Struct` for the format string `fmt`, cached
+    so that each format is only compiled once.
+    """
+    compiled = _STRUCTS.get(fmt)
+    if compiled is None:
+        compiled = _STRUCTS[fmt] = struct.Struct(fmt)
+    return compiled
 
 
 def parse_packet(data, format=None):
     """
     Parses a Lifx data packet (as a bytestring), returning into a Header object
-    for the fields that are common to all data packets, and a bytestring of
-    payload data for the type-specific fields (suitable for passing to
-    `parse_payload`).
+    for the fields that are common to all data packets, and a memoryview of
+    the payload data for the type-specific fields (suitable for passing to
+    `parse_payload`), so the payload isn't copied.
     """
-    unpacked = struct.unpack(BASE_FORMAT, data[:_FORMAT_SIZE])
-    psize, protocol, mac, gateway, time, ptype = unpacked
-    header = Header(psize, protocol, mac, gateway, time, ptype)
-    return header, data[_FORMAT_SIZE:]
+    header = Header._make(_HEADER.unpack_from(data))
+    return header, memoryview(data)[_FORMAT_SIZE:]
 
 
 def parse_payload(data, payload_fmt, *payload_names):
@@ -70,7 +168,7 @@ def parse_payload(data, payload_fmt, *payload_names):
     are from `payload_names` and the values are the corresponding values from
     the bytestring.
     """
-    payload = struct.unpack(payload_fmt, data)
+    payload = _struct(payload_fmt).unpack(data)
     return dict(zip(payload_names, payload))
 
 
@@ -93,10 +191,11 @@ def build_packet(packet_type, gateway, bulb, payload_fmt, *payload_args,
     """
     protocol = kwargs.get('protocol', COMMAND_PROTOCOL)
 
+    # The struct module caches compiled formats itself; see PacketCodec for
+    # packet types that are built often.
     packet_fmt = BASE_FORMAT + payload_fmt
-    packet_size = struct.calcsize(packet_fmt)
     return struct.pack(packet_fmt,
-                       packet_size,
+                       struct.calcsize(packet_fmt),
                        protocol,
                        bulb,
                        gateway,
@@ -105,14 +204,307 @@ def build_packet(packet_type, gateway, bulb, payload_fmt, *payload_args,
                        *payload_args)
 
 
+def _record_type(name, field_names):
+    """
+    Returns a namedtuple type for decoded payloads. Besides attribute access,
+    records support the `payload['field']`, `payload.get('field')` and
+    `payload.keys()` lookups of the dictionaries that `parse_payload` returns,
+    so callbacks written against either work unchanged.
+    """
+    base = namedtuple(name, field_names)
+    getitem = tuple.__getitem__
+    index = dict((field, i) for i, field in enumerate(base._fields))
+    attrs = {'__slots__': ()}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getitem(self, index[key])
+        return getitem(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._fields else default
+
+    def keys(self):
+        return list(self._fields)
+
+    attrs.update(__getitem__=__getitem__, get=get, keys=keys)
+
+    # Before Python 3.8, the namedtuple fields are properties that go through
+    # __getitem__, so point them straight at the tuple slots instead. (Later
+    # versions have faster native descriptors, which are kept.)
+    for i, field in enumerate(base._fields):
+        if isinstance(base.__dict__.get(field), property):
+            attrs[field] = property(lambda self, _index=i:
+                                    getitem(self, _index))
+    return type(name, (base,), attrs)
+
+
+class PacketCodec(object):
+    """
+    A precompiled encoder/decoder for one type of packet. The header and
+    payload formats are compiled into a single `struct.Struct`, so a packet
+    can be built or parsed (including in place, in a preallocated buffer) with
+    one call, and decoded payloads are returned as lightweight records rather
+    than dictionaries.
+    """
+    def __init__(self, packet_type, payload_fmt, *payload_names, **kwargs):
+        self.packet_type = packet_type
+        self.payload_fmt = payload_fmt
+        self.payload_names = payload_names
+        self.protocol = kwargs.get('protocol', COMMAND_PROTOCOL)
+        self.struct = _struct(BASE_FORMAT + payload_fmt.lstrip('<'))
+        self.size = self.struct.size
+        self.record = _record_type('Payload_%02x' % packet_type,
+                                   payload_names)
+        self.pack, self.pack_into = self._packers(
+            self.struct, self.size, self.protocol, packet_type)
+
+    @staticmethod
+    def _packers(compiled, size, protocol, packet_type):
+        """
+        Returns the `pack` and `pack_into` functions for a codec. They are
+        closures over the constant header fields rather than methods, which
+        keeps attribute lookups off the send path.
+        """
+        _pack, _pack_into = compiled.pack, compiled.pack_into
+
+        def pack(gateway, bulb, *payload_args):
+            """
+            Returns a packet, as a bytestring. Arguments are as for
+            `build_packet`, minus the packet type and payload format.
+            """
+            return _pack(size, protocol, bulb, gateway, 0, packet_type,
+                         *payload_args)
+
+        def pack_into(buf, offset, gateway, bulb, *payload_args):
+            """
+            Like `pack`, but writes the packet into the writable buffer `buf`
+            starting at `offset`. Returns the offset just past the packet.
+            """
+            _pack_into(buf, offset, size, protocol, bulb, gateway, 0,
+                       packet_type, *payload_args)
+            return offset + size
+
+        return pack, pack_into
+
+    def unpack_from(self, buf, offset=0):
+        """
+        Parses the packet in `buf` starting at `offset`, returning a pair of
+        (Header object, payload record).
+        """
+        values = self.struct.unpack_from(buf, offset)
+        return (tuple.__new__(Header, values[:6]),
+                tuple.__new__(self.record, values[6:]))
+
+
+_CODECS = {}
+
+
+def register_codec(packet_type, payload_fmt, *payload_names, **kwargs):
+    """
+    Compiles and registers a `PacketCodec` for `packet_type`, returning it.
+    The `protocol` keyword argument sets the protocol field of packets the
+    codec builds.
+    """
+    codec = _CODECS[packet_type] = PacketCodec(packet_type, payload_fmt,
+                                               *payload_names, **kwargs)
+    return codec
+
+
+def get_codec(packet_type):
+    """
+    Returns the registered `PacketCodec` for `packet_type`, or None.
+    """
+    return _CODECS.get(packet_type)
+
+
+def _packet_type(data):
+    """
+    Returns the packet type of the packet in `data`, without parsing the rest
+    of the header.
+    """
+    return _PACKET_TYPE.unpack_from(data, _PACKET_TYPE_OFFSET)[0]
+
+
+for _type, _payload in _PAYLOADS.items():
+    register_codec(_type, *_payload)
+del _type, _payload
+register_codec(REQ_GATEWAY, '', protocol=DISCOVERY_PROTOCOL)
+register_codec(REQ_SET_POWER_STATE, '2s', 'level')
+register_codec(REQ_GET_LIGHT_STATE, '')
+register_codec(REQ_SET_LIGHT_STATE, 'xHHHHI',
+               'hue', 'sat', 'bright', 'kelvin', 'duration')
+
+
+def _raw_color(hue, saturation, brightness):
+    """
+    Converts a hue (a float from 0 to 360), saturation and brightness (floats
+    from 0 to 1) to the raw integers used in packets, returning a tuple.
+    """
+    return (int((hue % 360) / 360.0 * 0xffff) & 0xffff,
+            int(saturation * 0xffff) & 0xffff,
+            int(brightness * 0xffff) & 0xffff)
+
+
+_NUMPY_CODES = {'B': 'u1', 'H': 'u2', 'I': 'u4', 'Q': 'u8'}
+
+
+_NUMPY_DTYPES = {}
+
+
+def _numpy_dtype(codec):
+    """
+    Returns a NumPy structured dtype matching the layout of the packets built
+    by `codec` (with the target bulb in the `mac` field), cached by type.
+    """
+    dtype = _NUMPY_DTYPES.get(codec.packet_type)
+    if dtype is None:
+        dtype = _NUMPY_DTYPES[codec.packet_type] = _build_numpy_dtype(codec)
+    return dtype
+
+
+def _build_numpy_dtype(codec):
+    """
+    Builds the dtype for `_numpy_dtype`.
+    """
+    names = ['size', 'protocol', 'mac', 'gateway', 'time', 'packet_type']
+    formats = ['<u2', '<u2', ('u1', 6), ('u1', 6), '<u8', '<u2']
+    offsets = [0, 2, 8, 16, 24, 32]
+    offset = _FORMAT_SIZE
+    for count, code in re.findall(r'(\d*)(\w)', codec.payload_fmt):
+        count = int(count or 1)
+        if code == 'x':
+            offset += count
+        elif code == 's':
+            names.append(codec.payload_names[len(names) - 6])
+            formats.append('S%d' % count)
+            offsets.append(offset)
+            offset += count
+        else:
+            for _ in range(count):
+                names.append(codec.payload_names[len(names) - 6])
+                formats.append('<' + _NUMPY_CODES[code])
+                offsets.append(offset)
+                offset += struct.calcsize('<' + code)
+    return numpy.dtype({'names': names, 'formats': formats,
+                        'offsets': offsets, 'itemsize': codec.size})
+
+
+def _use_numpy(use_numpy):
+    """
+    Returns whether to take the NumPy path, given the caller's preference
+    (None meaning "if NumPy is installed").
+    """
+    if use_numpy is None:
+        return numpy is not None
+    if use_numpy and numpy is None:
+        raise ImportError('numpy is not installed')
+    return use_numpy
+
+
+def encode_light_frame(gateway, macs, frame, durations=0, use_numpy=None):
+    """
+    Builds the packets to set the light state of many bulbs at once (one
+    frame of an animation, say), returning them concatenated in a bytearray.
+
+    - `gateway` is the mac address of the gateway bulb
+    - `macs` is a sequence of bulb mac addresses
+    - `frame` is a sequence of (hue, saturation, brightness, kelvin) rows, one
+      per bulb, with values as for `Lifx.set_light_state` (or an N x 4 array)
+    - `durations` is the transition time in milliseconds, either for all
+      bulbs or as a sequence with one per bulb
+
+    If NumPy is installed (or `use_numpy` is true) the conversion is done on
+    whole columns at once; otherwise it's done bulb by bulb, with the same
+    results.
+    """
+    codec = _CODECS[REQ_SET_LIGHT_STATE]
+    if not _use_numpy(use_numpy):
+        if isinstance(durations, numbers.Integral):
+            durations = [durations] * len(macs)
+        buf = bytearray(len(macs) * codec.size)
+        offset = 0
+        for mac, row, duration in zip(macs, frame, durations):
+            hue, sat, bright, kelvin = row
+            offset = codec.pack_into(buf, offset, gateway, mac,
+                                     *_raw_color(hue, sat, bright) +
+                                     (int(kelvin) & 0xffff, duration))
+        return buf
+
+    frame = numpy.asarray(frame, dtype=numpy.float64).reshape(-1, 4)
+    packets = numpy.zeros(len(macs), dtype=_numpy_dtype(codec))
+    packets['size'] = codec.size
+    packets['protocol'] = codec.protocol
+    packets['mac'] = numpy.frombuffer(b''.join(macs), numpy.uint8) \
+        .reshape(-1, 6)
+    packets['gateway'] = numpy.frombuffer(gateway, numpy.uint8)
+    packets['packet_type'] = codec.packet_type
+    packets['hue'] = (numpy.mod(frame[:, 0], 360) / 360.0 * 0xffff) \
+        .astype(numpy.int64) & 0xffff
+    packets['sat'] = (frame[:, 1] * 0xffff).astype(numpy.int64) & 0xffff
+    packets['bright'] = (frame[:, 2] * 0xffff).astype(numpy.int64) & 0xffff
+    packets['kelvin'] = frame[:, 3].astype(numpy.int64) & 0xffff
+    packets['duration'] = durations
+    return bytearray(packets.tobytes())
+
+
+def decode_light_frame(data, use_numpy=None):
+    """
+    Parses a buffer of concatenated light state packets (as received from
+    bulbs), returning a pair of (list of bulb mac addresses, frame), where the
+    frame has a (hue, saturation, brightness, kelvin) row for each bulb, like
+    the ones `encode_light_frame` takes.
+
+    With NumPy, the frame is an N x 4 array of floats; without it, it's a
+    list of tuples with the same values.
+    """
+    codec = _CODECS[RESP_LIGHT_STATE]
+    count = len(data) // codec.size
+    if not _use_numpy(use_numpy):
+        macs, frame = [], []
+        for offset in range(0, count * codec.size, codec.size):
+            header, state = codec.unpack_from(data, offset)
+            macs.append(header.mac)
+            frame.append(((state.hue / float(0xffff) * 360) % 360.0,
+                          state.sat / float(0xffff),
+                          state.bright / float(0xffff),
+                          float(state.kelvin)))
+        return macs, frame
+
+    packets = numpy.frombuffer(data, dtype=_numpy_dtype(codec),
+                               count=count)
+    mac_bytes = packets['mac'].tobytes()
+    macs = [mac_bytes[k:k + 6] for k in range(0, len(mac_bytes), 6)]
+    frame = numpy.empty((count, 4))
+    frame[:, 0] = (packets['hue'] / float(0xffff) * 360) % 360.0
+    frame[:, 1] = packets['sat'] / float(0xffff)
+    frame[:, 2] = packets['bright'] / float(0xffff)
+    frame[:, 3] = packets['kelvin']
+    return macs, frame
+
+
+def _updated(state, **changes):
+    """
+    Returns the payload record `state` with `changes` applied, or None if
+    there's no state.
+    """
+    return state and state._replace(**changes)
+
+
+# Python 2's bytestrings have no hex methods, so binascii is used there.
+_HEX_METHODS = hasattr(bytes, 'hex')
+
+
 def _bytes(packet):
     """
     Returns a human-friendly representation of the bytes in a bytestring.
 
-    >>> _bytes('\x12\x34\x56')
+    >>> _bytes(b'\x12\x34\x56')
     '123456'
     """
-    return ''.join('%02x' % ord(c) for c in packet)
+    if _HEX_METHODS:
+        return packet.hex()
+    return binascii.hexlify(packet)
 
 
 def _unbytes(bytestr):
@@ -120,10 +512,11 @@ def _unbytes(bytestr):
     Returns a bytestring from the human-friendly string returned by `_bytes`.
 
     >>> _unbytes('123456')
-    '\x12\x34\x56'
+    b'\x12\x34\x56'
     """
-    return ''.join(chr(int(bytestr[k:k + 2], 16))
-                   for k in range(0, len(bytestr), 2))
+    if _HEX_METHODS:
+        return bytes.fromhex(bytestr)
+    return binascii.unhexlify(bytestr)
 
 
 def _spawn(func, *args, **kwargs):
@@ -137,6 +530,15 @@ def _spawn(func, *args, **kwargs):
     return thr
 
 
+def _broadcast_socket():
+    """
+    Returns a new UDP socket that can send to the broadcast address.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    return sock
+
+
 def _retry(event, attempts, delay):
     """
     An iterator of pairs of (attempt number, event set), checking whether
@@ -157,316 +559,1878 @@ def _retry(event, attempts, delay):
     attempted = 0
     while attempted < attempts and not event.is_set():
         yield attempted, event.is_set()
+        attempted += 1
         if event.wait(delay):
             break
     yield attempted, event.is_set()
 
 
-@contextmanager
-def _blocking(lock, state_dict, event, timeout=None):
+def _drive(loop, steps):
     """
-    A contextmanager that clears `state_dict` and `event`, yields, and waits
-    for the event to be set. Clearing an yielding are done within `lock`.
-
-    Used for blocking request/response semantics on the request side, as in:
-
-        with _blocking(lock, state, event):
-            send_request()
-
-    The response side would then do something like:
-
-        with lock:
-            state['data'] = '...'
-            event.set()
+    Runs the generator `steps` on the asyncio event loop `loop`: each future
+    the generator yields is waited on, and its result (or exception) is sent
+    back into the generator. Returns a future that resolves to None once the
+    generator finishes, or fails with the exception it raises. Cancelling the
+    returned future cancels the future being waited on and closes the
+    generator; a future that's cancelled under it raises CancelledError in
+    the generator.
+
+    This is a minimal stand-in for an asyncio Task, usable without `async` or
+    `yield from` syntax, as in:
+
+        def _steps():
+            transport, _ = yield make_future_for_endpoint()
+            ok = yield make_future_for_response()
+            if not ok:
+                raise Exception('no response')
+
+        done = _drive(loop, _steps())
     """
-    with lock:
-        state_dict.clear()
-        event.clear()
-        yield
-    event.wait(timeout)
+    done = loop.create_future()
+    waiting = [None]
+
+    def step(future=None):
+        if done.cancelled():
+            # Whoever was waiting has given up, so stop the steps.
+            steps.close()
+            return
+        try:
+            if future is None:
+                waiting[0] = next(steps)
+            elif future.cancelled():
+                waiting[0] = steps.throw(asyncio.CancelledError())
+            elif future.exception() is not None:
+                waiting[0] = steps.throw(future.exception())
+            else:
+                waiting[0] = steps.send(future.result())
+        except StopIteration:
+            done.set_result(None)
+        except asyncio.CancelledError:
+            # (Before Python 3.8, CancelledError is an Exception too.)
+            done.cancel()
+        except Exception as exc:
+            done.set_exception(exc)
+        else:
+            waiting[0].add_done_callback(step)
+
+    def cancelled(_):
+        # Cancelling `done` cancels the future being waited on, whose
+        # callback then closes the generator.
+        if done.cancelled() and waiting[0] is not None:
+            waiting[0].cancel()
+
+    done.add_done_callback(cancelled)
+    step()
+    return done
+
+
+class ResponseTimeout(Exception):
+    """
+    An Exception raised when a response doesn't arrive in time.
+    """
+    pass
 
 
-class Callbacks(object):
+class ResponseFuture(object):
     """
-    An object to manage callbacks. It exposes a queue to schedule callbacks,
-    and a `run` function to be run in a separate thread to consume the queue
-    and run the callback functions.
+    The eventual response to a request, filled in by the receiving side when
+    the response arrives. Follows the `concurrent.futures.Future` interface
+    for the parts that make sense here.
     """
-    def __init__(self, logger):
-        self._logger = logger
-        self._callbacks = {}
-        self._queue = Queue.Queue()
+    def __init__(self, key=None):
+        self.key = key
+        self.created = _monotonic()
+        self._event = Event()
+        self._lock = Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
 
-    def register(self, event, fn):
+    def done(self):
         """
-        Tell the object to run `fn` whenever a message of type `event` is
-        received.
+        Returns whether the response has arrived.
         """
-        self._callbacks.setdefault(event, []).append(fn)
-        return fn
+        return self._event.is_set()
 
-    def put(self, event, *args, **kwargs):
+    def wait(self, timeout=None):
         """
-        Schedule a callback for `event`, passing `args` and `kwargs` to each
-        registered callback handler.
+        Waits up to `timeout` seconds for the response, returning whether it
+        arrived.
         """
-        self._queue.put((event, args, kwargs))
+        return self._event.wait(timeout)
 
-    def stop(self):
+    def result(self, timeout=None):
         """
-        Stop processing callbacks (once the queue is empty).
+        Returns the response, waiting up to `timeout` seconds for it to arrive.
+        Raises a ResponseTimeout if it doesn't, or the exception the request
+        failed with, if it did.
         """
-        self._queue.put(_SHUTDOWN)
+        if not self._event.wait(timeout):
+            raise ResponseTimeout('no response for %s' % (self.key,))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
 
-    def run(self):
+    def exception(self, timeout=None):
         """
-        Process all callbacks, until `stop()` is called. Intended to run in
-        its own thread.
+        Returns the exception the request failed with (or None), waiting up
+        to `timeout` seconds for it to finish.
         """
-        while True:
-            msg = self._queue.get()
-            if msg is _SHUTDOWN:
-                break
-            event, args, kwargs = msg
-            self._logger('<< %s', event)
-            for func in self._callbacks.get(event, []):
-                func(*args, **kwargs)
-
+        if not self._event.wait(timeout):
+            raise ResponseTimeout('no response for %s' % (self.key,))
+        return self._exception
 
-class PacketReceiver(object):
-    """
-    An object to process incoming packets. It parses the data in the packets
-    and schedules callbacks (on a `Callback` object) according to the packet's
-    type. The `is_shutdown` event can be used to wait for the receiver to shut
-    down after calling `stop`.
-    """
-    def __init__(self, addr, callbacks, buffer_size=65536, timeout=0.5):
-        self._addr = addr
-        self._shutdown = Event()
-        self._callbacks = callbacks
-        self._buffer_size = buffer_size
-        self._timeout = timeout
+    def cancelled(self):
+        """
+        Returns False: requests can't be taken back once they're sent.
+        """
+        return False
 
-    @property
-    def is_shutdown(self):
+    def add_done_callback(self, fn):
         """
-        An `Event` that is set when the receiver starts shutting down.
+        Arranges for `fn` to be called with the future once the response
+        arrives (right away, if it already has).
         """
-        return self._shutdown
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
 
-    def stop(self):
+    def set_result(self, result):
         """
-        Stop processing incoming packets.
+        Fills in the response, waking up anything waiting for it.
         """
-        self._shutdown.set()
+        self._finish(result, None)
 
-    def run(self):
+    def set_exception(self, exception):
         """
-        Process all incoming packets, until `stop()` is called. Intended to run
-        in its own thread.
+        Marks the request as failed, waking up anything waiting for it.
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.bind(self._addr)
-        sock.settimeout(self._timeout)
-        with closing(sock):
-            while not self._shutdown.is_set():
-                try:
-                    data, addr = sock.recvfrom(self._buffer_size)
-                except socket.timeout:
-                    continue
+        self._finish(None, exception)
 
-                header, rest = parse_packet(data)
-                if header.packet_type in _PAYLOADS:
-                    payload = parse_payload(rest,
-                                            *_PAYLOADS[header.packet_type])
-                    self._callbacks.put(header.packet_type,
-                                        header, payload, None, addr)
-                else:
-                    self._callbacks.put(EVENT_UNKNOWN,
-                                        header, None, rest, addr)
+    def _finish(self, result, exception):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
 
 
-class PacketSender(object):
+def _resolved(key, result):
     """
-    An object to manage outgoing packets. It exposes a queue to send packets,
-    and a `run` function to be run in a separate thread to consume the queue
-    while maintaining a connection to a gateway.
+    Returns a ResponseFuture that already has `result` filled in.
     """
-    def __init__(self):
-        self._queue = Queue.Queue()
-        self._connected = Event()
-        self._gateway = None
+    future = ResponseFuture(key)
+    future.set_result(result)
+    return future
 
-    @property
-    def is_connected(self):
+
+class Histogram(object):
+    """
+    Counts values into buckets, by the buckets' upper `bounds` (in increasing
+    order), with one more bucket for values above the last bound. Not
+    thread-safe: intended to be updated by one thread.
+    """
+    def __init__(self, bounds=_RTT_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
         """
-        An `Event` that is set once the sender has connected to a gateway.
+        Counts `value`.
         """
-        return self._connected
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
 
-    def put(self, packet):
+    def stats(self):
         """
-        Schedules a packet to be sent to the gateway.
+        Returns a dictionary of the number of values counted, their sum, and a
+        list of pairs of (upper bound, or None for the last bucket, count).
         """
-        self._queue.put(packet)
+        return {'count': self.count, 'sum': self.total,
+                'buckets': list(zip(self.bounds + (None,), self.counts))}
 
-    def stop(self):
+
+class TrafficCounter(object):
+    """
+    Counts packets and bytes by packet type. Not thread-safe: intended to be
+    updated by the thread sending or receiving the packets.
+    """
+    def __init__(self):
+        self._counts = {}
+
+    def add(self, packet_type, size):
         """
-        Stop processing outgoing packets (once the queue is empty).
+        Counts a packet of type `packet_type`, `size` bytes long.
         """
-        self._queue.put(_SHUTDOWN)
+        counts = self._counts.get(packet_type)
+        if counts is None:
+            counts = self._counts[packet_type] = [0, 0]
+        counts[0] += 1
+        counts[1] += size
 
-    def run(self):
+    def stats(self):
         """
-        Process all outgoing packets, until `stop()` is called. Intended to run
-        in its own thread.
+        Returns a dictionary mapping packet types to dictionaries of the
+        number of `packets` and `bytes` counted.
         """
-        while True:
-            to_send = self._queue.get()
-            if to_send is _SHUTDOWN:
-                break
-
-            # If we get a gateway object, connect to it. Otherwise, assume
-            # it's a bytestring and send it out on the socket.
-            if isinstance(to_send, Gateway):
-                self._gateway = to_send
-                self._connected.set()
-            else:
-                if not self._gateway:
-                    raise SendException('no gateway')
-                dest = (self._gateway.addr, self._gateway.port)
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.sendto(to_send, dest)
+        return dict((packet_type, {'packets': packets, 'bytes': size})
+                    for packet_type, (packets, size)
+                    in list(self._counts.items()))
 
 
-class Logger(object):
+class StateCache(dict):
     """
-    An object to manage sequential logging.
+    A dictionary of the last-known state of each bulb, by mac address, that
+    also records when each bulb's state was stored. `fresh` looks up states
+    no older than a given age, counting `hits` and `misses`.
     """
-    def __init__(self, enabled=True):
-        self._enabled = enabled
-        self._queue = Queue.Queue()
+    def __init__(self, clock=_monotonic):
+        super(StateCache, self).__init__()
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._times = {}
 
-    def __call__(self, msg, *args):
+    def __setitem__(self, mac, state):
+        dict.__setitem__(self, mac, state)
+        self._times[mac] = self._clock()
+
+    def __delitem__(self, mac):
+        dict.__delitem__(self, mac)
+        del self._times[mac]
+
+    def pop(self, mac, *default):
+        self._times.pop(mac, None)
+        return dict.pop(self, mac, *default)
+
+    def clear(self):
+        dict.clear(self)
+        self._times.clear()
+
+    def age(self, mac):
         """
-        Queue a log message, formatting `msg` with `args`.
+        Returns the number of seconds since the state of the bulb with mac
+        address `mac` was stored, or None if it hasn't been.
         """
-        self._queue.put(msg % args)
+        stored = self._times.get(mac)
+        return None if stored is None else self._clock() - stored
 
-    def stop(self):
+    def fresh(self, mac, max_age=None):
         """
-        Stop processing log messages (once the queue is empty).
+        Returns the state of the bulb with mac address `mac` if it was stored
+        no more than `max_age` seconds ago (or at all, if `max_age` is None),
+        and otherwise None.
         """
-        self._queue.put(_SHUTDOWN)
+        age = self.age(mac)
+        if age is None or (max_age is not None and age > max_age):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self[mac]
 
-    def run(self):
+    def stats(self):
         """
-        Process all log messages, until `stop()` is called. Intended to run
-        in its own thread.
+        Returns a dictionary with the number of bulbs with a stored state,
+        and the number of `fresh` lookups that hit and missed.
         """
-        while True:
-            msg = self._queue.get()
-            if msg is _SHUTDOWN:
-                break
-            if self._enabled:
-                print msg
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses}
 
 
-class ConnectException(Exception):
+class LightStateTable(object):
     """
-    An Exception raised when a gateway can't be found or connected to.
+    The last-received light state of many bulbs, stored by column: each
+    bulb has a row number (`index` maps mac addresses to them) into `array`s
+    of hue, saturation, brightness, kelvin, dim and power values and of the
+    times they were received. Updating a bulb's state overwrites its row in
+    place, so states arriving for known bulbs create no new objects.
     """
-    pass
-
-
-class SendException(Exception):
+    def __init__(self):
+        self.index = {}
+        self.macs = []
+        self.hue = array('H')
+        self.sat = array('H')
+        self.bright = array('H')
+        self.kelvin = array('H')
+        self.dim = array('H')
+        self.power = array('H')
+        self.time = array('d')
+
+    def __len__(self):
+        return len(self.macs)
+
+    def __contains__(self, mac):
+        return mac in self.index
+
+    def _columns(self):
+        return (self.hue, self.sat, self.bright, self.kelvin, self.dim,
+                self.power, self.time)
+
+    def update(self, mac, state, when):
+        """
+        Records `state` (a light state payload) for the bulb with mac address
+        `mac`, as received at time `when`.
+        """
+        row = self.index.get(mac)
+        if row is None:
+            self.index[mac] = len(self.macs)
+            self.macs.append(mac)
+            for column, value in zip(self._columns(), state[:6] + (when,)):
+                column.append(value)
+            return
+        self.hue[row] = state.hue
+        self.sat[row] = state.sat
+        self.bright[row] = state.bright
+        self.kelvin[row] = state.kelvin
+        self.dim[row] = state.dim
+        self.power[row] = state.power
+        self.time[row] = when
+
+    def get(self, mac):
+        """
+        Returns a tuple of (hue, sat, bright, kelvin, dim, power, time) for
+        the bulb with mac address `mac`, or None.
+        """
+        row = self.index.get(mac)
+        if row is None:
+            return None
+        return tuple(column[row] for column in self._columns())
+
+    def remove(self, mac):
+        """
+        Forgets the bulb with mac address `mac`, moving the last row into its
+        place to keep the columns packed.
+        """
+        row = self.index.pop(mac, None)
+        if row is None:
+            return
+        last = self.macs.pop()
+        for column in self._columns():
+            value = column.pop()
+            if last != mac:
+                column[row] = value
+        if last != mac:
+            self.macs[row] = last
+            self.index[last] = row
+
+    def snapshot(self):
+        """
+        Returns the columns as a LightColumns tuple, without copying them: the
+        `macs` list and the `array`s are the live ones, which keep changing as
+        states arrive. (NumPy users can wrap a column with `numpy.frombuffer`
+        to get an array of it without copying.)
+        """
+        return LightColumns(self.macs, *self._columns())
+
+
+class BulbGroups(object):
     """
-    An Exception raised when attempting to send data to a connected gateway.
+    Named groups of bulbs, each made of the bulbs whose labels match a
+    pattern, the bulbs with any of a set of tags, or an explicit list of mac
+    addresses. Membership is indexed as bulbs' labels and tags arrive (see
+    `update`), so looking a group up doesn't scan the bulbs.
     """
-    pass
+    def __init__(self):
+        # Mac addresses in each group, by name; the rule for each group
+        # (None for explicit lists); and each bulb's (label, tags).
+        self.members = {}
+        self._rules = {}
+        self._bulbs = {}
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def __getitem__(self, name):
+        """
+        Returns a list of the mac addresses in the group `name`, raising
+        KeyError if there's no such group.
+        """
+        return list(self.members[name])
+
+    def define(self, name, label=None, tags=None, macs=None):
+        """
+        Defines (or redefines) the group `name`, by exactly one of:
+
+        - `label`, a regular expression matching the start of the labels
+        - `tags`, a bitmask of tags (as in the light state's tags field)
+        - `macs`, a sequence of bulb mac addresses
+        """
+        if [label, tags, macs].count(None) != 2:
+            raise ValueError('a group needs one of label, tags or macs')
+        if macs is not None:
+            self._rules[name] = None
+            self.members[name] = set(macs)
+            return
+        if label is not None:
+            if not isinstance(label, bytes):
+                label = label.encode('utf-8')
+            pattern = re.compile(label)
+
+            def rule(label, bulb_tags):
+                return pattern.match(label) is not None
+        else:
+            def rule(label, bulb_tags):
+                return bool(bulb_tags & tags)
+        self._rules[name] = rule
+        self.members[name] = set(mac for mac, attrs in self._bulbs.items()
+                                 if rule(*attrs))
+
+    def undefine(self, name):
+        """
+        Removes the group `name`, if there is one.
+        """
+        self._rules.pop(name, None)
+        self.members.pop(name, None)
+
+    def update(self, mac, label, tags):
+        """
+        Records the `label` and `tags` (the raw field from a light state) of
+        the bulb with mac address `mac`, moving it between groups if they've
+        changed.
+        """
+        tags = _TAGS.unpack(tags)[0]
+        if self._bulbs.get(mac) == (label, tags):
+            return
+        self._bulbs[mac] = (label, tags)
+        for name, rule in self._rules.items():
+            if rule is None:
+                continue
+            if rule(label, tags):
+                self.members[name].add(mac)
+            else:
+                self.members[name].discard(mac)
 
+    def remove(self, mac):
+        """
+        Forgets the bulb with mac address `mac`, removing it from the groups
+        its label or tags put it in. (Explicit lists are left as they are.)
+        """
+        if self._bulbs.pop(mac, None) is None:
+            return
+        for name, rule in self._rules.items():
+            if rule is not None:
+                self.members[name].discard(mac)
 
-class Lifx(object):
-    """
-    Manages connecting to, sending requests to, and receiving responses from
-    Lifx bulbs.
+
+class PendingRequests(object):
     """
+    A table of outstanding requests, keyed by (bulb mac, expected response
+    type), so that each response only wakes up the requests that are waiting
+    for it.
 
-    def __init__(self, num_bulbs=None):
-        # Number of bulbs to wait for when connecting.
-        self.num_bulbs = 1 if num_bulbs is None else num_bulbs
+    The request side registers interest before sending, as in:
 
-        # Connection/bulb state.
-        self.gateway = None
-        self.bulbs = {}
-        self.power_state = {}
-        self.light_state = {}
+        future = pending.expect(mac, RESP_LIGHT_STATE)
+        send_request(mac)
+        response = future.result(timeout)
 
-        # Connection/state events.
-        self.gateway_found_event = Event()
-        self.bulbs_found_event = Event()
-        self.power_state_event = Event()
-        self.light_state_event = Event()
-        self.lock = Lock()
+    and the response side fills it in:
 
-        # Logging.
-        self.logger = Logger(False)
+        pending.resolve(header.mac, header.packet_type, payload)
 
-        # Callbacks.
-        self.callbacks = Callbacks(self.logger)
-        self.callbacks.register(RESP_GATEWAY, self._on_gateway)
-        self.callbacks.register(RESP_POWER_STATE, self._on_power_state)
-        self.callbacks.register(RESP_LIGHT_STATE, self._on_light_state)
+    A request can also give a predicate that a response has to satisfy, so
+    that e.g. a response that was already on its way when a change was sent
+    isn't taken as confirming it. Such requests can be superseded by a newer
+    change (see `supersede`), as they'd otherwise wait for a state the bulb
+    will never report.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._pending = {}
+        self._rtt = {}
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(futures) for futures in self._pending.values())
+
+    def rtt(self):
+        """
+        Returns a dictionary mapping response types to the `Histogram.stats`
+        of the round-trip times (from `expect` to `resolve`) of the requests
+        waiting for them.
+        """
+        return dict((packet_type, histogram.stats())
+                    for packet_type, histogram in list(self._rtt.items()))
+
+    def expect(self, mac, packet_type, accept=None):
+        """
+        Returns a ResponseFuture for the next response of type `packet_type`
+        from the bulb with mac address `mac` (for which `accept(response)`
+        returns true, if `accept` is given).
+        """
+        key = (mac, packet_type)
+        future = ResponseFuture(key)
+        with self._lock:
+            self._pending.setdefault(key, []).append((future, accept))
+        return future
+
+    def resolve(self, mac, packet_type, response):
+        """
+        Fills in every request waiting for a response of type `packet_type`
+        from `mac` that accepts `response`. Returns whether there were any.
+        """
+        key = (mac, packet_type)
+        with self._lock:
+            waiting = self._pending.get(key)
+            if not waiting:
+                return False
+            futures = []
+            rejected = []
+            for future, accept in waiting:
+                if accept is None or accept(response):
+                    futures.append(future)
+                else:
+                    rejected.append((future, accept))
+            if rejected:
+                self._pending[key] = rejected
+            else:
+                del self._pending[key]
+        if not futures:
+            return False
+        histogram = self._rtt.get(packet_type)
+        if histogram is None:
+            histogram = self._rtt[packet_type] = Histogram()
+        now = _monotonic()
+        for future in futures:
+            histogram.observe(now - future.created)
+            future.set_result(response)
+        return True
+
+    def supersede(self, mac, packet_type, state):
+        """
+        Resolves to None every request waiting for a response of type
+        `packet_type` from `mac` whose predicate rejects `state` (a record
+        like the response would be): those confirming an earlier change to
+        the bulb, which a newer one asking for `state` overrides. (Its packet
+        may not even be sent, if the sender drops it in favour of the newer
+        one.) Returns whether there were any.
+        """
+        key = (mac, packet_type)
+        with self._lock:
+            waiting = self._pending.get(key)
+            if not waiting:
+                return False
+            superseded = [future for future, accept in waiting
+                          if accept is not None and not accept(state)]
+            if not superseded:
+                return False
+            waiting[:] = [entry for entry in waiting
+                          if entry[0] not in superseded]
+            if not waiting:
+                del self._pending[key]
+        for future in superseded:
+            future.set_result(None)
+        return True
+
+    def cancel(self, future):
+        """
+        Stops waiting for the response to `future` (e.g. after a timeout).
+        """
+        with self._lock:
+            waiting = self._pending.get(future.key, [])
+            waiting[:] = [entry for entry in waiting if entry[0] is not future]
+            if not waiting:
+                self._pending.pop(future.key, None)
+
+
+class TimerWheel(object):
+    """
+    A hashed timing wheel, for keeping track of lots of timeouts cheaply:
+    scheduling an item is O(1), and each tick of the wheel only looks at the
+    items in one slot. Timeouts are rounded up to a whole number of ticks.
 
-        # Sending and receiving.
-        self.receiver = PacketReceiver(('0.0.0.0', LIFX_PORT), self.callbacks)
-        self.sender = PacketSender()
+    Not thread-safe.
+    """
+    def __init__(self, tick=0.05, slots=256, clock=_monotonic):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._cursor = 0
+        self._clock = clock
+        self._time = clock()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, item):
+        """
+        Schedules `item` to be returned by `advance` in `delay` seconds.
+        """
+        if not self._count:
+            # Nothing to lose by skipping ahead to now, if the wheel's been
+            # idle (and not turning).
+            self._time = self._clock()
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        rounds = (ticks - 1) // len(self._slots)
+        slot = (self._cursor + ticks) % len(self._slots)
+        self._slots[slot].append([rounds, item])
+        self._count += 1
+
+    def advance(self):
+        """
+        Turns the wheel up to the current time, returning a list of the items
+        that are due.
+        """
+        now = self._clock()
+        due = []
+        while self._time + self.tick <= now:
+            self._time += self.tick
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            waiting = []
+            for entry in self._slots[self._cursor]:
+                if entry[0]:
+                    entry[0] -= 1
+                    waiting.append(entry)
+                else:
+                    due.append(entry[1])
+            self._slots[self._cursor] = waiting
+        self._count -= len(due)
+        return due
 
-    ### Built-in callbacks
 
-    def _on_gateway(self, header, payload, rest, addr):
-        """
-        Records a discovered gateway, for connecting to later.
-        """
-        if payload.get('service') == SERVICE_UDP:
-            self.gateway = Gateway(addr[0], payload['port'], header.gateway)
-            self.gateway_found_event.set()
+class _Delivery(object):
+    """
+    A packet being delivered reliably, for `DeliveryTracker`.
+    """
+    __slots__ = ('mac', 'packet_type', 'packet_fmt', 'packet_args',
+                 'attempts', 'delay', 'sent', 'future')
 
-    def _on_power_state(self, header, payload, rest, addr):
+    def __init__(self, mac, packet_type, packet_fmt, packet_args, delay, sent):
+        self.mac = mac
+        self.packet_type = packet_type
+        self.packet_fmt = packet_fmt
+        self.packet_args = packet_args
+        self.attempts = 1
+        self.delay = delay
+        self.sent = sent
+        self.future = ResponseFuture((mac, packet_type))
+
+    def acknowledged_by(self, payload):
         """
-        Records the power (on/off) state of bulbs, and forwards to a high-level
-        callback with human-friendlier arguments.
+        Returns whether a response payload shows that the packet took effect.
+        """
+        if self.packet_type == REQ_SET_POWER_STATE:
+            return _shows_power(bool(self.packet_args[0].strip(b'\x00')),
+                                payload)
+        return _shows_color(self.packet_args[0], self.packet_args[1],
+                            self.packet_args[2], payload)
+
+
+def _shows_power(is_on, payload):
+    """
+    Returns whether a power state payload shows the bulb as `is_on`.
+    """
+    return bool(payload.is_on) == is_on
+
+
+def _shows_color(hue, sat, bright, payload):
+    """
+    Returns whether a light state payload shows the (raw) color `hue`, `sat`,
+    `bright`.
+    """
+    return (payload.hue, payload.sat, payload.bright) == (hue, sat, bright)
+
+
+# For packets that can be delivered reliably: the response that acknowledges
+# them, and whether the bulb sends it by itself (or has to be asked).
+_ACKNOWLEDGEMENTS = {
+    REQ_SET_POWER_STATE: (RESP_POWER_STATE, True),
+    REQ_SET_LIGHT_STATE: (RESP_LIGHT_STATE, False),
+}
+
+
+def _percentile(ordered, percent):
+    """
+    Returns the `percent` percentile of the sorted list `ordered`, by the
+    nearest-rank method.
+    """
+    if not ordered:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[max(0, rank - 1)]
+
+
+class DeliveryTracker(object):
+    """
+    An object to deliver packets reliably. The Lifx protocol has no sequence
+    numbers or acknowledgements, so a set-state packet counts as delivered
+    once the bulb reports the state it asked for. Until then, the packet is
+    tracked on a timer wheel and retransmitted (by calling `resend` with the
+    tracked `_Delivery`) with exponential backoff, up to `retries` times.
+
+    Delivery latencies (from first send to acknowledgement, retransmits
+    included) are kept for the last `history` deliveries, for `stats`. The
+    `run` function, to be run in a separate thread, drives the timer wheel.
+    """
+    def __init__(self, resend, retries=4, retry_delay=0.25, tick=0.05,
+                 history=1024, clock=_monotonic):
+        self._resend = resend
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._clock = clock
+        self._wheel = TimerWheel(tick, clock=clock)
+        self._outstanding = {}
+        self._latencies = deque(maxlen=history)
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._shutdown = Event()
+        self.delivered = 0
+        self.failed = 0
+        self.retransmits = 0
+
+    def track(self, mac, packet_type, packet_fmt, *packet_args):
+        """
+        Starts tracking a packet that's just been sent to the bulb `mac`.
+        Returns a ResponseFuture that resolves to the delivery latency (in
+        seconds), or to None if a newer packet of the same type for the same
+        bulb supersedes it; or that fails with a SendException if the bulb
+        never acknowledges it.
+        """
+        delivery = _Delivery(mac, packet_type, packet_fmt, packet_args,
+                             self._retry_delay, self._clock())
+        key = (mac, _ACKNOWLEDGEMENTS[packet_type][0])
+        with self._lock:
+            superseded = self._outstanding.get(key, [])
+            self._outstanding[key] = [delivery]
+            self._wheel.schedule(delivery.delay, delivery)
+        self._wakeup.set()
+        for old in superseded:
+            old.future.set_result(None)
+        return delivery.future
+
+    def acknowledge(self, mac, response_type, payload):
+        """
+        Checks a response from a bulb against the packets being delivered to
+        it, marking any that it acknowledges as delivered.
+        """
+        key = (mac, response_type)
+        if key not in self._outstanding:
+            return
+        now = self._clock()
+        with self._lock:
+            waiting = self._outstanding.get(key, [])
+            acked = [delivery for delivery in waiting
+                     if delivery.acknowledged_by(payload)]
+            if not acked:
+                return
+            waiting = [delivery for delivery in waiting
+                       if delivery not in acked]
+            if waiting:
+                self._outstanding[key] = waiting
+            else:
+                del self._outstanding[key]
+            for delivery in acked:
+                self._latencies.append(now - delivery.sent)
+            self.delivered += len(acked)
+        for delivery in acked:
+            delivery.future.set_result(now - delivery.sent)
+
+    def _expire(self, delivery):
+        """
+        Handles a delivery whose timeout has passed: reschedules it (returning
+        True, to retransmit it) if it has attempts left, or gives up on it
+        (returning False). Called within the lock.
+        """
+        if delivery.attempts > self._retries:
+            key = (delivery.mac, _ACKNOWLEDGEMENTS[delivery.packet_type][0])
+            waiting = [other for other in self._outstanding.get(key, [])
+                       if other is not delivery]
+            if waiting:
+                self._outstanding[key] = waiting
+            else:
+                self._outstanding.pop(key, None)
+            self.failed += 1
+            return False
+        delivery.attempts += 1
+        delivery.delay *= 2
+        self._wheel.schedule(delivery.delay, delivery)
+        self.retransmits += 1
+        return True
+
+    def stats(self):
+        """
+        Returns a dictionary of delivery counts, and the 50th, 90th and 99th
+        percentile delivery latencies (in seconds).
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            outstanding = sum(len(deliveries)
+                              for deliveries in self._outstanding.values())
+        return {'delivered': self.delivered,
+                'failed': self.failed,
+                'retransmits': self.retransmits,
+                'outstanding': outstanding,
+                'latency_p50': _percentile(latencies, 50),
+                'latency_p90': _percentile(latencies, 90),
+                'latency_p99': _percentile(latencies, 99)}
+
+    def stop(self):
+        """
+        Stop tracking deliveries.
+        """
+        self._shutdown.set()
+        self._wakeup.set()
+
+    def run(self):
+        """
+        Retransmit packets as their timeouts pass, until `stop()` is called.
+        Intended to run in its own thread.
+        """
+        while not self._shutdown.is_set():
+            self._wakeup.wait(self._wheel.tick if len(self._wheel) else None)
+            self._wakeup.clear()
+            resend, failed = [], []
+            with self._lock:
+                for delivery in self._wheel.advance():
+                    if delivery.future.done():
+                        continue
+                    elif self._expire(delivery):
+                        resend.append(delivery)
+                    else:
+                        failed.append(delivery)
+            for delivery in failed:
+                delivery.future.set_exception(SendException(
+                    'no acknowledgement from %s after %d attempts' % (
+                        _bytes(delivery.mac), delivery.attempts)))
+            for delivery in resend:
+                self._resend(delivery)
+
+
+class Timeouts(object):
+    """
+    Calls functions once their delays have passed, from the one thread that
+    runs `run` and turns a timer wheel, so that waiting on many timeouts
+    doesn't take a thread each.
+    """
+    def __init__(self, tick=0.05, clock=_monotonic):
+        self._wheel = TimerWheel(tick, clock=clock)
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._shutdown = Event()
+
+    def __len__(self):
+        return len(self._wheel)
+
+    def schedule(self, delay, fn):
+        """
+        Arranges for `fn` to be called (with no arguments) in `delay` seconds.
+        """
+        with self._lock:
+            self._wheel.schedule(delay, fn)
+        self._wakeup.set()
+
+    def stop(self):
+        """
+        Stop calling functions.
+        """
+        self._shutdown.set()
+        self._wakeup.set()
+
+    def run(self):
+        """
+        Call functions as their delays pass, until `stop()` is called.
+        Intended to run in its own thread.
+        """
+        while not self._shutdown.is_set():
+            self._wakeup.wait(self._wheel.tick if len(self._wheel) else None)
+            self._wakeup.clear()
+            with self._lock:
+                due = self._wheel.advance()
+            for fn in due:
+                fn()
+
+
+def _handler_name(fn, taken):
+    """
+    Returns a readable name for the callback handler `fn`, for latency stats:
+    its qualified name (with the class, for methods), numbered if a
+    different handler in `taken` (a dictionary mapping names to handlers)
+    already has that name, as two lambdas or the same method of two objects
+    would.
+    """
+    name = getattr(fn, '__qualname__', None)
+    if name is None:
+        name = getattr(fn, '__name__', None)
+        owner = getattr(fn, '__self__', None)
+        if name is not None and owner is not None:
+            name = '%s.%s' % (type(owner).__name__, name)
+    if name is None:
+        base = repr(fn)
+    else:
+        base = '%s.%s' % (getattr(fn, '__module__', None),
+                          name.replace('<locals>.', ''))
+    name = base
+    count = 1
+    while name in taken and taken[name] != fn:
+        count += 1
+        name = '%s#%d' % (base, count)
+    return name
+
+
+def _ordering_key(args):
+    """
+    Returns the mac address that callbacks with arguments `args` concern (the
+    first argument's `mac`, for packet headers and `Bulb`s), or None.
+    """
+    return getattr(args[0], 'mac', None) if args else None
+
+
+class Callbacks(object):
+    """
+    An object to manage callbacks. It exposes a queue to schedule callbacks,
+    and a `run` function to be run in a separate thread to consume the queue
+    and run the callback functions.
+
+    Callbacks are registered as either inline, run on the dispatching thread
+    (the built-in state-tracking ones, which must not be held up), or not. If
+    `workers` is nonzero, callbacks that aren't inline are handed to a pool of
+    that many worker threads while `run` is running, so a slow handler only
+    delays callbacks for the same bulb: callbacks are sharded by bulb mac
+    address, so those for any one bulb still run in order. The time spent in
+    each handler is recorded, and reported by `latency`.
+    """
+    def __init__(self, logger, workers=0):
+        self._logger = logger
+        self._callbacks = {}
+        self._queue = Queue.Queue()
+        self._workers = workers
+        self._pool = None
+        self._latency = {}
+        self._latency_lock = Lock()
+        self._names = {}
+
+    def register(self, event, fn, inline=True):
+        """
+        Tell the object to run `fn` whenever a message of type `event` is
+        received. If `inline` is false, `fn` may be run on a worker thread.
+        """
+        name = _handler_name(fn, self._names)
+        self._names[name] = fn
+        self._callbacks.setdefault(event, []).append((fn, inline, name))
+        return fn
+
+    def depth(self):
+        """
+        Returns the number of callbacks waiting to be run.
+        """
+        return self._queue.qsize()
+
+    def handles(self, event):
+        """
+        Returns whether any callbacks are registered for `event`.
+        """
+        return event in self._callbacks
+
+    def put(self, event, *args, **kwargs):
+        """
+        Schedule a callback for `event`, passing `args` and `kwargs` to each
+        registered callback handler.
+        """
+        self._queue.put((event, args, kwargs))
+
+    def stop(self):
+        """
+        Stop processing callbacks (once the queue is empty).
+        """
+        self._queue.put(_SHUTDOWN)
+
+    def run(self):
+        """
+        Process all callbacks, until `stop()` is called. Intended to run in
+        its own thread. Callbacks handed to worker threads are finished before
+        this returns.
+        """
+        if self._workers:
+            queues = [Queue.Queue() for _ in range(self._workers)]
+            self._pool = [(queue, _spawn(self._work, queue))
+                          for queue in queues]
+        try:
+            while True:
+                msg = self._queue.get()
+                if msg is _SHUTDOWN:
+                    break
+                event, args, kwargs = msg
+                self.dispatch(event, *args, **kwargs)
+        finally:
+            pool, self._pool = self._pool, None
+            for queue, thread in pool or []:
+                queue.put(_SHUTDOWN)
+            for queue, thread in pool or []:
+                thread.join()
+
+    def dispatch(self, event, *args, **kwargs):
+        """
+        Run the callbacks registered for `event`: inline ones right away, in
+        the calling thread, and others on a worker thread if there are any.
+        """
+        if self._logger.enabled:
+            self._logger('<< %s', event)
+        pool = self._pool
+        for func, inline, name in self._callbacks.get(event, []):
+            if inline or pool is None:
+                self._call(func, name, args, kwargs)
+            else:
+                queue = pool[hash(_ordering_key(args)) % len(pool)][0]
+                queue.put((func, name, args, kwargs))
+
+    def _work(self, queue):
+        """
+        Runs the callbacks handed to one worker thread, until shut down.
+        """
+        while True:
+            msg = queue.get()
+            if msg is _SHUTDOWN:
+                break
+            func, name, args, kwargs = msg
+            try:
+                self._call(func, name, args, kwargs)
+            except Exception as exc:
+                self._logger.error('callback %s failed: %r', name, exc)
+
+    def _call(self, func, name, args, kwargs):
+        """
+        Runs one callback handler, recording how long it took under `name`.
+        """
+        started = _monotonic()
+        try:
+            func(*args, **kwargs)
+        finally:
+            elapsed = _monotonic() - started
+            with self._latency_lock:
+                stats = self._latency.get(name)
+                if stats is None:
+                    stats = self._latency[name] = [0, 0.0, 0.0]
+                stats[0] += 1
+                stats[1] += elapsed
+                if elapsed > stats[2]:
+                    stats[2] = elapsed
+
+    def latency(self):
+        """
+        Returns a dictionary mapping the name of each handler that has been
+        run to a dictionary of its `calls`, and its `mean` and `max` run time
+        in seconds.
+        """
+        with self._latency_lock:
+            items = [(name, list(stats))
+                     for name, stats in self._latency.items()]
+        return dict((name, {'calls': calls,
+                            'mean': total / calls,
+                            'max': longest})
+                    for name, (calls, total, longest) in items)
+
+
+class LoopCallbacks(Callbacks):
+    """
+    A `Callbacks` object for use with an asyncio event loop: rather than
+    going through a queue consumed by a separate thread, callbacks that are
+    `put` are scheduled to run on the loop.
+    """
+    def __init__(self, logger, loop=None):
+        super(LoopCallbacks, self).__init__(logger)
+        self.loop = loop
+
+    def put(self, event, *args, **kwargs):
+        """
+        Schedule a callback for `event` to run on the event loop.
+        """
+        self.loop.call_soon(partial(self.dispatch, event, *args, **kwargs))
+
+    def run(self):
+        """
+        Returns straight away: callbacks are run by the event loop, so
+        there's no queue to consume.
+        """
+
+
+def _dispatch_datagram(callbacks, data, addr):
+    """
+    Parses a received datagram (a bytestring, or a buffer that may be reused
+    once this returns) and schedules callbacks for it, according to the
+    packet's type. Returns the event scheduled: the packet type,
+    `EVENT_UNKNOWN`, or `RUNT` for datagrams too short to be Lifx packets
+    (which are ignored).
+    """
+    if len(data) < _FORMAT_SIZE:
+        return RUNT
+    packet_type = _packet_type(data)
+    if packet_type in _PAYLOADS and len(data) >= _CODECS[packet_type].size:
+        header, payload = _CODECS[packet_type].unpack_from(data)
+        callbacks.put(packet_type, header, payload, None, addr)
+        return packet_type
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    header, rest = parse_packet(data)
+    callbacks.put(EVENT_UNKNOWN, header, None, rest, addr)
+    return EVENT_UNKNOWN
+
+
+class PacketReceiver(object):
+    """
+    An object to process incoming packets. It parses the data in the packets
+    and schedules callbacks (on a `Callback` object) according to the packet's
+    type. The `is_shutdown` event can be used to wait for the receiver to shut
+    down after calling `stop`.
+
+    The receiver sleeps until data arrives or `stop` is called (which wakes it
+    through a pipe), rather than polling. Each time it wakes it handles every
+    datagram that's waiting, receiving them into one reusable buffer.
+    `timeout`, if given, limits how long it sleeps for at a time. `rcvbuf`,
+    if given, sets the socket's receive buffer size (`SO_RCVBUF`), so that
+    bursts of replies from large fleets aren't dropped by the kernel.
+    """
+    def __init__(self, addr, callbacks, buffer_size=65536, timeout=None,
+                 rcvbuf=None):
+        self.received = TrafficCounter()
+        self._addr = addr
+        self._shutdown = Event()
+        self._callbacks = callbacks
+        self._buffer_size = buffer_size
+        self._timeout = timeout
+        self._rcvbuf = rcvbuf
+        self._wakeup = None
+        self._wakeup_lock = Lock()
+
+    @property
+    def is_shutdown(self):
+        """
+        An `Event` that is set when the receiver starts shutting down.
+        """
+        return self._shutdown
+
+    def stop(self):
+        """
+        Stop processing incoming packets.
+        """
+        self._shutdown.set()
+        with self._wakeup_lock:
+            if self._wakeup is not None:
+                try:
+                    os.write(self._wakeup, b'x')
+                except OSError:
+                    pass
+
+    def _drain(self, sock, buf, view):
+        """
+        Receives and dispatches every datagram waiting on `sock`, using `buf`
+        (and `view`, a memoryview of it) as the receive buffer.
+        """
+        while True:
+            try:
+                size, addr = sock.recvfrom_into(buf)
+            except socket.error as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            self.received.add(
+                _dispatch_datagram(self._callbacks, view[:size], addr), size)
+
+    def run(self):
+        """
+        Process all incoming packets, until `stop()` is called. Intended to run
+        in its own thread.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self._rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._rcvbuf)
+        sock.bind(self._addr)
+        sock.setblocking(False)
+        wakeup, self._wakeup = os.pipe()
+        if selectors is not None:
+            selector = selectors.DefaultSelector()
+            selector.register(sock, selectors.EVENT_READ)
+            selector.register(wakeup, selectors.EVENT_READ)
+            wait = selector.select
+        else:
+            selector = None
+            wait = partial(select.select, [sock, wakeup], [], [])
+
+        buf = bytearray(self._buffer_size)
+        view = memoryview(buf)
+        with closing(sock):
+            try:
+                while not self._shutdown.is_set():
+                    wait(self._timeout)
+                    self._drain(sock, buf, view)
+            finally:
+                if selector is not None:
+                    selector.close()
+                os.close(wakeup)
+                # Swapped out under the lock, so a concurrent `stop` never
+                # writes to a closed (and possibly reused) descriptor.
+                with self._wakeup_lock:
+                    write_end, self._wakeup = self._wakeup, None
+                os.close(write_end)
+
+
+class SendScheduler(object):
+    """
+    Decides when queued packets are sent. Each bulb gets a token bucket that
+    lets `rate` packets per second through to it (in bursts of up to
+    `burst`), since bulbs drop packets that arrive faster than they can
+    handle them. A `rate` of None turns off rate limiting. (Bulbs are told
+    apart by gateway as well as by mac, so that the `ALL_BULBS` packets sent
+    through each gateway are limited separately.)
+
+    While a set-state packet for a bulb is waiting its turn, a newer one of
+    the same type for the same bulb replaces it in place, so only the latest
+    state is sent. A newer get-state packet also replaces a waiting one, but
+    moves to the back of the bulb's queue. The number of packets waiting
+    (`depth`), replaced (`dropped`) and sent (`sent`) are kept as attributes.
+
+    Not thread-safe: intended to be used by the thread sending packets.
+    """
+    def __init__(self, rate=20.0, burst=5, clock=_monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.depth = 0
+        self.dropped = 0
+        self.sent = 0
+        self._clock = clock
+        self._queues = {}
+        self._latest = {}
+        self._buckets = {}
+        self._ready = deque()
+
+    def push(self, packet):
+        """
+        Queues a packet (a bytestring or buffer) for sending.
+        """
+        bulb = _ROUTE.unpack_from(packet, _TARGET_OFFSET)[0]
+        packet_type = _packet_type(packet)
+        coalesced = (packet_type in _COALESCED_TYPES or
+                     packet_type in _REQUEUED_TYPES)
+        if coalesced:
+            entry = self._latest.get((bulb, packet_type))
+            if entry is not None:
+                self.dropped += 1
+                if packet_type in _COALESCED_TYPES:
+                    entry[1] = packet
+                    return
+                # Left in the queue, but skipped when its turn comes.
+                entry[1] = None
+                self.depth -= 1
+
+        entry = [packet_type, packet]
+        queue = self._queues.get(bulb)
+        if queue is None:
+            queue = self._queues[bulb] = deque()
+            self._ready.append(bulb)
+        queue.append(entry)
+        if coalesced:
+            self._latest[(bulb, packet_type)] = entry
+        self.depth += 1
+
+    def _tokens(self, bulb, now):
+        """
+        Returns the number of tokens in `bulb`'s bucket, after refilling it.
+        """
+        bucket = self._buckets.get(bulb)
+        if bucket is None:
+            bucket = self._buckets[bulb] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) *
+                            self.rate)
+            bucket[1] = now
+        return bucket
+
+    def pop_ready(self, everything=False):
+        """
+        Returns a pair of (list of packets that may be sent now, number of
+        seconds until more will be, or None if nothing is waiting). If
+        `everything` is true, every waiting packet is returned regardless of
+        rate limits.
+        """
+        now = self._clock()
+        packets = []
+        wait = None
+        for _ in range(len(self._ready)):
+            bulb = self._ready.popleft()
+            queue = self._queues[bulb]
+            unlimited = everything or self.rate is None
+            bucket = None if unlimited else self._tokens(bulb, now)
+            while queue and (unlimited or bucket[0] >= 1):
+                entry = queue.popleft()
+                packet_type, packet = entry
+                if packet is None:
+                    continue
+                if self._latest.get((bulb, packet_type)) is entry:
+                    del self._latest[(bulb, packet_type)]
+                packets.append(packet)
+                if not unlimited:
+                    bucket[0] -= 1
+
+            if queue:
+                self._ready.append(bulb)
+                until = (1 - bucket[0]) / self.rate
+                wait = until if wait is None else min(wait, until)
+            else:
+                del self._queues[bulb]
+        self.depth -= len(packets)
+        self.sent += len(packets)
+        return packets, wait
+
+
+class PacketSender(object):
+    """
+    An object to manage outgoing packets. It exposes a queue to send packets,
+    and a `run` function to be run in a separate thread to consume the queue
+    while maintaining connections to gateways.
+
+    Each packet is sent to the gateway whose mac address is in its header,
+    or to the most recently connected gateway if that one isn't known. Each
+    gateway gets one long-lived UDP socket, connected to the gateway's
+    address, which is reused for every packet sent to it and closed when the
+    sender shuts down. Packets that are queued up together are sent in a
+    single batch, so a burst of `put` calls costs one queue wakeup.
+
+    Packets go through a `SendScheduler`, which limits each bulb to `rate`
+    packets per second (in bursts of up to `burst`) and only sends the
+    latest of any set-state (or get-state) packets for a bulb that are
+    waiting their turn.
+    """
+    def __init__(self, batch_size=256, rate=20.0, burst=5):
+        self._queue = Queue.Queue()
+        self._connected = Event()
+        self._gateway = None
+        self._gateways = {}
+        self._sockets = {}
+        self._batch_size = batch_size
+        self.scheduler = SendScheduler(rate, burst)
+        self.traffic = TrafficCounter()
+        self.errors = 0
+
+    @property
+    def is_connected(self):
+        """
+        An `Event` that is set once the sender has connected to a gateway.
+        """
+        return self._connected
+
+    def put(self, packet):
+        """
+        Schedules a packet to be sent to the gateway.
+        """
+        self._queue.put(packet)
+
+    def put_many(self, packets):
+        """
+        Schedules a list of packets to be sent to the gateway in one burst.
+        """
+        self._queue.put(list(packets))
+
+    def stop(self):
+        """
+        Stop processing outgoing packets (once the queue is empty).
+        """
+        self._queue.put(_SHUTDOWN)
+
+    def stats(self):
+        """
+        Returns a dictionary with the number of items waiting in the queue,
+        packets waiting their turn to be sent, packets dropped because a
+        newer one superseded them, packets sent, and sends that failed, and
+        the `TrafficCounter.stats` of the packets sent.
+        """
+        return {'queued': self._queue.qsize(),
+                'scheduled': self.scheduler.depth,
+                'dropped': self.scheduler.dropped,
+                'sent': self.scheduler.sent,
+                'errors': self.errors,
+                'traffic': self.traffic.stats()}
+
+    def _socket(self, gateway):
+        """
+        Returns the socket connected to `gateway`, creating it if necessary.
+        """
+        dest = (gateway.addr, gateway.port)
+        sock = self._sockets.get(dest)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect(dest)
+            self._sockets[dest] = sock
+        return sock
+
+    def _close(self):
+        """
+        Closes all of the gateway sockets.
+        """
+        for sock in self._sockets.values():
+            sock.close()
+        self._sockets.clear()
+
+    def _drain(self, timeout=None):
+        """
+        Blocks until something is queued (or for up to `timeout` seconds),
+        then returns a list of everything that's queued (up to the batch size)
+        without blocking again.
+        """
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout))
+            while len(batch) < self._batch_size:
+                batch.append(self._queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return batch
+
+    def _flush(self, packets):
+        """
+        Sends a batch of packets, each to its gateway.
+        """
+        if not packets:
+            return
+        if not self._gateway:
+            raise SendException('no gateway')
+        sends = {}
+        for packet in packets:
+            site = _SITE.unpack_from(packet, _SITE_OFFSET)[0]
+            send = sends.get(site)
+            if send is None:
+                gateway = self._gateways.get(site, self._gateway)
+                send = sends[site] = self._socket(gateway).send
+            try:
+                send(packet)
+            except socket.error:
+                # A connected UDP socket reports ICMP errors from earlier
+                # packets on later sends; delivery is best-effort anyway.
+                self.errors += 1
+                continue
+            self.traffic.add(_packet_type(packet), len(packet))
+
+    def run(self):
+        """
+        Process all outgoing packets, until `stop()` is called. Intended to run
+        in its own thread.
+        """
+        scheduler = self.scheduler
+        wait = None
+        try:
+            while True:
+                for to_send in self._drain(wait):
+                    if to_send is _SHUTDOWN:
+                        self._flush(scheduler.pop_ready(everything=True)[0])
+                        return
+
+                    # If we get a gateway object, connect to it (after sending
+                    # anything already queued). Otherwise, assume it's a
+                    # bytestring (or a list of them) and schedule it for
+                    # sending.
+                    if isinstance(to_send, Gateway):
+                        self._flush(scheduler.pop_ready(everything=True)[0])
+                        self._gateway = self._gateways[to_send.mac] = to_send
+                        self._connected.set()
+                    elif isinstance(to_send, list):
+                        for packet in to_send:
+                            scheduler.push(packet)
+                    else:
+                        scheduler.push(to_send)
+
+                packets, wait = scheduler.pop_ready()
+                self._flush(packets)
+        finally:
+            self._close()
+
+
+class DatagramHandler(object):
+    """
+    An asyncio datagram protocol that does the job of a `PacketReceiver` on
+    an event loop: it parses incoming packets and schedules callbacks (on a
+    `LoopCallbacks` object) according to the packet's type.
+    """
+    def __init__(self, callbacks):
+        self.received = TrafficCounter()
+        self._callbacks = callbacks
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.received.add(_dispatch_datagram(self._callbacks, data, addr),
+                          len(data))
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+
+class DatagramSender(object):
+    """
+    Does the job of a `PacketSender` on an event loop: packets are sent to
+    the gateway straight away on an asyncio datagram transport, rather than
+    going through a queue consumed by a separate thread.
+    """
+    def __init__(self):
+        self._connected = Event()
+        self._gateway = None
+        self._gateways = {}
+        self.transport = None
+        self.traffic = TrafficCounter()
+
+    @property
+    def is_connected(self):
+        """
+        An `Event` that is set once the sender has connected to a gateway.
+        """
+        return self._connected
+
+    def put(self, to_send):
+        """
+        Connects to a gateway (given a Gateway object), or sends a packet to
+        its gateway, as for `PacketSender`.
+        """
+        if isinstance(to_send, Gateway):
+            self._gateway = self._gateways[to_send.mac] = to_send
+            self._connected.set()
+        elif not self._gateway:
+            raise SendException('no gateway')
+        else:
+            site = _SITE.unpack_from(to_send, _SITE_OFFSET)[0]
+            gateway = self._gateways.get(site, self._gateway)
+            self.transport.sendto(to_send, (gateway.addr, gateway.port))
+            self.traffic.add(_packet_type(to_send), len(to_send))
+
+    def put_many(self, packets):
+        """
+        Sends a list of packets to their gateways.
+        """
+        for packet in packets:
+            self.put(packet)
+
+    def stats(self):
+        """
+        Returns a dictionary like `PacketSender.stats`. (Packets are sent
+        straight away, so nothing is ever queued.)
+        """
+        return {'queued': 0, 'scheduled': 0, 'dropped': 0,
+                'sent': sum(counts['packets']
+                            for counts in self.traffic.stats().values()),
+                'errors': 0, 'traffic': self.traffic.stats()}
+
+    def stop(self):
+        """
+        Stop sending packets, closing the transport.
+        """
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+class _Hex(object):
+    """
+    Wraps a bytestring so that it's only converted to its `_bytes`
+    representation if it's actually formatted into a log message.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return _bytes(self.data)
+
+
+class Logger(object):
+    """
+    An object to manage sequential logging.
+
+    Messages are logged at one of the `logging` module's levels, and those
+    below `level` (or all of them, if the logger isn't enabled) are dropped
+    before any formatting is done or anything is queued. Messages are
+    formatted lazily, by the thread running `run`.
+
+    If `target` (a `logging.Logger`) is given, messages are handed to it
+    instead of being printed.
+    """
+    def __init__(self, enabled=True, level=logging.DEBUG, target=None):
+        self.enabled = enabled
+        self.level = level
+        self.target = target
+        self._queue = Queue.Queue()
+
+    def depth(self):
+        """
+        Returns the number of messages waiting to be printed.
+        """
+        return self._queue.qsize()
+
+    def is_enabled_for(self, level):
+        """
+        Returns whether messages at `level` will be logged. Useful to avoid
+        computing log arguments when they'd be thrown away.
+        """
+        return self.enabled and level >= self.level
+
+    def log(self, level, msg, *args):
+        """
+        Log a message at `level`, to be formatted with `args` later.
+        """
+        if not self.enabled or level < self.level:
+            return
+        if self.target is not None:
+            self.target.log(level, msg, *args)
+        else:
+            self._queue.put((msg, args))
+
+    def debug(self, msg, *args):
+        """
+        Log a message at the DEBUG level.
+        """
+        self.log(logging.DEBUG, msg, *args)
+
+    __call__ = debug
+
+    def info(self, msg, *args):
+        """
+        Log a message at the INFO level.
+        """
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        """
+        Log a message at the WARNING level.
+        """
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        """
+        Log a message at the ERROR level.
+        """
+        self.log(logging.ERROR, msg, *args)
+
+    def stop(self):
+        """
+        Stop processing log messages (once the queue is empty).
+        """
+        self._queue.put(_SHUTDOWN)
+
+    def run(self):
+        """
+        Process all log messages, until `stop()` is called. Intended to run
+        in its own thread.
+        """
+        while True:
+            msg = self._queue.get()
+            if msg is _SHUTDOWN:
+                break
+            msg, args = msg
+            print(msg % args)
+
+
+class DiscoveryCache(object):
+    """
+    Remembers what discovery found (gateways, and bulbs with their labels and
+    gateways) in a JSON file at `path`, so a later `Lifx.connect` can start
+    straight away. Saved results are used for up to `ttl` seconds.
+    """
+    def __init__(self, path, ttl=24 * 60 * 60, clock=time.time):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self._clock = clock
+
+    def load(self):
+        """
+        Returns a pair of (list of Gateways, dictionary mapping bulb mac
+        addresses to pairs of (Bulb, gateway mac address)), or None if nothing
+        usable has been saved.
+        """
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            if self._clock() - saved['saved'] > self.ttl:
+                return None
+            gateways = [Gateway(addr, port, _unbytes(mac))
+                        for addr, port, mac in saved['gateways']]
+            bulbs = dict((_unbytes(mac),
+                          (Bulb(_unbytes(label), _unbytes(mac)),
+                           _unbytes(gateway)))
+                         for mac, label, gateway in saved['bulbs'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        return gateways, bulbs
+
+    def save(self, gateways, bulbs):
+        """
+        Saves a list of Gateways, and a dictionary like the one returned by
+        `load`. The file is replaced atomically, so a concurrent `load` sees
+        either the old contents or the new; if it can't be written, the
+        IOError or OSError is raised and no temporary file is left behind.
+        """
+        saved = {'saved': self._clock(),
+                 'gateways': [[gateway.addr, gateway.port,
+                               _bytes(gateway.mac)]
+                              for gateway in gateways],
+                 'bulbs': [[_bytes(mac), _bytes(bulb.label), _bytes(gateway)]
+                           for mac, (bulb, gateway) in bulbs.items()]}
+        temp = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(temp, 'w') as f:
+                json.dump(saved, f)
+            os.rename(temp, self.path)
+        except (IOError, OSError):
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+
+    def clear(self):
+        """
+        Forgets anything saved.
+        """
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class ConnectException(Exception):
+    """
+    An Exception raised when a gateway can't be found or connected to.
+    """
+    pass
+
+
+class SendException(Exception):
+    """
+    An Exception raised when attempting to send data to a connected gateway.
+    """
+    pass
+
+
+class _LifxBase(object):
+    """
+    The state and commands shared by `Lifx` and `AsyncLifx`: recording what
+    the bulbs report, and building and sending the packets for commands.
+    Subclasses provide the `callbacks`, `sender` and `receiver`, connecting,
+    and `_collect`, which decides whether commands block or return futures.
+    """
+
+    def __init__(self, num_bulbs=None, logger=None):
+        # Number of bulbs to wait for when connecting (if None, connecting
+        # only waits for a gateway, and bulbs are found in the background).
+        self.num_bulbs = 1 if num_bulbs is None else num_bulbs
+        self.wait_for_bulbs = num_bulbs is not None
+
+        # When each bulb was last heard from.
+        self.seen = {}
+
+        # Connection/bulb state. `gateway` is the first gateway found, and
+        # `gateways` maps the mac address of each one found to its Gateway;
+        # `routes` maps bulb mac addresses to the gateway each was heard from.
+        self.gateway = None
+        self.gateways = {}
+        self.routes = {}
+        self.bulbs = {}
+        self.power_state = StateCache()
+        self.light_state = StateCache()
+        self.light_table = LightStateTable()
+        self.groups = BulbGroups()
+
+        # Connection/state events.
+        self.gateway_found_event = Event()
+        self.bulbs_found_event = Event()
+        self.power_state_event = Event()
+        self.light_state_event = Event()
+        self.lock = Lock()
+
+        # Outstanding requests, by bulb and expected response.
+        self.pending = PendingRequests()
+
+        # Logging (disabled unless a Logger is given).
+        self.logger = Logger(False) if logger is None else logger
+
+    ### Built-in callbacks
+
+    def _register_callbacks(self):
+        """
+        Registers the built-in callbacks that track connection/bulb state.
+        """
+        self.callbacks.register(RESP_GATEWAY, self._on_gateway)
+        self.callbacks.register(RESP_POWER_STATE, self._on_power_state)
+        self.callbacks.register(RESP_LIGHT_STATE, self._on_light_state)
+
+    def _on_gateway(self, header, payload, rest, addr):
+        """
+        Records a discovered gateway, and tells the sender about it so that
+        packets can be routed to it.
+        """
+        if payload.service == SERVICE_UDP:
+            gateway = Gateway(addr[0], payload.port, header.gateway)
+            with self.lock:
+                is_new = self.gateways.get(gateway.mac) != gateway
+                self.gateways[gateway.mac] = gateway
+                if self.gateway is None:
+                    self.gateway = gateway
+            if is_new:
+                self.sender.put(gateway)
+            self.gateway_found_event.set()
+
+    def _on_power_state(self, header, payload, rest, addr):
+        """
+        Records the power (on/off) state of bulbs, and forwards to a high-level
+        callback with human-friendlier arguments.
         """
         with self.lock:
+            self.routes[header.mac] = header.gateway
+            self.seen[header.mac] = _monotonic()
             self.power_state[header.mac] = payload
             if len(self.power_state) >= self.num_bulbs:
                 self.power_state_event.set()
+        self.pending.resolve(header.mac, RESP_POWER_STATE, payload)
 
         self.callbacks.put(EVENT_POWER_STATE, self.get_bulb(header.mac),
-                           is_on=bool(payload['is_on']))
+                           is_on=bool(payload.is_on))
 
     def _on_light_state(self, header, payload, rest, addr):
         """
         Records the light state of bulbs, and forwards to a high-level callback
         with human-friendlier arguments.
         """
+        now = _monotonic()
+        # One unpacking is cheaper than reading the fields one at a time
+        # (particularly on Python 2, where record fields are properties).
+        hue, sat, bright, kelvin, _, power, label, tags = payload
         with self.lock:
-            label = payload['label'].strip('\x00')
-            self.bulbs[header.mac] = bulb = Bulb(label, header.mac)
+            label = label.strip(b'\x00')
+            bulb = self.bulbs.get(header.mac)
+            added = bulb is None
+            if added or bulb.label != label:
+                self.bulbs[header.mac] = bulb = Bulb(label, header.mac)
+            self.routes[header.mac] = header.gateway
+            self.seen[header.mac] = now
+            self.light_table.update(header.mac, payload, now)
+            self.groups.update(header.mac, label, tags)
             if len(self.bulbs) >= self.num_bulbs:
                 self.bulbs_found_event.set()
 
             self.light_state[header.mac] = payload
             if len(self.light_state) >= self.num_bulbs:
                 self.light_state_event.set()
+        self.pending.resolve(header.mac, RESP_LIGHT_STATE, payload)
 
+        if added:
+            self.callbacks.put(EVENT_BULB_ADDED, bulb)
+        if not self.callbacks.handles(EVENT_LIGHT_STATE):
+            return
         self.callbacks.put(EVENT_LIGHT_STATE, bulb,
                            raw=payload,
-                           hue=(payload['hue'] / float(0xffff) * 360) % 360.0,
-                           saturation=payload['sat'] / float(0xffff),
-                           brightness=payload['bright'] / float(0xffff),
-                           kelvin=payload['kelvin'],
-                           is_on=bool(payload['power']))
+                           hue=(hue / float(0xffff) * 360) % 360.0,
+                           saturation=sat / float(0xffff),
+                           brightness=bright / float(0xffff),
+                           kelvin=kelvin,
+                           is_on=bool(power))
 
     ### State methods
 
@@ -475,55 +2439,413 @@ class Lifx(object):
         Returns a Bulb object corresponding to the bulb with the mac address
         `mac` (a 6-byte bytestring).
         """
-        return self.bulbs.get(mac, Bulb('Bulb %s' % _bytes(mac), mac))
+        bulb = self.bulbs.get(mac)
+        if bulb is None:
+            bulb = Bulb(b'Bulb ' + _bytes(mac).encode('ascii'), mac)
+        return bulb
+
+    def define_group(self, name, label=None, tags=None, macs=None):
+        """
+        Defines a named group of bulbs, by a label pattern, a bitmask of tags
+        or a list of mac addresses (see `BulbGroups.define`), which the
+        `group` argument of the set-state methods can then address.
+        """
+        with self.lock:
+            self.groups.define(name, label, tags, macs)
+
+    def _group(self, name):
+        """
+        Returns a list of the mac addresses of the bulbs in the group `name`.
+        """
+        with self.lock:
+            return self.groups[name]
+
+    def light_columns(self):
+        """
+        Returns the last-received light state of every bulb by column, as a
+        LightColumns tuple; see `LightStateTable.snapshot`.
+        """
+        with self.lock:
+            return self.light_table.snapshot()
+
+    def get_light_state(self, bulb=ALL_BULBS, max_age=None, timeout=None):
+        """
+        Returns a dictionary mapping the mac addresses of one or more bulbs
+        to their (raw) light state.
+
+        States recorded no more than `max_age` seconds ago (or at all, if
+        `max_age` is None) are answered from `light_state` without asking the
+        bulbs; only the bulbs without one are asked, and this blocks until
+        they've responded, or until `timeout` seconds have passed. Bulbs that
+        don't respond are left out.
+        """
+        targets = self._targets(bulb)
+        futures = {}
+        stale = []
+        with self.lock:
+            for mac in targets:
+                state = self.light_state.fresh(mac, max_age)
+                if state is None:
+                    stale.append(mac)
+                else:
+                    futures[mac] = _resolved(mac, state)
+
+        if stale:
+            futures.update(self._expect_each(stale, RESP_LIGHT_STATE))
+            if bulb == ALL_BULBS and len(stale) == len(targets):
+                stale = [ALL_BULBS]
+            for mac in stale:
+                self.send(REQ_GET_LIGHT_STATE, mac, '')
+        return self._collect(futures, timeout)
 
     ### Sender methods
 
     def send(self, packet_type, bulb, packet_fmt, *packet_args):
         """
-        Builds and sends a packet to one or more bulbs.
+        Builds and sends a packet to one or more bulbs, with the codec
+        registered for `packet_type` if its payload format is `packet_fmt`.
+
+        `bulb` is a bulb's mac address, `ALL_BULBS`, or a list of mac
+        addresses; for a list, the packets (built with the codec registered
+        for `packet_type`) are packed into one buffer and sent in one burst.
+        """
+        if isinstance(bulb, list):
+            with self.lock:
+                routes = [(self.routes.get(mac, self.gateway.mac), mac)
+                          for mac in bulb]
+            packets = self._pack_each(packet_type, routes, *packet_args)
+        else:
+            codec = _CODECS.get(packet_type)
+            if codec is not None and codec.payload_fmt == packet_fmt:
+                packets = [codec.pack(gateway, bulb, *packet_args)
+                           for gateway in self._routes(bulb)]
+            else:
+                packets = [build_packet(packet_type, gateway, bulb,
+                                        packet_fmt, *packet_args)
+                           for gateway in self._routes(bulb)]
+        if self.logger.enabled:
+            for packet in packets:
+                self.logger('>> %s', _Hex(packet))
+        if len(packets) == 1:
+            self.sender.put(packets[0])
+        else:
+            self.sender.put_many(packets)
+
+    def _pack_each(self, packet_type, routes, *payload_args):
+        """
+        Packs a packet of `packet_type` with the same payload for each of
+        `routes`, a list of (gateway mac address, bulb mac address) pairs,
+        into one buffer. Returns a list of memoryviews of the packets.
+        """
+        codec = _CODECS[packet_type]
+        buf = bytearray(len(routes) * codec.size)
+        view = memoryview(buf)
+        packets = []
+        offset = 0
+        for gateway, mac in routes:
+            end = codec.pack_into(buf, offset, gateway, mac, *payload_args)
+            packets.append(view[offset:end])
+            offset = end
+        return packets
+
+    def _routes(self, bulb):
+        """
+        Returns a list of the mac addresses of the gateways that a packet for
+        `bulb` is sent through: the one the bulb was last heard from (or the
+        first gateway found, if it hasn't been), or every gateway found, for
+        `ALL_BULBS`.
         """
-        packet = build_packet(packet_type, self.gateway.mac, bulb,
-                              packet_fmt, *packet_args)
-        self.logger('>> %s', _bytes(packet))
-        self.sender.put(packet)
+        with self.lock:
+            if bulb == ALL_BULBS and self.gateways:
+                return list(self.gateways)
+            return [self.routes.get(bulb, self.gateway.mac)]
 
-    def set_power_state(self, is_on, bulb=ALL_BULBS, timeout=None):
+    def _targets(self, bulb):
         """
-        Sets the power state of one or more bulbs.
+        Returns a list of the mac addresses of the bulbs that a request for
+        `bulb` addresses: every known bulb, for `ALL_BULBS`, or the bulbs in
+        `bulb`, for a list.
         """
-        with _blocking(self.lock, self.power_state, self.light_state_event,
-                       timeout):
-            self.send(REQ_SET_POWER_STATE,
-                      bulb, '2s', '\x00\x01' if is_on else '\x00\x00')
-            self.send(REQ_GET_LIGHT_STATE, ALL_BULBS, '')
-        return self.power_state
+        if isinstance(bulb, list):
+            return bulb
+        if bulb == ALL_BULBS:
+            with self.lock:
+                return list(self.bulbs)
+        return [bulb]
 
-    def set_light_state_raw(self, hue, saturation, brightness, kelvin,
-                            bulb=ALL_BULBS, timeout=None):
+    def _expect(self, bulb, packet_type, accept=None):
         """
-        Sets the (low-level) light state of one or more bulbs.
+        Registers interest in responses of type `packet_type` from `bulb`, or
+        from every known bulb if `bulb` is `ALL_BULBS`, that `accept` (as for
+        `PendingRequests.expect`). Returns a dictionary mapping bulb mac
+        addresses to ResponseFutures.
         """
-        with _blocking(self.lock, self.light_state, self.light_state_event,
-                       timeout):
-            self.send(REQ_SET_LIGHT_STATE, bulb, 'xHHHHI',
-                      hue, saturation, brightness, kelvin, 0)
-            self.send(REQ_GET_LIGHT_STATE, ALL_BULBS, '')
-        return self.light_state
+        return self._expect_each(self._targets(bulb), packet_type, accept)
+
+    def _expect_each(self, macs, packet_type, accept=None):
+        """
+        Like `_expect`, for each of the bulbs in the list `macs`.
+        """
+        return dict((mac, self.pending.expect(mac, packet_type, accept))
+                    for mac in macs)
+
+    def _expect_change(self, bulb, packet_type, state, accept):
+        """
+        Like `_expect`, for the responses that confirm a change to `bulb`
+        asking for `state` (a record like the response would be). Any earlier
+        change to the same bulbs still waiting to be confirmed is superseded
+        (see `PendingRequests.supersede`), and its requests resolve to None.
+        """
+        targets = self._targets(bulb)
+        for mac in targets:
+            self.pending.supersede(mac, packet_type, state)
+        return self._expect_each(targets, packet_type, accept)
+
+    def _collect(self, futures, timeout=None):
+        """
+        Returns the responses in `futures` (as returned by `_expect`), within
+        `timeout` seconds in all, as a dictionary mapping bulb mac addresses
+        to responses for the bulbs that responded in time: either directly,
+        blocking until then, or as a future.
+        """
+        raise NotImplementedError
+
+    def _refresh(self, bulb, refresh, duration=0):
+        """
+        Asks for the light state that confirms a change made to `bulb`,
+        according to `refresh` (one of the `REFRESH_` constants), that the
+        bulbs transition to over `duration` milliseconds.
+        """
+        if refresh == REFRESH_ALL:
+            bulb = ALL_BULBS
+        elif refresh != REFRESH_TARGETED:
+            return
+        self.send(REQ_GET_LIGHT_STATE, bulb, '')
+        if duration:
+            self._refresh_after(bulb, duration)
+
+    def _refresh_after(self, bulb, duration):
+        """
+        Asks `bulb` for its light state again once a transition lasting
+        `duration` milliseconds is over. A bulb part way through one reports
+        the color it has got to, which doesn't confirm the change.
+        """
+        self._call_later(duration / 1000.0 + _SETTLE_TIME,
+                         partial(self.send, REQ_GET_LIGHT_STATE, bulb, ''))
+
+    def _call_later(self, delay, fn):
+        """
+        Arranges for `fn` to be called in `delay` seconds.
+        """
+        raise NotImplementedError
+
+    def _assume(self, bulb, state, update):
+        """
+        Updates the recorded state (`self.light_state` or `self.power_state`)
+        of `bulb`, or of every known bulb for `ALL_BULBS`, without waiting for
+        the bulbs to confirm. `update` is called with each bulb's recorded
+        state (or None) and returns the new state (or None to leave it be).
+
+        Returns a dictionary mapping bulb mac addresses to ResponseFutures that
+        already hold the updated state, like `_expect`.
+        """
+        targets = self._targets(bulb)
+        futures = {}
+        with self.lock:
+            for mac in targets:
+                updated = update(state.get(mac))
+                if updated is not None:
+                    state[mac] = updated
+                    futures[mac] = _resolved(mac, updated)
+        return futures
+
+    def set_power_state(self, is_on, bulb=ALL_BULBS, timeout=None,
+                        refresh=REFRESH_TARGETED, group=None):
+        """
+        Sets the power state of one or more bulbs: `bulb`, or the bulbs in
+        `group` (see `define_group`), whose packets are sent in one burst.
+
+        Blocks until each of the bulbs has responded, or until `timeout`
+        seconds have passed, and returns a dictionary mapping the mac
+        addresses of the bulbs that responded to their power state (or to
+        None, for bulbs where a newer change superseded this one first).
+
+        `refresh` controls which bulbs are then asked for their light state:
+        `REFRESH_TARGETED` (the default) asks just the bulbs that were
+        changed, and `REFRESH_ALL` asks all of them. With `REFRESH_NONE`, no
+        bulbs are asked, the call doesn't wait for any responses, and the
+        recorded state is updated on the assumption that the change worked.
+        """
+        return self._collect(self._set_power_state(is_on, bulb, refresh,
+                                                   group), timeout)
+
+    def _set_power_state(self, is_on, bulb, refresh, group):
+        """
+        Sends the packets for `set_power_state`, returning a dictionary of
+        ResponseFutures for the responses, like `_expect`.
+        """
+        if group is not None:
+            bulb = self._group(group)
+        level = b'\x00\x01' if is_on else b'\x00\x00'
+        requested = _CODECS[RESP_POWER_STATE].record(int(is_on))
+        if refresh == REFRESH_NONE:
+            power = 0xffff if is_on else 0
+            self._assume(bulb, self.light_state,
+                         partial(_updated, power=power))
+            futures = self._assume(bulb, self.power_state,
+                                   lambda state: requested)
+        else:
+            # Only a response showing the new state confirms it; one that
+            # was already on its way doesn't.
+            futures = self._expect_change(bulb, RESP_POWER_STATE, requested,
+                                          partial(_shows_power, bool(is_on)))
+        self.send(REQ_SET_POWER_STATE, bulb, '2s', level)
+        self._refresh(bulb, refresh)
+        return futures
+
+    def set_light_state_raw(self, hue, saturation, brightness, kelvin,
+                            bulb=ALL_BULBS, timeout=None,
+                            refresh=REFRESH_TARGETED, duration=0,
+                            group=None):
+        """
+        Sets the (low-level) light state of one or more bulbs, which
+        transition to it over `duration` milliseconds. As for
+        `set_power_state`, the bulbs are either `bulb` or those in `group`.
+
+        Blocks until each of the bulbs has responded, or until `timeout`
+        seconds have passed, and returns a dictionary mapping the mac
+        addresses of the bulbs that responded to their light state (or to
+        None, as for `set_power_state`).
+
+        `refresh` controls which bulbs are asked for their light state to
+        confirm the change, as for `set_power_state`. With `REFRESH_NONE`, the
+        returned light states are the recorded ones, updated on the
+        assumption that the change worked.
+        """
+        return self._collect(self._set_light_state(
+            hue, saturation, brightness, kelvin, bulb, refresh, duration,
+            group), timeout)
+
+    def _set_light_state(self, hue, saturation, brightness, kelvin, bulb,
+                         refresh, duration, group):
+        """
+        Sends the packets for `set_light_state_raw`, returning a dictionary of
+        ResponseFutures for the responses, like `_expect`.
+        """
+        if group is not None:
+            bulb = self._group(group)
+        if refresh == REFRESH_NONE:
+            futures = self._assume(
+                bulb, self.light_state,
+                partial(_updated, hue=hue, sat=saturation, bright=brightness,
+                        kelvin=kelvin))
+        else:
+            requested = _CODECS[REQ_SET_LIGHT_STATE].record(
+                hue, saturation, brightness, kelvin, duration)
+            futures = self._expect_change(bulb, RESP_LIGHT_STATE, requested,
+                                          partial(_shows_color, hue,
+                                                  saturation, brightness))
+        self.send(REQ_SET_LIGHT_STATE, bulb, 'xHHHHI',
+                  hue, saturation, brightness, kelvin, duration)
+        self._refresh(bulb, refresh, duration)
+        return futures
 
     def set_light_state(self, hue, saturation, brightness, kelvin,
-                        bulb=ALL_BULBS, timeout=None):
+                        bulb=ALL_BULBS, timeout=None,
+                        refresh=REFRESH_TARGETED, duration=0, group=None):
         """
-        Sets the light state of one or more bulbs.
+        Sets the light state of one or more bulbs (`bulb`, or those in
+        `group`).
 
         Hue is a float from 0 to 360, saturation and brightness are floats from
-        0 to 1, and kelvin is an integer.
+        0 to 1, and kelvin is an integer. The bulbs transition to the new state
+        over `duration` milliseconds.
         """
-        raw_hue = int((hue % 360) / 360.0 * 0xffff) & 0xffff
-        raw_sat = int(saturation * 0xffff) & 0xffff
-        raw_bright = int(brightness * 0xffff) & 0xffff
+        raw_hue, raw_sat, raw_bright = _raw_color(hue, saturation, brightness)
         return self.set_light_state_raw(raw_hue, raw_sat, raw_bright, kelvin,
-                                        bulb, timeout)
+                                        bulb, timeout, refresh, duration,
+                                        group)
+
+    def apply_scene(self, scene, timeout=None, refresh=REFRESH_TARGETED):
+        """
+        Sets the light state of many bulbs at once. `scene` is a dictionary
+        mapping bulb mac addresses to tuples of (hue, saturation, brightness,
+        kelvin, duration), where the first four are as for `set_light_state`
+        and duration is the transition time in milliseconds.
+
+        The packets for every bulb are built in one pass, into one buffer, and
+        sent in one burst; the bulbs' confirmations (according to `refresh`,
+        as for `set_light_state`) are then collected in parallel. Returns a
+        dictionary mapping each bulb's mac address to whether it confirmed
+        its new state within `timeout` seconds.
+        """
+        responses = self._collect(self._send_scene(scene, refresh), timeout)
+        return dict((mac, responses.get(mac) is not None) for mac in scene)
+
+    def _send_scene(self, scene, refresh):
+        """
+        Sends the packets for `apply_scene`, returning a dictionary of
+        ResponseFutures for the confirmations, like `_expect`.
+        """
+        set_codec = _CODECS[REQ_SET_LIGHT_STATE]
+        macs = list(scene)
+
+        if refresh == REFRESH_NONE:
+            futures = {}
+            for mac in macs:
+                hue, sat, bright, kelvin, _ = scene[mac]
+                hue, sat, bright = _raw_color(hue, sat, bright)
+                futures.update(self._assume(
+                    mac, self.light_state,
+                    partial(_updated, hue=hue, sat=sat, bright=bright,
+                            kelvin=kelvin)))
+            refreshes = []
+        else:
+            futures = {}
+            for mac in macs:
+                hue, sat, bright, kelvin, duration = scene[mac]
+                hue, sat, bright = _raw_color(hue, sat, bright)
+                futures.update(self._expect_change(
+                    mac, RESP_LIGHT_STATE,
+                    set_codec.record(hue, sat, bright, kelvin, duration),
+                    partial(_shows_color, hue, sat, bright)))
+            refreshes = macs if refresh == REFRESH_TARGETED else [ALL_BULBS]
+
+        # One buffer for each gateway's set packets, built by column where
+        # possible, and one for the refresh packets.
+        by_gateway = {}
+        for mac in macs:
+            by_gateway.setdefault(self._routes(mac)[0], []).append(mac)
+        packets = []
+        for gateway, group in by_gateway.items():
+            sets = encode_light_frame(gateway, group,
+                                      [scene[mac][:4] for mac in group],
+                                      [scene[mac][4] for mac in group])
+            view = memoryview(sets)
+            packets.extend(view[offset:offset + set_codec.size]
+                           for offset in range(0, len(sets), set_codec.size))
+
+        refreshes = [(gateway, mac) for mac in refreshes
+                     for gateway in self._routes(mac)]
+        packets.extend(self._pack_each(REQ_GET_LIGHT_STATE, refreshes))
+
+        if self.logger.enabled:
+            for packet in packets:
+                self.logger('>> %s', _Hex(packet.tobytes()))
+        self.sender.put_many(packets)
+
+        # Bulbs with a transition to make are asked again once it's over.
+        if refresh != REFRESH_NONE:
+            later = {}
+            for mac in macs:
+                if scene[mac][4]:
+                    later.setdefault(scene[mac][4], []).append(mac)
+            if refresh == REFRESH_ALL and later:
+                self._refresh_after(ALL_BULBS, max(later))
+            elif refresh == REFRESH_TARGETED:
+                for duration, group in later.items():
+                    self._refresh_after(group, duration)
+        return futures
 
     ### Callback helpers
 
@@ -531,39 +2853,46 @@ class Lifx(object):
         """
         Registers a function to be called when a gateway is discovered.
         """
-        return self.callbacks.register(EVENT_DISCOVERED, fn)
+        return self.callbacks.register(EVENT_DISCOVERED, fn, inline=False)
 
     def on_connected(self, fn):
         """
         Registers a function to be called when a gateway connection is made.
         """
-        return self.callbacks.register(EVENT_CONNECTED, fn)
+        return self.callbacks.register(EVENT_CONNECTED, fn, inline=False)
 
     def on_bulbs_found(self, fn):
         """
         Registers a function to be called when the expected number of bulbs are
         found.
         """
-        return self.callbacks.register(EVENT_BULBS_FOUND, fn)
+        return self.callbacks.register(EVENT_BULBS_FOUND, fn, inline=False)
+
+    def on_bulb_added(self, fn):
+        """
+        Registers a function to be called with a Bulb when a bulb is first
+        heard from.
+        """
+        return self.callbacks.register(EVENT_BULB_ADDED, fn, inline=False)
 
     def on_light_state(self, fn):
         """
         Registers a function to be called when light state data is received.
         """
-        return self.callbacks.register(EVENT_LIGHT_STATE, fn)
+        return self.callbacks.register(EVENT_LIGHT_STATE, fn, inline=False)
 
     def on_power_state(self, fn):
         """
         Registers a function to be called when power state data is received.
         """
-        return self.callbacks.register(EVENT_POWER_STATE, fn)
+        return self.callbacks.register(EVENT_POWER_STATE, fn, inline=False)
 
     def on_unknown(self, fn):
         """
         Registers a function to be called when packet data is received with a
         type that has no explicitly registered callbacks.
         """
-        return self.callbacks.register(EVENT_UNKNOWN, fn)
+        return self.callbacks.register(EVENT_UNKNOWN, fn, inline=False)
         # TODO event constants
 
     def on_packet(self, packet_type):
@@ -572,9 +2901,276 @@ class Lifx(object):
         specific type.
         """
         def _wrapper(fn):
-            return self.callbacks.register(packet_type, fn)
+            return self.callbacks.register(packet_type, fn, inline=False)
         return _wrapper
 
+
+class Lifx(_LifxBase):
+    """
+    Manages connecting to, sending requests to, and receiving responses from
+    Lifx bulbs.
+    """
+
+    def __init__(self, num_bulbs=None, logger=None, reliable=False,
+                 callback_workers=0, cache=None, discover=True,
+                 metrics_interval=None):
+        super(Lifx, self).__init__(num_bulbs, logger)
+
+        # Whether `run` keeps discovering gateways and bulbs in the
+        # background.
+        self.discover = discover
+        self._stopping = Event()
+
+        # Discovery results from an earlier run (a DiscoveryCache, or None),
+        # and the thread checking they're still right, if there is one.
+        self.cache = cache
+        self.revalidation = None
+
+        # Reliable delivery (off unless asked for).
+        self.reliable = reliable
+        self.tracker = DeliveryTracker(self._resend)
+
+        # Timeouts for the futures returned by the `*_async` methods.
+        self.timeouts = Timeouts()
+
+        # How often `run` calls the `on_metrics` callbacks with `stats()`, in
+        # seconds (or never, if None).
+        self.metrics_interval = metrics_interval
+
+        # Callbacks (those registered through the `on_*` helpers run on a
+        # pool of `callback_workers` threads, if that's nonzero).
+        self.callbacks = Callbacks(self.logger, callback_workers)
+        self._register_callbacks()
+
+        # Sending and receiving.
+        self.receiver = PacketReceiver(('0.0.0.0', LIFX_PORT), self.callbacks)
+        self.sender = PacketSender()
+
+    ### Built-in callbacks
+
+    def _on_power_state(self, header, payload, rest, addr):
+        """
+        As for `_LifxBase`, also acknowledging reliable deliveries.
+        """
+        super(Lifx, self)._on_power_state(header, payload, rest, addr)
+        self.tracker.acknowledge(header.mac, RESP_POWER_STATE, payload)
+
+    def _on_light_state(self, header, payload, rest, addr):
+        """
+        As for `_LifxBase`, also acknowledging reliable deliveries.
+        """
+        super(Lifx, self)._on_light_state(header, payload, rest, addr)
+        self.tracker.acknowledge(header.mac, RESP_LIGHT_STATE, payload)
+
+    ### State methods
+
+    def stats(self):
+        """
+        Returns a dictionary of runtime metrics:
+
+        * `received` and `sent`: dictionaries mapping packet types to the
+          number of `packets` and `bytes` received and sent (received
+          packets of unknown types are counted under `EVENT_UNKNOWN`, and
+          datagrams too short to be packets under `RUNT`)
+        * `unknown`: the number of packets of unknown types received
+        * `queues`: the number of items waiting for the callbacks, sender
+          (`sender`, and `scheduled` for packets held back by rate limits)
+          and logger threads
+        * `dropped`: the number of packets superseded before they were sent
+          (`coalesced`), sends that failed (`send_errors`), and datagrams
+          received that were too short to be packets (`runts`)
+        * `rtt`: dictionaries mapping response types to histograms of the
+          round-trip times of the requests that waited for them, as for
+          `Histogram.stats`
+        * `delivery`, `light_state_cache` and `callbacks`: the stats of the
+          `tracker`, `light_state` cache and `callbacks` (handler latency)
+        """
+        receiver = self.receiver
+        received = {} if receiver is None else receiver.received.stats()
+        sender = self.sender.stats()
+        return {
+            'received': received,
+            'sent': sender['traffic'],
+            'unknown': received.get(EVENT_UNKNOWN, {}).get('packets', 0),
+            'queues': {'callbacks': self.callbacks.depth(),
+                       'sender': sender['queued'],
+                       'scheduled': sender['scheduled'],
+                       'logger': self.logger.depth()},
+            'dropped': {'coalesced': sender['dropped'],
+                        'send_errors': sender['errors'],
+                        'runts': received.get(RUNT, {}).get('packets', 0)},
+            'rtt': self.pending.rtt(),
+            'delivery': self.tracker.stats(),
+            'light_state_cache': self.light_state.stats(),
+            'callbacks': self.callbacks.latency(),
+        }
+
+    def report_metrics(self, interval):
+        """
+        Calls the `on_metrics` callbacks with `stats()` every `interval`
+        seconds, until `stop` is called. Intended to run in its own thread
+        (`run` starts one if `metrics_interval` is set).
+        """
+        while not self._stopping.wait(interval):
+            self.callbacks.put(EVENT_METRICS, self.stats())
+
+    ### Sender methods
+
+    def send(self, packet_type, bulb, packet_fmt, *packet_args, **kwargs):
+        """
+        Builds and sends a packet to one or more bulbs, as for `_LifxBase`.
+
+        If the `reliable` keyword argument is true (it defaults to the
+        `reliable` attribute), set-state packets are tracked until each bulb
+        they're sent to reports the new state, and retransmitted if it
+        doesn't; see `DeliveryTracker`. Returns a dictionary mapping each
+        bulb's mac address to a ResponseFuture for its delivery, without
+        waiting for any of them. (Otherwise, returns None.) If the bulbs
+        don't report the new state by themselves, they're asked for it.
+        """
+        deliveries = None
+        if (kwargs.get('reliable', self.reliable) and
+                packet_type in _ACKNOWLEDGEMENTS):
+            # Tracked first, so that a quick acknowledgement isn't missed.
+            deliveries = dict((mac, self.tracker.track(mac, packet_type,
+                                                       packet_fmt,
+                                                       *packet_args))
+                              for mac in self._targets(bulb))
+        super(Lifx, self).send(packet_type, bulb, packet_fmt, *packet_args)
+        if deliveries is not None and not _ACKNOWLEDGEMENTS[packet_type][1]:
+            super(Lifx, self).send(REQ_GET_LIGHT_STATE, bulb, '')
+        return deliveries
+
+    def _resend(self, delivery):
+        """
+        Retransmits a packet that hasn't been acknowledged, asking the bulb
+        for its state too if it won't report it by itself.
+        """
+        self.send(delivery.packet_type, delivery.mac, delivery.packet_fmt,
+                  *delivery.packet_args, reliable=False)
+        if not _ACKNOWLEDGEMENTS[delivery.packet_type][1]:
+            self.send(REQ_GET_LIGHT_STATE, delivery.mac, '', reliable=False)
+
+    def _collect(self, futures, timeout=None):
+        """
+        Waits for the responses in `futures` (as returned by `_expect`), up to
+        `timeout` seconds in all. Returns a dictionary mapping bulb mac
+        addresses to responses, for the bulbs that responded in time.
+        """
+        deadline = None if timeout is None else _monotonic() + timeout
+        responses = {}
+        for mac, future in futures.items():
+            remaining = (None if deadline is None
+                         else max(0, deadline - _monotonic()))
+            if future.wait(remaining):
+                responses[mac] = future.result()
+            else:
+                self.pending.cancel(future)
+        return responses
+
+    def _gather(self, futures, timeout=None):
+        """
+        Like `_collect`, but returns a `concurrent.futures.Future` (or, on
+        Python 2 without the `futures` backport, a ResponseFuture) rather than
+        blocking. It resolves to the dictionary of responses once every bulb
+        has responded, or fails with a ResponseTimeout if `timeout` seconds
+        pass first.
+        """
+        gathered = ResponseFuture() if Future is None else Future()
+        if Future is not None:
+            # Running, as far as `concurrent.futures` is concerned, so it
+            # can't be cancelled: the packets have already gone out.
+            gathered.set_running_or_notify_cancel()
+        lock = Lock()
+        responses = {}
+        finished = []
+
+        def finish(mac, future):
+            # Called as each response arrives (and with no response when
+            # the timeout passes); only the first call to finish counts.
+            with lock:
+                if finished:
+                    return
+                if future is not None:
+                    responses[mac] = future.result()
+                    if len(responses) < len(futures):
+                        return
+                finished.append(True)
+                missing = [other for other in futures
+                           if other not in responses]
+            for other in missing:
+                self.pending.cancel(futures[other])
+            if missing:
+                gathered.set_exception(ResponseTimeout(
+                    'no response from %s' % ', '.join(map(_bytes, missing))))
+            else:
+                gathered.set_result(responses)
+
+        for mac, future in futures.items():
+            future.add_done_callback(partial(finish, mac))
+        if not futures:
+            gathered.set_result({})
+        elif timeout is not None:
+            self._call_later(timeout, partial(finish, None, None))
+        return gathered
+
+    def _call_later(self, delay, fn):
+        """
+        Arranges for `fn` to be called in `delay` seconds, on the `timeouts`
+        thread.
+        """
+        self.timeouts.schedule(delay, fn)
+
+    def set_power_state_async(self, is_on, bulb=ALL_BULBS, timeout=None,
+                              refresh=REFRESH_TARGETED, group=None):
+        """
+        Like `set_power_state`, but returns a future (see `_gather`) for the
+        dictionary of power states instead of blocking.
+        """
+        return self._gather(self._set_power_state(is_on, bulb, refresh,
+                                                  group), timeout)
+
+    def set_light_state_raw_async(self, hue, saturation, brightness, kelvin,
+                                  bulb=ALL_BULBS, timeout=None,
+                                  refresh=REFRESH_TARGETED, duration=0,
+                                  group=None):
+        """
+        Like `set_light_state_raw`, but returns a future (see `_gather`) for
+        the dictionary of light states instead of blocking.
+        """
+        return self._gather(self._set_light_state(
+            hue, saturation, brightness, kelvin, bulb, refresh, duration,
+            group), timeout)
+
+    def set_light_state_async(self, hue, saturation, brightness, kelvin,
+                              bulb=ALL_BULBS, timeout=None,
+                              refresh=REFRESH_TARGETED, duration=0,
+                              group=None):
+        """
+        Like `set_light_state`, but returns a future (see `_gather`) for the
+        dictionary of light states instead of blocking.
+        """
+        raw_hue, raw_sat, raw_bright = _raw_color(hue, saturation, brightness)
+        return self.set_light_state_raw_async(raw_hue, raw_sat, raw_bright,
+                                              kelvin, bulb, timeout, refresh,
+                                              duration, group)
+
+    ### Callback helpers
+
+    def on_bulb_removed(self, fn):
+        """
+        Registers a function to be called with a Bulb when background
+        discovery gives up on a bulb that has stopped answering.
+        """
+        return self.callbacks.register(EVENT_BULB_REMOVED, fn, inline=False)
+
+    def on_metrics(self, fn):
+        """
+        Registers a function to be called with the dictionary returned by
+        `stats` every `metrics_interval` seconds while running.
+        """
+        return self.callbacks.register(EVENT_METRICS, fn, inline=False)
+
     ### Connection methods
 
     def connect(self, attempts=20, delay=0.5):
@@ -583,7 +3179,9 @@ class Lifx(object):
         are found.
 
         Step 1: send a gateway discovery packet to the broadcast address, wait
-        until we've received some info about the gateway.
+        until we've received some info about a gateway. (Every gateway that
+        answers is recorded, and packets are routed to the one each bulb is
+        reached through.)
 
         Step 2: connect to a discovered gateway, wait until the connection has
         been completed.
@@ -592,11 +3190,26 @@ class Lifx(object):
         bulbs we expect.
 
         Raises a ConnectException if any of the steps fail.
+
+        If there's a `cache` with enough bulbs saved in it, it's used instead:
+        the saved gateways are connected to and the saved bulbs recorded, and
+        this returns right away, while a background thread (`revalidation`)
+        checks that the bulbs answer, falling back to the steps above if they
+        don't. The cache is saved whenever the steps above succeed.
+        """
+        cached = self.cache.load() if self.cache is not None else None
+        if cached is not None and self._warm_start(*cached):
+            self.revalidation = _spawn(self._revalidate, attempts, delay)
+            return
+        self._discover(attempts, delay)
+        self._save_cache()
+
+    def _discover(self, attempts, delay):
+        """
+        The steps of `connect`, without the cache.
         """
         # Broadcast discovery packets until we find a gateway.
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        with closing(sock):
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        with closing(_broadcast_socket()) as sock:
             discover_packet = build_packet(REQ_GATEWAY,
                                            ALL_BULBS, ALL_BULBS, '',
                                            protocol=DISCOVERY_PROTOCOL)
@@ -614,6 +3227,11 @@ class Lifx(object):
             raise ConnectException('connection failed')
         self.callbacks.put(EVENT_CONNECTED)
 
+        # Without a number of bulbs to wait for, just ask for them once.
+        if not self.wait_for_bulbs:
+            self.send(REQ_GET_LIGHT_STATE, ALL_BULBS, '')
+            return
+
         # Send light state packets to the gateway until we find bulbs.
         for _, ok in _retry(self.bulbs_found_event, attempts, delay):
             self.send(REQ_GET_LIGHT_STATE, ALL_BULBS, '')
@@ -622,6 +3240,143 @@ class Lifx(object):
                                    len(self.bulbs), self.num_bulbs))
         self.callbacks.put(EVENT_BULBS_FOUND)
 
+    def discover_forever(self, interval=1.0, max_interval=60.0, misses=3):
+        """
+        Keeps looking for gateways and bulbs until `stop` is called, so that
+        `gateways` and `bulbs` stay current. Intended to run in its own thread
+        (`run` starts one, unless `discover` is false).
+
+        Each round broadcasts a discovery packet and asks every bulb for its
+        state, then waits: `interval` seconds after a round that found a
+        change, and twice as long as last time (up to `max_interval`) after
+        one that didn't. Bulbs that haven't answered for `misses` rounds in a
+        row are removed, and the `on_bulb_removed` callbacks called (new bulbs
+        trigger the `on_bulb_added` ones when they first answer).
+        """
+        discover_packet = build_packet(REQ_GATEWAY, ALL_BULBS, ALL_BULBS, '',
+                                       protocol=DISCOVERY_PROTOCOL)
+        wait = interval
+        missed = {}
+        with closing(_broadcast_socket()) as sock:
+            while not self._stopping.is_set():
+                started = _monotonic()
+                with self.lock:
+                    known = set(self.gateways), set(self.bulbs)
+                try:
+                    sock.sendto(discover_packet, BROADCAST_ADDRESS)
+                except socket.error as exc:
+                    self.logger.warning('discovery broadcast failed: %s', exc)
+                if self.gateway is not None:
+                    self.send(REQ_GET_LIGHT_STATE, ALL_BULBS, '')
+                if self._stopping.wait(wait):
+                    break
+
+                removed = []
+                with self.lock:
+                    for mac in list(self.bulbs):
+                        if self.seen.get(mac, started) > started:
+                            missed.pop(mac, None)
+                            continue
+                        missed[mac] = missed.get(mac, 0) + 1
+                        if missed[mac] >= misses:
+                            del missed[mac]
+                            removed.append(self._forget(mac))
+                    changed = known != (set(self.gateways), set(self.bulbs))
+
+                for bulb in removed:
+                    self.callbacks.put(EVENT_BULB_REMOVED, bulb)
+                if changed:
+                    self._save_cache()
+                wait = interval if changed else min(wait * 2, max_interval)
+
+    def _forget(self, mac):
+        """
+        Removes everything known about the bulb with mac address `mac`,
+        returning its Bulb. Must be called with `lock` held.
+        """
+        for state in (self.routes, self.seen, self.power_state,
+                      self.light_state):
+            state.pop(mac, None)
+        self.light_table.remove(mac)
+        self.groups.remove(mac)
+        return self.bulbs.pop(mac)
+
+    def _warm_start(self, gateways, bulbs):
+        """
+        Records gateways and bulbs loaded from the cache, and connects to the
+        gateways, returning True; or returns False if too few bulbs were saved
+        to be worth trying.
+        """
+        if not gateways or len(bulbs) < self.num_bulbs:
+            return False
+        with self.lock:
+            for gateway in gateways:
+                self.gateways[gateway.mac] = gateway
+            if self.gateway is None:
+                self.gateway = gateways[0]
+            for mac, (bulb, gateway) in bulbs.items():
+                self.bulbs.setdefault(mac, bulb)
+                self.routes.setdefault(mac, gateway)
+        self.gateway_found_event.set()
+        self.callbacks.put(EVENT_DISCOVERED)
+
+        for gateway in gateways:
+            self.sender.put(gateway)
+        if not self.sender.is_connected.wait(3):
+            return False
+        self.callbacks.put(EVENT_CONNECTED)
+        self.callbacks.put(EVENT_BULBS_FOUND)
+        return True
+
+    def _revalidate(self, attempts, delay):
+        """
+        Asks the bulbs loaded from the cache for their state, and runs full
+        discovery if any of them don't answer. Intended to run in its own
+        thread.
+        """
+        with self.lock:
+            macs = list(self.bulbs)
+        futures = self._expect_each(macs, RESP_LIGHT_STATE)
+        for _ in range(attempts):
+            self.send(REQ_GET_LIGHT_STATE, ALL_BULBS, '')
+            deadline = _monotonic() + delay
+            for mac, future in list(futures.items()):
+                if future.wait(max(0, deadline - _monotonic())):
+                    del futures[mac]
+            if not futures:
+                break
+        for future in futures.values():
+            self.pending.cancel(future)
+
+        try:
+            if futures:
+                self.logger.warning('cached bulbs missing: %s',
+                                    ', '.join(map(_bytes, futures)))
+                with self.lock:
+                    for mac in futures:
+                        self._forget(mac)
+                self._discover(attempts, delay)
+            self._save_cache()
+        except ConnectException as exc:
+            self.logger.error('revalidating cache failed: %s', exc)
+
+    def _save_cache(self):
+        """
+        Saves the gateways and bulbs found to the cache, if there is one. The
+        cache is only an optimization, so failing to write it is logged rather
+        than raised.
+        """
+        if self.cache is None:
+            return
+        with self.lock:
+            gateways = list(self.gateways.values())
+            bulbs = dict((mac, (bulb, self.routes.get(mac, self.gateway.mac)))
+                         for mac, bulb in self.bulbs.items())
+        try:
+            self.cache.save(gateways, bulbs)
+        except (IOError, OSError) as exc:
+            self.logger.warning('saving discovery cache failed: %s', exc)
+
     @contextmanager
     def run(self):
         """
@@ -633,21 +3388,33 @@ class Lifx(object):
         callback_thr = _spawn(self.callbacks.run)
         sender_thr = _spawn(self.sender.run)
         logger_thr = _spawn(self.logger.run)
+        tracker_thr = _spawn(self.tracker.run)
+        timeouts_thr = _spawn(self.timeouts.run)
 
         self.connect()
+        background = []
+        if self.discover:
+            background.append(_spawn(self.discover_forever))
+        if self.metrics_interval:
+            background.append(_spawn(self.report_metrics,
+                                     self.metrics_interval))
         try:
             yield
         finally:
             self.stop()
 
-            # Wait for the listener to finish.
+            # Wait for the listener (and discovery and metrics) to finish.
             listener_thr.join()
+            for thr in background:
+                thr.join()
             self.callbacks.put('shutdown')
 
             # Tell the other threads to finish, and wait for them.
-            for obj in [self.callbacks, self.sender, self.logger]:
+            for obj in [self.callbacks, self.sender, self.logger,
+                        self.tracker, self.timeouts]:
                 obj.stop()
-            for thr in [callback_thr, sender_thr, logger_thr]:
+            for thr in [callback_thr, sender_thr, logger_thr, tracker_thr,
+                        timeouts_thr]:
                 thr.join()
 
     def run_forever(self):
@@ -661,4 +3428,479 @@ class Lifx(object):
         """
         Gracefully terminates a connection.
         """
+        self._stopping.set()
         self.receiver.stop()
+
+
+class AsyncLifx(_LifxBase):
+    """
+    Manages connecting to, sending requests to, and receiving responses from
+    Lifx bulbs on an asyncio event loop, without any threads.
+
+    A single socket, bound to `addr` (by default, the Lifx port on every
+    interface), is used for both sending and receiving, and callbacks
+    (registered with `on_light_state`, `on_packet`, and so on, just as for
+    `Lifx`) are run on the loop. `connect`, `get_light_state`,
+    `set_power_state`, `set_light_state_raw`, `set_light_state` and
+    `apply_scene` return futures, so they can be awaited:
+
+        lifx = AsyncLifx(num_bulbs=2)
+        await lifx.connect()
+        await lifx.set_power_state(True)
+        lifx.close()
+
+    There's no logging thread, so to see log messages pass a `Logger` with a
+    `logging.Logger` as its target. Requires asyncio (Python 3.4 and up).
+    """
+
+    def __init__(self, num_bulbs=None, loop=None, logger=None,
+                 addr=('0.0.0.0', LIFX_PORT)):
+        if asyncio is None:
+            raise ImportError('AsyncLifx requires asyncio')
+        super(AsyncLifx, self).__init__(num_bulbs, logger)
+        self.loop = loop
+        self.addr = addr
+        self._waiters = []
+
+        self.callbacks = LoopCallbacks(self.logger, loop)
+        self._register_callbacks()
+        for packet_type in _PAYLOADS:
+            self.callbacks.register(packet_type, self._check_waiters)
+
+        self.receiver = None
+        self.sender = DatagramSender()
+
+    ### Waiting for responses
+
+    def _check_waiters(self, *args):
+        """
+        Resolves the futures of any waiters whose condition has been met by
+        the response that just arrived.
+        """
+        waiting = []
+        for predicate, result, future in self._waiters:
+            if future.done():
+                continue
+            if predicate():
+                future.set_result(result())
+            else:
+                waiting.append((predicate, result, future))
+        self._waiters = waiting
+
+    def _when(self, predicate, result, timeout=None):
+        """
+        Returns a future that resolves to `result()` once `predicate()` is true
+        (checked each time a response arrives), or once `timeout` seconds have
+        passed.
+        """
+        future = self.loop.create_future()
+        if predicate():
+            future.set_result(result())
+            return future
+
+        self._waiters.append((predicate, result, future))
+        if timeout is not None:
+            def expire():
+                if not future.done():
+                    future.set_result(result())
+            handle = self.loop.call_later(timeout, expire)
+            future.add_done_callback(lambda _: handle.cancel())
+        return future
+
+    def _retry_async(self, event, attempts, delay, action):
+        """
+        The event loop counterpart of `_retry`: calls `action()` up to
+        `attempts` times, `delay` seconds apart, until `event` is set. Returns
+        a future that resolves to whether the event was set.
+        """
+        event.clear()
+        found = self._when(event.is_set, lambda: True)
+
+        def attempt(attempted):
+            if found.done():
+                return
+            if attempted >= attempts:
+                found.set_result(False)
+                return
+            action()
+            self.loop.call_later(delay, attempt, attempted + 1)
+
+        attempt(0)
+        return found
+
+    ### Sender methods
+
+    def _collect(self, futures, timeout=None):
+        """
+        Returns a future for the dictionary of responses (see
+        `_LifxBase._collect`), rather than blocking.
+        """
+        collected = self.loop.create_future()
+        remaining = [len(futures)]
+
+        def finish():
+            if collected.done():
+                return
+            responses = {}
+            for mac, future in futures.items():
+                if future.done():
+                    responses[mac] = future.result()
+                else:
+                    self.pending.cancel(future)
+            collected.set_result(responses)
+
+        def arrived(future):
+            remaining[0] -= 1
+            if not remaining[0]:
+                finish()
+
+        for future in futures.values():
+            future.add_done_callback(arrived)
+        if not futures:
+            finish()
+        elif timeout is not None:
+            handle = self.loop.call_later(timeout, finish)
+            collected.add_done_callback(lambda _: handle.cancel())
+        return collected
+
+    def _call_later(self, delay, fn):
+        """
+        Arranges for `fn` to be called in `delay` seconds, on the event loop.
+        """
+        self.loop.call_later(delay, fn)
+
+    def set_power_state(self, is_on, bulb=ALL_BULBS, timeout=None,
+                        refresh=REFRESH_TARGETED, group=None):
+        """
+        Sets the power state of one or more bulbs. Returns a future.
+        """
+        return super(AsyncLifx, self).set_power_state(is_on, bulb, timeout,
+                                                      refresh, group)
+
+    def set_light_state_raw(self, hue, saturation, brightness, kelvin,
+                            bulb=ALL_BULBS, timeout=None,
+                            refresh=REFRESH_TARGETED, duration=0,
+                            group=None):
+        """
+        Sets the (low-level) light state of one or more bulbs. Returns a
+        future.
+        """
+        return super(AsyncLifx, self).set_light_state_raw(
+            hue, saturation, brightness, kelvin, bulb, timeout, refresh,
+            duration, group)
+
+    def apply_scene(self, scene, timeout=None, refresh=REFRESH_TARGETED):
+        """
+        Sets the light state of many bulbs at once, as for
+        `Lifx.apply_scene`. Returns a future.
+        """
+        acked = self.loop.create_future()
+        collected = self._collect(self._send_scene(scene, refresh), timeout)
+        collected.add_done_callback(lambda _: acked.set_result(
+            dict((mac, collected.result().get(mac) is not None)
+                 for mac in scene)))
+        return acked
+
+    ### Connection methods
+
+    def connect(self, attempts=20, delay=0.5):
+        """
+        Connects to a gateway, returning a future that resolves once a
+        connection is made and bulbs are found. The steps are as for
+        `Lifx.connect`, and the future fails with a ConnectException if any
+        of them fail.
+        """
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        self.callbacks.loop = self.loop
+        return _drive(self.loop, self._connect(attempts, delay))
+
+    def _connect(self, attempts, delay):
+        """
+        The steps of `connect`, as a generator for `_drive`.
+        """
+        self.receiver = DatagramHandler(self.callbacks)
+        transport, _ = yield self.loop.create_task(
+            self.loop.create_datagram_endpoint(
+                lambda: self.receiver,
+                local_addr=self.addr, allow_broadcast=True))
+        self.sender.transport = transport
+
+        # Broadcast discovery packets until we find a gateway.
+        discover_packet = build_packet(REQ_GATEWAY,
+                                       ALL_BULBS, ALL_BULBS, '',
+                                       protocol=DISCOVERY_PROTOCOL)
+        ok = yield self._retry_async(
+            self.gateway_found_event, attempts, delay,
+            lambda: transport.sendto(discover_packet, BROADCAST_ADDRESS))
+        if not ok:
+            raise ConnectException('discovery failed')
+        self.callbacks.put(EVENT_DISCOVERED)
+
+        # The transport is already open, so connecting is immediate.
+        self.sender.put(self.gateway)
+        self.callbacks.put(EVENT_CONNECTED)
+
+        # Without a number of bulbs to wait for, just ask for them once.
+        if not self.wait_for_bulbs:
+            self.send(REQ_GET_LIGHT_STATE, ALL_BULBS, '')
+            return
+
+        # Send light state packets to the gateway until we find bulbs.
+        ok = yield self._retry_async(
+            self.bulbs_found_event, attempts, delay,
+            lambda: self.send(REQ_GET_LIGHT_STATE, ALL_BULBS, ''))
+        if not ok:
+            raise ConnectException('only found %d of %d bulbs' % (
+                                   len(self.bulbs), self.num_bulbs))
+        self.callbacks.put(EVENT_BULBS_FOUND)
+
+    def stop(self):
+        """
+        Closes the connection.
+        """
+        self.sender.stop()
+
+    close = stop
+
+
+class Animation(object):
+    """
+    A keyframe animation for one or more bulbs. `keyframes` is a list of
+    pairs of (seconds, colour), in order of time, meaning that the bulbs
+    reach `colour` (a tuple of hue, saturation, brightness and kelvin, as
+    for `Lifx.set_light_state`) that many seconds after the animation
+    starts. The bulbs make each transition themselves, using the duration
+    field of the light state packet, so one packet per bulb is sent per
+    keyframe. The animation plays `repeat` times, or forever if that's None.
+    """
+    def __init__(self, keyframes, repeat=1):
+        self.keyframes = list(keyframes)
+        self.repeat = repeat
+        if not self.keyframes or (repeat is None and self.length <= 0):
+            raise ValueError('an animation needs keyframes that take time')
+
+    @property
+    def length(self):
+        """
+        The number of seconds one play of the animation takes.
+        """
+        return self.keyframes[-1][0]
+
+    def colours(self, colour, count):
+        """
+        Returns the colour for a keyframe for `count` bulbs: either a single
+        colour for all of them, or a list with one per bulb. Subclasses can
+        override this to vary colours between bulbs.
+        """
+        return colour
+
+    def steps(self, count):
+        """
+        Returns an iterator of tuples of (seconds from the start, colours as
+        for `colours`, transition time in seconds) for the packets to send to
+        `count` bulbs.
+        """
+        played = 0
+        while self.repeat is None or played < self.repeat:
+            start = played * self.length
+            previous = 0.0
+            for at, colour in self.keyframes:
+                yield (start + previous, self.colours(colour, count),
+                       at - previous)
+                previous = at
+            played += 1
+
+
+class Fade(Animation):
+    """
+    Fades bulbs to `colour` over `duration` seconds.
+    """
+    def __init__(self, colour, duration):
+        super(Fade, self).__init__([(duration, colour)])
+
+
+class Pulse(Animation):
+    """
+    Fades bulbs back and forth between `colour` and `other`, taking `period`
+    seconds for each round trip, `cycles` times (or forever, if None).
+    """
+    def __init__(self, colour, other, period, cycles=None):
+        super(Pulse, self).__init__(
+            [(period / 2.0, colour), (period, other)], cycles)
+
+
+class ColorCycle(Animation):
+    """
+    Takes bulbs around the colour wheel at the given saturation, brightness
+    and kelvin, once every `period` seconds, in `steps` transitions, `cycles`
+    times (or forever, if None). Each bulb's hue is `spread` degrees further
+    round than the previous bulb's, so a spread of 360 / number of bulbs
+    puts a whole rainbow across them.
+    """
+    def __init__(self, saturation, brightness, kelvin, period, steps=12,
+                 spread=0.0, cycles=None):
+        self.spread = spread
+        super(ColorCycle, self).__init__(
+            [(period * (step + 1) / float(steps),
+              ((360.0 * (step + 1) / steps) % 360, saturation, brightness,
+               kelvin))
+             for step in range(steps)], cycles)
+
+    def colours(self, colour, count):
+        if not self.spread:
+            return colour
+        hue, saturation, brightness, kelvin = colour
+        return [((hue + self.spread * index) % 360, saturation, brightness,
+                 kelvin) for index in range(count)]
+
+
+class _Playing(object):
+    """
+    An animation being played on some bulbs by an `EffectsEngine`.
+    """
+    __slots__ = ('macs', 'overridden', 'started', 'steps', 'next', 'until',
+                 'future')
+
+    def __init__(self, animation, macs, started):
+        self.macs = macs
+        # Bulbs that an animation started later has taken over.
+        self.overridden = set()
+        self.started = started
+        self.steps = animation.steps(len(macs))
+        self.next = next(self.steps, None)
+        # When the last transition sent ends, relative to `started`.
+        self.until = 0.0
+        self.future = ResponseFuture(animation)
+
+
+class EffectsEngine(object):
+    """
+    Plays animations (see `Animation`) on the bulbs of a `Lifx` object. A
+    single thread (`run`) ticks `rate` times a second by the monotonic clock;
+    each tick gathers the packets due for every animation playing into one
+    scene, sent in one burst as for `Lifx.apply_scene`. Ticks that are
+    missed (because the thread was held up) are skipped, not bunched up.
+
+    Only the keyframes of an animation need packets, since the bulbs make the
+    transitions between them, so the work per animation is one packet per
+    bulb per keyframe, however high the rate. If several keyframes of an
+    animation fall due in one tick, only the latest is sent, with its
+    transition shortened by however late it is.
+    """
+    def __init__(self, lifx, rate=20.0, clock=_monotonic):
+        self.lifx = lifx
+        self.period = 1.0 / rate
+        self._clock = clock
+        self._lock = Lock()
+        self._playing = []
+        self._wakeup = Event()
+        self._shutdown = Event()
+
+    def play(self, animation, bulb=ALL_BULBS):
+        """
+        Starts playing `animation` on `bulb` (a mac address, a list of them,
+        or `ALL_BULBS` for every known bulb). Where animations playing at once
+        share bulbs, the one started last wins: the others stop sending to
+        those bulbs (and stop altogether if they have none left). Returns a
+        ResponseFuture that is resolved with True when the animation finishes
+        (once its last transition is over), or False if it's stopped first.
+        """
+        if isinstance(bulb, (list, tuple)):
+            macs = list(bulb)
+        else:
+            macs = self.lifx._targets(bulb)
+        playing = _Playing(animation, macs, self._clock())
+        taken = set(macs)
+        stopped = []
+        with self._lock:
+            for other in self._playing:
+                other.overridden.update(taken.intersection(other.macs))
+                if other.overridden.issuperset(other.macs):
+                    stopped.append(other)
+            for other in stopped:
+                self._playing.remove(other)
+            self._playing.append(playing)
+        self._wakeup.set()
+        for other in stopped:
+            other.future.set_result(False)
+        return playing.future
+
+    def cancel(self, future):
+        """
+        Stops playing the animation that `play` returned `future` for. The
+        bulbs are left as they are.
+        """
+        with self._lock:
+            for playing in self._playing:
+                if playing.future is future:
+                    self._playing.remove(playing)
+                    break
+            else:
+                return
+        future.set_result(False)
+
+    def tick(self, now=None):
+        """
+        Sends the packets due at time `now` (by default, the current time),
+        returning the scene sent, as for `Lifx.apply_scene`.
+        """
+        now = self._clock() if now is None else now
+        scene = {}
+        finished = []
+        with self._lock:
+            for playing in self._playing:
+                elapsed = now - playing.started
+                due = None
+                while playing.next is not None and playing.next[0] <= elapsed:
+                    due = playing.next
+                    playing.next = next(playing.steps, None)
+                if due is not None:
+                    at, colours, duration = due
+                    playing.until = at + duration
+                    millis = int(max(0.0, duration - (elapsed - at)) * 1000)
+                    if not isinstance(colours, list):
+                        colours = [colours] * len(playing.macs)
+                    for mac, colour in zip(playing.macs, colours):
+                        if mac not in playing.overridden:
+                            scene[mac] = tuple(colour) + (millis,)
+                if playing.next is None and elapsed >= playing.until:
+                    finished.append(playing)
+            for playing in finished:
+                self._playing.remove(playing)
+
+        if scene:
+            self.lifx._send_scene(scene, REFRESH_NONE)
+        for playing in finished:
+            playing.future.set_result(True)
+        return scene
+
+    def stop(self):
+        """
+        Stops the engine (leaving any animations unfinished).
+        """
+        self._shutdown.set()
+        self._wakeup.set()
+
+    def run(self):
+        """
+        Ticks until `stop()` is called. Intended to run in its own thread.
+        """
+        due = self._clock()
+        while not self._shutdown.is_set():
+            with self._lock:
+                idle = not self._playing
+            if idle:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                due = self._clock()
+                continue
+            now = self._clock()
+            if now < due:
+                self._wakeup.wait(due - now)
+                self._wakeup.clear()
+                continue
+            self.tick(now)
+            due += self.period
+            if due < now:
+                due = now + self.period
@@ -0,0 +1,483 @@
+"""
+A daemon that owns a host's connection to its Lifx bulbs (the socket bound
+to the Lifx port, discovery, and the recorded bulb state), so that many
+local processes can drive the bulbs through it, and a client for talking to
+it.
+
+Clients connect over a Unix domain socket, and both sides send Lifx packets
+over it, built and parsed with the same codecs: each packet's header starts
+with its size, so a stream of them needs no other framing. Clients send
+set/get-state requests, which the daemon routes to the right gateways (the
+gateway field of a client's packet is ignored), along with a few packet
+types of the daemon's own:
+
+- `DAEMON_SUBSCRIBE` asks for the light and power states reported by bulbs
+  to be streamed to the client as they arrive, along with a
+  `DAEMON_BULB_REMOVED` packet for each bulb that stops responding
+- `DAEMON_SNAPSHOT` asks for the recorded light state of every bulb, which
+  the daemon sends as light state packets, all together, followed by a
+  `DAEMON_SNAPSHOT_END` packet with the number of bulbs
+
+Run a daemon with:
+
+    python lazylights_daemon.py /tmp/lazylights.sock
+"""
+import argparse
+from collections import deque
+from contextlib import closing
+import errno
+import os
+import select
+import socket
+import struct
+from threading import Event, Lock
+
+import lazylights
+from lazylights import (ALL_BULBS, EVENT_BULB_REMOVED, REQ_GET_LIGHT_STATE,
+                        REQ_SET_LIGHT_STATE, REQ_SET_POWER_STATE,
+                        RESP_LIGHT_STATE, RESP_POWER_STATE, ConnectException,
+                        build_packet, get_codec, register_codec)
+
+
+DAEMON_SUBSCRIBE = 0x7001
+DAEMON_SNAPSHOT = 0x7002
+DAEMON_SNAPSHOT_END = 0x7003
+DAEMON_BULB_REMOVED = 0x7004
+
+for _type in (DAEMON_SUBSCRIBE, DAEMON_SNAPSHOT, DAEMON_BULB_REMOVED):
+    register_codec(_type, '')
+del _type
+register_codec(DAEMON_SNAPSHOT_END, 'I', 'bulbs')
+
+# The packets from clients that the daemon sends on to the bulbs.
+_FORWARDED = frozenset([REQ_GET_LIGHT_STATE, REQ_SET_LIGHT_STATE,
+                        REQ_SET_POWER_STATE])
+
+# The size field at the start of every packet.
+_SIZE = struct.Struct('<H')
+
+# Clients leave the gateway field of their packets empty.
+_NO_GATEWAY = b'\x00' * 6
+
+
+def _split_packets(buf):
+    """
+    Removes the complete packets from the front of `buf` (a bytearray of data
+    received from a stream), returning them as a list of bytestrings. Raises
+    a ValueError if a packet's size is too small to be right.
+    """
+    packets = []
+    offset = 0
+    while len(buf) - offset >= _SIZE.size:
+        size = _SIZE.unpack_from(buf, offset)[0]
+        if size < lazylights._FORMAT_SIZE:
+            raise ValueError('bad packet size %d' % size)
+        if len(buf) - offset < size:
+            break
+        packets.append(bytes(buf[offset:offset + size]))
+        offset += size
+    del buf[:offset]
+    return packets
+
+
+def _decode(packet):
+    """
+    Returns a pair of (Header object, payload) for a packet: the payload is a
+    record if the packet type has a codec, or the raw payload data if not.
+    """
+    codec = get_codec(lazylights._packet_type(packet))
+    if codec is None or len(packet) < codec.size:
+        return lazylights.parse_packet(packet)
+    return codec.unpack_from(packet)
+
+
+class _Client(object):
+    """
+    A connection from a client to the `Daemon`.
+    """
+    __slots__ = ('sock', 'inbox', 'outbox', 'subscribed')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.subscribed = False
+
+
+class Daemon(object):
+    """
+    Serves the bulbs known to `lifx` (a `Lifx`, or a new one that discovers
+    bulbs in the background) to clients connecting to the Unix domain socket
+    at `path`.
+
+    Packets for a client are buffered until its socket can take them; a
+    client that falls more than `max_backlog` bytes behind (a subscriber
+    that stopped reading, say) is disconnected, rather than holding up the
+    others. The `is_serving` event is set once clients can connect.
+    """
+    def __init__(self, path, lifx=None, max_backlog=1 << 20):
+        self.path = path
+        self.lifx = lazylights.Lifx() if lifx is None else lifx
+        self.max_backlog = max_backlog
+        self.clients = {}
+        self.is_serving = Event()
+        self._lock = Lock()
+        self._shutdown = Event()
+        self._wakeup = None
+        self._wakeup_lock = Lock()
+
+        for packet_type in (RESP_LIGHT_STATE, RESP_POWER_STATE):
+            self.lifx.callbacks.register(packet_type, self._on_state)
+        self.lifx.callbacks.register(EVENT_BULB_REMOVED,
+                                     self._on_bulb_removed)
+
+    ### Callbacks, run by `lifx`
+
+    def _on_state(self, header, payload, rest, addr):
+        """
+        Streams a state reported by a bulb to the subscribers.
+        """
+        codec = get_codec(header.packet_type)
+        self._publish(codec.pack(header.gateway, header.mac, *payload))
+
+    def _on_bulb_removed(self, bulb):
+        """
+        Tells the subscribers about a bulb that's stopped responding.
+        """
+        codec = get_codec(DAEMON_BULB_REMOVED)
+        self._publish(codec.pack(_NO_GATEWAY, bulb.mac))
+
+    def _publish(self, packet):
+        with self._lock:
+            for client in self.clients.values():
+                if client.subscribed:
+                    client.outbox += packet
+        self._wake()
+
+    ### Requests from clients
+
+    def _handle(self, client, packet):
+        """
+        Handles a packet received from `client`.
+        """
+        packet_type = lazylights._packet_type(packet)
+        if packet_type == DAEMON_SUBSCRIBE:
+            client.subscribed = True
+        elif packet_type == DAEMON_SNAPSHOT:
+            snapshot = self._snapshot()
+            with self._lock:
+                client.outbox += snapshot
+        elif packet_type in _FORWARDED:
+            codec = get_codec(packet_type)
+            if len(packet) >= codec.size:
+                header, payload = codec.unpack_from(packet)
+                self.lifx.send(packet_type, header.mac, codec.payload_fmt,
+                               *payload)
+
+    def _snapshot(self):
+        """
+        Returns the packets answering a snapshot request, concatenated.
+        """
+        lifx = self.lifx
+        with lifx.lock:
+            states = list(lifx.light_state.items())
+            routes = dict(lifx.routes)
+        codec = get_codec(RESP_LIGHT_STATE)
+        end = get_codec(DAEMON_SNAPSHOT_END)
+        buf = bytearray(len(states) * codec.size + end.size)
+        offset = 0
+        for mac, state in states:
+            offset = codec.pack_into(buf, offset,
+                                     routes.get(mac, _NO_GATEWAY), mac,
+                                     *state)
+        end.pack_into(buf, offset, _NO_GATEWAY, ALL_BULBS, len(states))
+        return buf
+
+    ### Connections
+
+    def _accept(self, listener):
+        try:
+            sock, _ = listener.accept()
+        except socket.error as exc:
+            if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        sock.setblocking(False)
+        with self._lock:
+            self.clients[sock.fileno()] = _Client(sock)
+
+    def _close(self, client):
+        with self._lock:
+            self.clients.pop(client.sock.fileno(), None)
+        client.sock.close()
+
+    def _read(self, client):
+        """
+        Receives and handles what `client` has sent, closing the connection
+        if the client has, or if it sends something malformed.
+        """
+        try:
+            data = client.sock.recv(65536)
+        except socket.error as exc:
+            if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = b''
+        client.inbox += data
+        try:
+            packets = _split_packets(client.inbox)
+        except ValueError as exc:
+            self.lifx.logger.warning('dropping daemon client: %s', exc)
+            data = b''
+            packets = []
+        for packet in packets:
+            self._handle(client, packet)
+        if not data:
+            self._close(client)
+
+    def _write(self, client):
+        """
+        Sends as much of `client`'s buffered packets as its socket will take.
+        """
+        with self._lock:
+            try:
+                sent = client.sock.send(client.outbox)
+            except socket.error as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.EINTR):
+                    return
+                sent = None
+            if sent is not None:
+                del client.outbox[:sent]
+        if sent is None:
+            self._close(client)
+
+    def _listen(self):
+        """
+        Returns a socket listening at `path`, replacing a socket file left
+        behind by a daemon that's no longer running.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(self.path):
+            with closing(socket.socket(socket.AF_UNIX,
+                                       socket.SOCK_STREAM)) as probe:
+                try:
+                    probe.connect(self.path)
+                except socket.error:
+                    os.unlink(self.path)
+                else:
+                    sock.close()
+                    raise ConnectException('a daemon is already running at '
+                                           '%s' % self.path)
+        sock.bind(self.path)
+        sock.listen(socket.SOMAXCONN)
+        sock.setblocking(False)
+        return sock
+
+    def _wake(self):
+        with self._wakeup_lock:
+            if self._wakeup is not None:
+                try:
+                    os.write(self._wakeup, b'x')
+                except OSError:
+                    pass
+
+    def stop(self):
+        """
+        Stop serving clients.
+        """
+        self._shutdown.set()
+        self._wake()
+
+    def serve(self):
+        """
+        Serves clients until `stop()` is called, without starting `lifx`
+        (see `run`).
+        """
+        listener = self._listen()
+        wakeup, self._wakeup = os.pipe()
+        self.is_serving.set()
+        try:
+            while not self._shutdown.is_set():
+                with self._lock:
+                    for client in list(self.clients.values()):
+                        if len(client.outbox) > self.max_backlog:
+                            self.lifx.logger.warning(
+                                'dropping daemon client %d bytes behind',
+                                len(client.outbox))
+                            del self.clients[client.sock.fileno()]
+                            client.sock.close()
+                    clients = dict(self.clients)
+                    writers = [fd for fd, client in clients.items()
+                               if client.outbox]
+                readable, writable, _ = select.select(
+                    [listener, wakeup] + list(clients), writers, [])
+                for fd in readable:
+                    if fd == wakeup:
+                        os.read(wakeup, 4096)
+                    elif fd is listener:
+                        self._accept(listener)
+                    else:
+                        self._read(clients[fd])
+                for fd in writable:
+                    if clients[fd].sock.fileno() == fd:
+                        self._write(clients[fd])
+        finally:
+            self.is_serving.clear()
+            with self._lock:
+                clients, self.clients = list(self.clients.values()), {}
+            for client in clients:
+                client.sock.close()
+            listener.close()
+            os.unlink(self.path)
+            os.close(wakeup)
+            with self._wakeup_lock:
+                write_end, self._wakeup = self._wakeup, None
+            os.close(write_end)
+
+    def run(self):
+        """
+        Connects to the bulbs (as `lifx.run()` does), and serves clients
+        until `stop()` is called.
+        """
+        with self.lifx.run():
+            self.serve()
+
+
+class DaemonClient(object):
+    """
+    A connection to a `Daemon` listening at `path`. Requests are sent without
+    waiting for the bulbs to respond; states reported by bulbs can be read
+    with `receive`, after calling `subscribe`.
+
+    `timeout` limits how long (in seconds) reading from the daemon blocks
+    for; `receive` takes its own.
+    """
+    def __init__(self, path, timeout=None):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._timeout = timeout
+        self._inbox = bytearray()
+        self._received = deque()
+
+    def close(self):
+        """
+        Closes the connection to the daemon.
+        """
+        self._sock.close()
+
+    def send(self, packet_type, bulb, packet_fmt, *packet_args):
+        """
+        Builds and sends a packet for the daemon to send to one or more
+        bulbs. Arguments are as for `Lifx.send`.
+        """
+        self._sock.sendall(build_packet(packet_type, _NO_GATEWAY, bulb,
+                                        packet_fmt, *packet_args))
+
+    def set_power_state(self, is_on, bulb=ALL_BULBS):
+        """
+        Asks for the power state of one or more bulbs to be set.
+        """
+        level = b'\x00\x01' if is_on else b'\x00\x00'
+        self.send(REQ_SET_POWER_STATE, bulb, '2s', level)
+
+    def set_light_state_raw(self, hue, saturation, brightness, kelvin,
+                            bulb=ALL_BULBS, duration=0):
+        """
+        Asks for the (low-level) light state of one or more bulbs to be set,
+        as for `Lifx.set_light_state_raw`.
+        """
+        self.send(REQ_SET_LIGHT_STATE, bulb, 'xHHHHI',
+                  hue, saturation, brightness, kelvin, duration)
+
+    def set_light_state(self, hue, saturation, brightness, kelvin,
+                        bulb=ALL_BULBS, duration=0):
+        """
+        Asks for the light state of one or more bulbs to be set, as for
+        `Lifx.set_light_state`.
+        """
+        raw_hue, raw_sat, raw_bright = lazylights._raw_color(
+            hue, saturation, brightness)
+        self.set_light_state_raw(raw_hue, raw_sat, raw_bright, kelvin, bulb,
+                                 duration)
+
+    def get_light_state(self, bulb=ALL_BULBS):
+        """
+        Asks one or more bulbs for their light state, which subscribers
+        receive.
+        """
+        self.send(REQ_GET_LIGHT_STATE, bulb, '')
+
+    def subscribe(self):
+        """
+        Asks for the states reported by bulbs to be sent to this client.
+        """
+        self.send(DAEMON_SUBSCRIBE, ALL_BULBS, '')
+
+    def snapshot(self):
+        """
+        Returns a dictionary mapping the mac addresses of the bulbs known to
+        the daemon to their recorded light state. Packets streamed to a
+        subscriber meanwhile are kept for `receive`.
+        """
+        self.send(DAEMON_SNAPSHOT, ALL_BULBS, '')
+        received = []
+        while True:
+            header, payload = self._next(self._timeout)
+            if header.packet_type == DAEMON_SNAPSHOT_END:
+                break
+            received.append((header, payload))
+
+        # The snapshot's packets come just before its end; any before them
+        # were streamed.
+        split = len(received) - payload.bulbs
+        self._received.extendleft(reversed(received[:split]))
+        return dict((header.mac, payload)
+                    for header, payload in received[split:])
+
+    def receive(self, timeout=None):
+        """
+        Returns the next packet streamed from the daemon as a pair of (Header
+        object, payload record), waiting up to `timeout` seconds for one to
+        arrive; or returns None if none does.
+        """
+        try:
+            return self._next(timeout)
+        except socket.timeout:
+            return None
+
+    def _next(self, timeout):
+        """
+        Returns the next packet from the daemon, decoded.
+        """
+        if self._received:
+            return self._received.popleft()
+        self._sock.settimeout(timeout)
+        while True:
+            packets = _split_packets(self._inbox)
+            if packets:
+                self._received.extend(_decode(packet)
+                                      for packet in packets[1:])
+                return _decode(packets[0])
+            data = self._sock.recv(65536)
+            if not data:
+                raise ConnectException('the daemon closed the connection')
+            self._inbox += data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', help='path of the Unix domain socket to '
+                        'listen at')
+    parser.add_argument('--bulbs', type=int, help='number of bulbs to wait '
+                        'for before serving clients')
+    args = parser.parse_args(argv)
+
+    daemon = Daemon(args.path, lazylights.Lifx(args.bulbs))
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
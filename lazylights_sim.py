@@ -0,0 +1,272 @@
+"""
+A simulated Lifx gateway and bulbs on a local UDP socket, for exercising
+lazylights without hardware, and tools for recording and replaying packet
+captures.
+
+A capture is a text file with one packet per line: the number of seconds
+since the capture started, the direction (`>>` for packets sent to bulbs,
+`<<` for packets sent by them, as in `lazylights.Logger` output) and the
+packet's bytes as written by `lazylights._bytes`.
+"""
+from contextlib import closing
+import heapq
+import random
+import select
+import socket
+import struct
+from threading import Event, Lock
+
+import lazylights
+from lazylights import (ALL_BULBS, LIFX_PORT, SERVICE_UDP, REQ_GATEWAY,
+                        REQ_GET_LIGHT_STATE, REQ_SET_LIGHT_STATE,
+                        REQ_SET_POWER_STATE, RESP_GATEWAY, RESP_LIGHT_STATE,
+                        RESP_POWER_STATE, get_codec)
+
+
+SENT = '>>'
+RECEIVED = '<<'
+
+
+def _mac(prefix, number):
+    """
+    Returns a 6-byte mac address made of a 2-byte `prefix` and `number`.
+    """
+    return prefix + struct.pack('>I', number)
+
+
+class SimulatedBulb(object):
+    """
+    The state of one simulated bulb.
+    """
+    __slots__ = ('mac', 'label', 'hue', 'sat', 'bright', 'kelvin', 'dim',
+                 'power', 'tags')
+
+    def __init__(self, mac, label):
+        self.mac = mac
+        self.label = label
+        self.hue = self.sat = self.bright = self.dim = self.power = 0
+        self.kelvin = 3500
+        self.tags = b''
+
+    def light_state(self):
+        """
+        Returns the payload arguments for a light state packet.
+        """
+        return (self.hue, self.sat, self.bright, self.kelvin, self.dim,
+                self.power, self.label, self.tags)
+
+
+class Simulator(object):
+    """
+    A fake gateway for `num_bulbs` bulbs, listening on `addr` (by default an
+    unused port on localhost; the `addr` attribute has the actual address).
+    It answers discovery, light state and power state requests the way a
+    real gateway does, sending responses to `reply_port` on the requesting
+    host (real gateways answer on the Lifx port, where the `PacketReceiver`
+    listens).
+
+    Each packet received, and each response, is dropped with probability
+    `loss`, and responses are delayed by `latency` seconds (plus up to
+    `jitter` more). `seed` seeds the random numbers used for both.
+
+    If `capture` is given (a file-like object), every packet received and
+    sent is written to it, as for `write_capture`.
+    """
+    def __init__(self, num_bulbs=1, addr=('127.0.0.1', 0),
+                 reply_port=LIFX_PORT, loss=0.0, latency=0.0, jitter=0.0,
+                 seed=None, gateway_mac=b'\x9e\x00\x00\x00\x00\x00',
+                 capture=None):
+        self.gateway_mac = gateway_mac
+        self.bulbs = {}
+        for num in range(num_bulbs):
+            mac = _mac(b'\xb0\x00', num)
+            label = ('Bulb %d' % num).encode('ascii')
+            self.bulbs[mac] = SimulatedBulb(mac, label)
+        self.reply_port = reply_port
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._delayed = []
+        self._sequence = 0
+        self._lock = Lock()
+        self._shutdown = Event()
+        self._capture = capture
+        self._started = lazylights._monotonic()
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(addr)
+        self._sock.setblocking(False)
+        self.addr = self._sock.getsockname()
+
+    @property
+    def gateway(self):
+        """
+        A Gateway for connecting to the simulator directly.
+        """
+        return lazylights.Gateway(self.addr[0], self.addr[1],
+                                  self.gateway_mac)
+
+    def _record(self, direction, packet):
+        if self._capture is not None:
+            with self._lock:
+                write_capture(self._capture, [(
+                    lazylights._monotonic() - self._started, direction,
+                    packet)])
+
+    def _lost(self):
+        if self.loss and self._random.random() < self.loss:
+            self.dropped += 1
+            return True
+        return False
+
+    def _respond(self, packets, host):
+        """
+        Sends (or schedules, with latency) response packets to `host`.
+        """
+        dest = (host, self.reply_port)
+        for packet in packets:
+            if self._lost():
+                continue
+            delay = self.latency + self._random.random() * self.jitter
+            if not delay:
+                self._send(packet, dest)
+                continue
+            self._sequence += 1
+            heapq.heappush(self._delayed, (lazylights._monotonic() + delay,
+                                           self._sequence, packet, dest))
+
+    def _send(self, packet, dest):
+        self._record(RECEIVED, packet)
+        try:
+            self._sock.sendto(packet, dest)
+        except socket.error:
+            self.dropped += 1
+            return
+        self.sent += 1
+
+    def _targets(self, mac):
+        if mac == ALL_BULBS:
+            return list(self.bulbs.values())
+        bulb = self.bulbs.get(mac)
+        return [] if bulb is None else [bulb]
+
+    def handle(self, packet):
+        """
+        Returns a list of the response packets for a request `packet`,
+        updating the simulated bulbs' state.
+        """
+        header, payload = lazylights.parse_packet(packet)
+        packet_type = header.packet_type
+        if packet_type == REQ_GATEWAY:
+            codec = get_codec(RESP_GATEWAY)
+            return [codec.pack(self.gateway_mac, ALL_BULBS, SERVICE_UDP,
+                               self.addr[1])]
+
+        bulbs = self._targets(header.mac)
+        if packet_type == REQ_SET_LIGHT_STATE:
+            codec = get_codec(REQ_SET_LIGHT_STATE)
+            _, state = codec.unpack_from(packet)
+            for bulb in bulbs:
+                bulb.hue, bulb.sat, bulb.bright = state[:3]
+                bulb.kelvin = state.kelvin
+            return []
+        if packet_type == REQ_SET_POWER_STATE:
+            power = 0xffff if payload[:2].tobytes() != b'\x00\x00' else 0
+            codec = get_codec(RESP_POWER_STATE)
+            for bulb in bulbs:
+                bulb.power = power
+            return [codec.pack(self.gateway_mac, bulb.mac, power)
+                    for bulb in bulbs]
+        if packet_type == REQ_GET_LIGHT_STATE:
+            codec = get_codec(RESP_LIGHT_STATE)
+            return [codec.pack(self.gateway_mac, bulb.mac,
+                               *bulb.light_state())
+                    for bulb in bulbs]
+        return []
+
+    def stop(self):
+        """
+        Stop answering requests.
+        """
+        self._shutdown.set()
+
+    def run(self):
+        """
+        Answer requests until `stop()` is called. Intended to run in its own
+        thread.
+        """
+        with closing(self._sock):
+            while not self._shutdown.is_set():
+                now = lazylights._monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, _, packet, dest = heapq.heappop(self._delayed)
+                    self._send(packet, dest)
+                wait = 0.05
+                if self._delayed:
+                    wait = min(wait, self._delayed[0][0] - now)
+                readable, _, _ = select.select([self._sock], [], [], wait)
+                if not readable:
+                    continue
+                while True:
+                    try:
+                        packet, (host, _) = self._sock.recvfrom(65536)
+                    except socket.error:
+                        break
+                    self.received += 1
+                    self._record(SENT, packet)
+                    if self._lost():
+                        continue
+                    self._respond(self.handle(packet), host)
+
+
+def write_capture(f, records):
+    """
+    Writes `records`, an iterable of tuples of (seconds since the start of
+    the capture, direction, packet), to the file-like object `f`.
+    """
+    for offset, direction, packet in records:
+        f.write('%.6f %s %s\n' % (offset, direction,
+                                  lazylights._bytes(packet)))
+
+
+def read_capture(f):
+    """
+    Returns an iterator of tuples of (seconds since the start of the capture,
+    direction, packet) from a capture in the file-like object `f`. Blank
+    lines and lines starting with `#` are skipped.
+    """
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        offset, direction, data = line.split()
+        yield float(offset), direction, lazylights._unbytes(data)
+
+
+def replay(records, addr, speed=1.0, direction=SENT):
+    """
+    Sends the packets in `records` (as returned by `read_capture`) that went
+    in `direction` to `addr`, with the same timing as when they were
+    captured, sped up by a factor of `speed`; if `speed` is None, they're
+    sent as fast as possible. Returns a pair of (number of packets sent,
+    seconds taken).
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    count = 0
+    started = lazylights._monotonic()
+    with closing(sock):
+        sock.connect(addr)
+        for offset, packet_direction, packet in records:
+            if packet_direction != direction:
+                continue
+            if speed is not None:
+                wait = started + offset / speed - lazylights._monotonic()
+                if wait > 0:
+                    select.select([], [], [], wait)
+            sock.send(packet)
+            count += 1
+    return count, lazylights._monotonic() - started
@@ -4,7 +4,7 @@ setup(name='lazylights',
       version='0.1.0',
       author='Matt Papi',
       author_email='matt@mpapi.net',
-      py_modules=['lazylights'],
+      py_modules=['lazylights', 'lazylights_daemon'],
       scripts=[],
       url='http://github.com/mpapi/lazylights/',
       license='LICENSE',
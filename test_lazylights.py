@@ -1,7 +1,18 @@
 """
 Unit tests for lazylights.
 """
-from nose.tools import eq_
+from contextlib import closing
+import logging
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_raises, eq_
 
 import lazylights
 from lazylights import parse_packet, parse_payload, build_packet
@@ -10,7 +21,9 @@ from lazylights import parse_packet, parse_payload, build_packet
 OFF_PACKET = lazylights._unbytes("26000034000000000000000000000000"
                                  "99887766554400000000000000000000"
                                  "150000000000")
-GATEWAY = '\x99\x88\x77\x66\x55\x44'
+GATEWAY = b'\x99\x88\x77\x66\x55\x44'
+BULB_1 = b'\x01\x01\x01\x01\x01\x01'
+BULB_2 = b'\x02\x02\x02\x02\x02\x02'
 
 
 def test_parse_packet():
@@ -20,17 +33,944 @@ def test_parse_packet():
     eq_(lazylights.ALL_BULBS, header.mac)
     eq_(GATEWAY, header.gateway)
     eq_(lazylights.REQ_SET_POWER_STATE, header.packet_type)
-    eq_('\x00\x00', data)
+    eq_(b'\x00\x00', data)
 
 
 def test_parse_payload():
-    payload = parse_payload('\x00\x01', '>H', 'is_on')
-    eq_(['is_on'], payload.keys())
+    payload = parse_payload(b'\x00\x01', '>H', 'is_on')
+    eq_(['is_on'], list(payload.keys()))
     eq_(1, payload['is_on'])
 
 
 def test_build_packet():
     packet = build_packet(lazylights.REQ_SET_POWER_STATE,
                           GATEWAY, lazylights.ALL_BULBS,
-                          '2s', '\x00\x00')
+                          '2s', b'\x00\x00')
     eq_(packet, OFF_PACKET)
+
+
+def test_packet_sender_reuses_gateway_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    with closing(sock):
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(1.0)
+        addr, port = sock.getsockname()
+
+        # (For different bulbs, since the scheduler drops duplicates.)
+        packets = [build_packet(lazylights.REQ_GET_LIGHT_STATE, GATEWAY, mac,
+                                '')
+                   for mac in (lazylights.ALL_BULBS, BULB_1, BULB_2)]
+        sender = lazylights.PacketSender()
+        thr = lazylights._spawn(sender.run)
+        sender.put(lazylights.Gateway(addr, port, GATEWAY))
+        for packet in packets:
+            sender.put(packet)
+        sender.stop()
+        thr.join(1.0)
+
+        eq_(packets, [sock.recv(1024) for _ in range(3)])
+        eq_({}, sender._sockets)
+
+
+def test_codec_round_trip():
+    codec = lazylights.get_codec(lazylights.REQ_SET_POWER_STATE)
+    eq_(OFF_PACKET, codec.pack(GATEWAY, lazylights.ALL_BULBS, b'\x00\x00'))
+
+    buf = bytearray(2 * codec.size)
+    end = codec.pack_into(buf, codec.size, GATEWAY, lazylights.ALL_BULBS,
+                          b'\x00\x00')
+    eq_(len(buf), end)
+    eq_(OFF_PACKET, bytes(buf[codec.size:]))
+
+    header, payload = codec.unpack_from(buf, codec.size)
+    eq_(lazylights.REQ_SET_POWER_STATE, header.packet_type)
+    eq_(GATEWAY, header.gateway)
+    eq_(b'\x00\x00', payload.level)
+
+
+def test_codec_records_support_dict_lookups():
+    codec = lazylights.get_codec(lazylights.RESP_GATEWAY)
+    _, payload = codec.unpack_from(codec.pack(GATEWAY, GATEWAY, 1, 56700))
+    eq_(1, payload.service)
+    eq_(56700, payload['port'])
+    eq_(1, payload.get('service'))
+    eq_(None, payload.get('missing'))
+    eq_(['service', 'port'], list(payload.keys()))
+    eq_((1, 56700), tuple(payload))
+
+
+def _new_event_loop():
+    if lazylights.asyncio is None:
+        raise SkipTest('asyncio is not available')
+    return lazylights.asyncio.new_event_loop()
+
+
+def test_drive_sends_results_into_generator():
+    loop = _new_event_loop()
+    seen = []
+
+    def steps():
+        first = loop.create_future()
+        loop.call_soon(first.set_result, 1)
+        seen.append((yield first))
+        second = loop.create_future()
+        loop.call_soon(second.set_exception, ValueError('boom'))
+        try:
+            yield second
+        except ValueError as exc:
+            seen.append(str(exc))
+
+    with closing(loop):
+        eq_(None, loop.run_until_complete(lazylights._drive(loop, steps())))
+    eq_([1, 'boom'], seen)
+
+
+def test_drive_handles_cancellation():
+    loop = _new_event_loop()
+    seen = []
+
+    def steps(inner):
+        try:
+            yield inner
+        except lazylights.asyncio.CancelledError:
+            seen.append('cancelled')
+            raise
+        finally:
+            seen.append('closed')
+
+    with closing(loop):
+        # Cancelling the returned future cancels what the steps wait on.
+        inner = loop.create_future()
+        done = lazylights._drive(loop, steps(inner))
+        done.cancel()
+        loop.run_until_complete(lazylights.asyncio.sleep(0))
+        eq_(True, inner.cancelled())
+        eq_(['closed'], seen)
+
+        # A future cancelled under the steps cancels the returned one.
+        del seen[:]
+        inner = loop.create_future()
+        done = lazylights._drive(loop, steps(inner))
+        inner.cancel()
+        loop.run_until_complete(lazylights.asyncio.sleep(0))
+        eq_(True, done.cancelled())
+        eq_(['cancelled', 'closed'], seen)
+
+
+def test_async_connect_stops_when_abandoned():
+    loop = _new_event_loop()
+    errors = []
+    loop.set_exception_handler(lambda loop, context: errors.append(context))
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as sock:
+        sock.bind(('127.0.0.1', 0))
+        lifx = lazylights.AsyncLifx(loop=loop, addr=('127.0.0.1', 0))
+        broadcast = lazylights.BROADCAST_ADDRESS
+        lazylights.BROADCAST_ADDRESS = sock.getsockname()
+        try:
+            assert_raises(lazylights.asyncio.TimeoutError,
+                          loop.run_until_complete,
+                          lazylights.asyncio.wait_for(
+                              lifx.connect(attempts=4, delay=0.1), 0.15))
+            loop.run_until_complete(lazylights.asyncio.sleep(0.5))
+        finally:
+            lazylights.BROADCAST_ADDRESS = broadcast
+            lifx.close()
+            loop.close()
+
+        # Only the broadcasts sent before the timeout went out.
+        sock.setblocking(False)
+        received = 0
+        try:
+            while True:
+                sock.recv(1024)
+                received += 1
+        except socket.error:
+            pass
+    eq_([], errors)
+    assert 0 < received < 4, received
+
+
+def test_loop_callbacks_run_on_loop():
+    loop = _new_event_loop()
+    callbacks = lazylights.LoopCallbacks(lazylights.Logger(False), loop)
+    seen = []
+    callbacks.register('event', lambda *args, **kwargs: seen.append(
+        (args, kwargs)))
+
+    with closing(loop):
+        callbacks.put('event', 1, key=2)
+        eq_([], seen)
+        loop.run_until_complete(lazylights.asyncio.sleep(0))
+    eq_([((1,), {'key': 2})], seen)
+
+
+def test_pending_requests_resolve_by_bulb_and_type():
+    pending = lazylights.PendingRequests()
+    first = pending.expect(BULB_1, lazylights.RESP_LIGHT_STATE)
+    second = pending.expect(BULB_2, lazylights.RESP_LIGHT_STATE)
+    eq_(2, len(pending))
+
+    eq_(True, pending.resolve(BULB_1, lazylights.RESP_LIGHT_STATE, 'state'))
+    eq_(False, pending.resolve(BULB_1, lazylights.RESP_POWER_STATE, 'on'))
+    eq_('state', first.result(0))
+    eq_(False, second.done())
+
+    pending.cancel(second)
+    eq_(0, len(pending))
+    assert_raises(lazylights.ResponseTimeout, second.result, 0)
+
+
+class FakeSender(object):
+    """
+    Stands in for a PacketSender, answering light state requests on behalf of
+    the bulbs in `responsive` with the color they were last set to. With
+    `transitions`, bulbs report a color half way there until a change's
+    duration has passed.
+    """
+    def __init__(self, lifx, responsive):
+        self.lifx = lifx
+        self.responsive = responsive
+        self.sent = []
+        self.bursts = []
+        self.gateways = []
+        self.threads = []
+        self.colors = {}
+        self.transitions = False
+        self.midway = 0
+        self.is_connected = threading.Event()
+
+    def put_many(self, packets):
+        self.bursts.append(len(packets))
+        for packet in packets:
+            self.put(packet)
+
+    def put(self, packet):
+        if isinstance(packet, lazylights.Gateway):
+            self.gateways.append(packet)
+            self.is_connected.set()
+            return
+        header, _ = parse_packet(packet)
+        self.sent.append(header)
+        if header.packet_type == lazylights.REQ_SET_LIGHT_STATE:
+            _, payload = lazylights.get_codec(header.packet_type) \
+                .unpack_from(packet)
+            self.colors[header.mac] = (tuple(payload[:4]), time.time() +
+                                       payload.duration / 1000.0)
+        if header.packet_type != lazylights.REQ_GET_LIGHT_STATE:
+            return
+        codec = lazylights.get_codec(lazylights.RESP_LIGHT_STATE)
+        for mac in self.responsive:
+            if header.mac in (mac, lazylights.ALL_BULBS):
+                color, until = self.colors.get(mac, ((1, 2, 3, 4), 0))
+                if self.transitions and time.time() < until:
+                    self.midway += 1
+                    color = tuple(value // 2 for value in color[:3]) + \
+                        color[3:]
+                response = codec.pack(GATEWAY, mac,
+                                      *color + (0, 1, b'', b''))
+                self.threads.append(lazylights._spawn(
+                    self.lifx._on_light_state,
+                    *codec.unpack_from(response) +
+                    (None, ('127.0.0.1', 56700))))
+
+
+def _fake_lifx(bulbs, responsive):
+    lifx = lazylights.Lifx(num_bulbs=len(bulbs))
+    lifx.gateway = lazylights.Gateway('127.0.0.1', 56700, GATEWAY)
+    lifx.sender = FakeSender(lifx, responsive)
+    for mac in bulbs:
+        lifx.bulbs[mac] = lazylights.Bulb(b'', mac)
+    return lifx
+
+
+def test_set_light_state_waits_per_bulb():
+    lifx = _fake_lifx([BULB_1, BULB_2], [BULB_1])
+
+    # No timeout, but only waits for the addressed bulb.
+    responses = lifx.set_light_state_raw(1, 2, 3, 4, BULB_1)
+    eq_([BULB_1], list(responses.keys()))
+    eq_(4, responses[BULB_1].kelvin)
+
+    responses = lifx.set_light_state_raw(1, 2, 3, 4, timeout=0.1)
+    eq_([BULB_1], list(responses.keys()))
+    eq_(0, len(lifx.pending))
+
+
+def test_stale_response_does_not_confirm_change():
+    lifx = _fake_lifx([BULB_1], [])
+    codec = lazylights.get_codec(lazylights.RESP_LIGHT_STATE)
+
+    def respond(hue):
+        lifx._on_light_state(*codec.unpack_from(codec.pack(
+            GATEWAY, BULB_1, hue, 2, 3, 4, 0, 1, b'', b'')) +
+            (None, ('127.0.0.1', 56700)))
+
+    futures = lifx._set_light_state(5, 2, 3, 4, BULB_1,
+                                    lazylights.REFRESH_TARGETED, 0, None)
+    respond(1)
+    eq_(False, futures[BULB_1].done())
+    respond(5)
+    eq_(5, futures[BULB_1].result(0).hue)
+    eq_(0, len(lifx.pending))
+
+
+def test_changes_with_a_duration_are_confirmed_once_done():
+    lifx = _fake_lifx([BULB_1, BULB_2], [BULB_1, BULB_2])
+    lifx.sender.transitions = True
+    timeouts_thr = lazylights._spawn(lifx.timeouts.run)
+    try:
+        responses = lifx.set_light_state_raw(100, 200, 300, 4, BULB_1,
+                                             timeout=2, duration=100)
+        eq_(100, responses[BULB_1].hue)
+        eq_(1, lifx.sender.midway)
+
+        acked = lifx.apply_scene({BULB_1: (120, 1.0, 0.5, 3500, 100),
+                                  BULB_2: (240, 0.5, 1.0, 2700, 0)},
+                                 timeout=2)
+        eq_({BULB_1: True, BULB_2: True}, acked)
+        eq_(2, lifx.sender.midway)
+    finally:
+        lifx.timeouts.stop()
+        timeouts_thr.join()
+        for thr in lifx.sender.threads:
+            thr.join()
+
+
+def test_async_commands_return_futures():
+    lifx = _fake_lifx([BULB_1, BULB_2], [BULB_1])
+    timeouts_thr = lazylights._spawn(lifx.timeouts.run)
+    try:
+        answered = lifx.set_light_state_raw_async(1, 2, 3, 4, BULB_1)
+        unanswered = lifx.set_light_state_raw_async(1, 2, 3, 4, BULB_2,
+                                                    timeout=0.1)
+        eq_(4, answered.result(1)[BULB_1].kelvin)
+        assert_raises(lazylights.ResponseTimeout, unanswered.result, 1)
+        eq_(0, len(lifx.pending))
+
+        assumed = lifx.set_power_state_async(
+            True, refresh=lazylights.REFRESH_NONE)
+        eq_(set([BULB_1, BULB_2]), set(assumed.result(0)))
+        if lazylights.Future is not None:
+            from concurrent.futures import FIRST_EXCEPTION, wait
+            futures = [lifx.set_light_state_async(0, 0, 1, 3500, mac,
+                                                  timeout=0.1)
+                       for mac in (BULB_1, BULB_2)]
+            done, _ = wait(futures, 1, FIRST_EXCEPTION)
+            assert futures[1] in done
+    finally:
+        lifx.timeouts.stop()
+        timeouts_thr.join()
+        for thr in lifx.sender.threads:
+            thr.join()
+
+
+def test_set_light_state_refreshes_only_target():
+    lifx = _fake_lifx([BULB_1, BULB_2], [BULB_1, BULB_2])
+    lifx.set_light_state_raw(1, 2, 3, 4, BULB_1)
+    eq_([(lazylights.REQ_SET_LIGHT_STATE, BULB_1),
+         (lazylights.REQ_GET_LIGHT_STATE, BULB_1)],
+        [(header.packet_type, header.mac) for header in lifx.sender.sent])
+
+    del lifx.sender.sent[:]
+    lifx.set_light_state_raw(1, 2, 3, 4, BULB_1, timeout=1,
+                             refresh=lazylights.REFRESH_ALL)
+    eq_(lazylights.ALL_BULBS, lifx.sender.sent[-1].mac)
+
+
+def test_set_state_without_refresh_assumes_change():
+    lifx = _fake_lifx([BULB_1, BULB_2], [])
+    codec = lazylights.get_codec(lazylights.RESP_LIGHT_STATE)
+    lifx.light_state[BULB_1] = codec.record(0, 0, 0, 0, 0, 0, b'', b'')
+
+    responses = lifx.set_light_state_raw(1, 2, 3, 4, BULB_1,
+                                         refresh=lazylights.REFRESH_NONE)
+    eq_((1, 2, 3, 4), tuple(responses[BULB_1])[:4])
+    eq_(responses[BULB_1], lifx.light_state[BULB_1])
+
+    responses = lifx.set_power_state(True, refresh=lazylights.REFRESH_NONE)
+    eq_(set([BULB_1, BULB_2]), set(responses))
+    eq_(1, lifx.power_state[BULB_2].is_on)
+    eq_(0xffff, lifx.light_state[BULB_1].power)
+    eq_([lazylights.REQ_SET_LIGHT_STATE, lazylights.REQ_SET_POWER_STATE],
+        [header.packet_type for header in lifx.sender.sent])
+
+
+def test_disabled_logger_queues_nothing():
+    logger = lazylights.Logger(False)
+    logger('>> %s', lazylights._Hex(OFF_PACKET))
+    logger.error('boom')
+    eq_(0, logger._queue.qsize())
+
+    logger = lazylights.Logger(level=logging.INFO)
+    logger.debug('dropped')
+    logger.info('kept %s', lazylights._Hex(b'\x12\x34'))
+    eq_(1, logger._queue.qsize())
+    msg, args = logger._queue.get()
+    eq_('kept 1234', msg % args)
+
+
+def test_logger_routes_to_stdlib_logging():
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    target = logging.getLogger('lazylights.test')
+    target.addHandler(handler)
+    target.setLevel(logging.DEBUG)
+
+    logger = lazylights.Logger(target=target)
+    logger.warning('%d bulbs', 3)
+    eq_(0, logger._queue.qsize())
+    eq_(['3 bulbs'], [record.getMessage() for record in records])
+    eq_(logging.WARNING, records[0].levelno)
+
+
+def test_apply_scene_sends_one_burst():
+    lifx = _fake_lifx([BULB_1, BULB_2], [BULB_1])
+    acked = lifx.apply_scene({BULB_1: (120, 1.0, 0.5, 3500, 1000),
+                              BULB_2: (240, 0.5, 1.0, 2700, 0)},
+                             timeout=0.1)
+    eq_({BULB_1: True, BULB_2: False}, acked)
+    eq_(4, len(lifx.sender.sent))
+    eq_(set([(lazylights.REQ_SET_LIGHT_STATE, BULB_1),
+             (lazylights.REQ_SET_LIGHT_STATE, BULB_2),
+             (lazylights.REQ_GET_LIGHT_STATE, BULB_1),
+             (lazylights.REQ_GET_LIGHT_STATE, BULB_2)]),
+        set((header.packet_type, header.mac)
+            for header in lifx.sender.sent))
+
+
+FRAME = [(0, 0, 0, 2500), (359.9, 1.0, 0.5, 9000), (-90, 0.25, 1.0, 3500)]
+
+
+def test_encode_light_frame_matches_packets():
+    buf = lazylights.encode_light_frame(GATEWAY, [BULB_1, BULB_2, BULB_1],
+                                        FRAME, [0, 100, 200], use_numpy=False)
+    codec = lazylights.get_codec(lazylights.REQ_SET_LIGHT_STATE)
+    eq_(3 * codec.size, len(buf))
+    header, payload = codec.unpack_from(buf, codec.size)
+    eq_(BULB_2, header.mac)
+    eq_((0xffec, 0xffff, 0x7fff, 9000, 100), tuple(payload))
+
+
+def test_light_frames_same_with_numpy():
+    if lazylights.numpy is None:
+        raise SkipTest('numpy is not installed')
+    macs = [BULB_1, BULB_2, b'\x00\x00\x00\x00\x00\x00']
+    for durations in (0, [0, 100, 200]):
+        eq_(lazylights.encode_light_frame(GATEWAY, macs, FRAME, durations,
+                                          use_numpy=False),
+            lazylights.encode_light_frame(GATEWAY, macs, FRAME, durations,
+                                          use_numpy=True))
+
+    codec = lazylights.get_codec(lazylights.RESP_LIGHT_STATE)
+    data = b''.join(codec.pack(GATEWAY, mac, hue, 0x8000, 0xffff, 3500, 0, 0,
+                               b'label', b'')
+                    for mac, hue in zip(macs, [0, 0x4000, 0xffff]))
+    python_macs, python_frame = lazylights.decode_light_frame(
+        data, use_numpy=False)
+    numpy_macs, numpy_frame = lazylights.decode_light_frame(
+        data, use_numpy=True)
+    eq_(macs, python_macs)
+    eq_(macs, numpy_macs)
+    eq_(python_frame, [tuple(row) for row in numpy_frame.tolist()])
+
+
+def test_send_scheduler_coalesces_and_limits_rate():
+    now = [0.0]
+    scheduler = lazylights.SendScheduler(rate=10.0, burst=1,
+                                         clock=lambda: now[0])
+    codec = lazylights.get_codec(lazylights.REQ_SET_LIGHT_STATE)
+    get = lazylights.get_codec(lazylights.REQ_GET_LIGHT_STATE)
+    first = codec.pack(GATEWAY, BULB_1, 1, 1, 1, 1, 0)
+    refresh = get.pack(GATEWAY, BULB_1)
+    latest = codec.pack(GATEWAY, BULB_1, 2, 2, 2, 2, 0)
+    other = codec.pack(GATEWAY, BULB_2, 3, 3, 3, 3, 0)
+    for packet in [first, refresh, latest, other]:
+        scheduler.push(packet)
+    eq_((1, 3), (scheduler.dropped, scheduler.depth))
+
+    # One packet per bulb fits in the burst; the latest state replaced the
+    # first, in its place in the queue.
+    packets, wait = scheduler.pop_ready()
+    eq_([latest, other], packets)
+    eq_(0.1, round(wait, 6))
+
+    now[0] += 0.1
+    eq_(([refresh], None), scheduler.pop_ready())
+    eq_((0, 3), (scheduler.depth, scheduler.sent))
+
+    # Once a packet's been sent, a new one queues up behind the others.
+    scheduler.push(refresh)
+    scheduler.push(first)
+    scheduler.push(latest)
+    eq_(([], 0.1), scheduler.pop_ready())
+    eq_([refresh, latest], scheduler.pop_ready(everything=True)[0])
+    eq_(2, scheduler.dropped)
+
+    # A newer get-state packet replaces a waiting one too, but goes to the
+    # back of the queue, so that it sees the change queued in between.
+    scheduler.push(refresh)
+    scheduler.push(first)
+    scheduler.push(refresh)
+    eq_((3, 2), (scheduler.dropped, scheduler.depth))
+    eq_([first, refresh], scheduler.pop_ready(everything=True)[0])
+    eq_(0, scheduler.depth)
+
+
+def test_timer_wheel_returns_items_when_due():
+    now = [0.0]
+    wheel = lazylights.TimerWheel(tick=1.0, slots=4, clock=lambda: now[0])
+    wheel.schedule(1, 'a')
+    wheel.schedule(2.5, 'b')
+    wheel.schedule(9, 'c')
+    eq_(3, len(wheel))
+
+    seen = []
+    for _ in range(10):
+        now[0] += 1
+        seen.append(wheel.advance())
+    eq_([['a'], [], ['b'], [], [], [], [], [], ['c'], []], seen)
+    eq_(0, len(wheel))
+
+
+def test_delivery_tracker_retransmits_until_acknowledged():
+    resent = []
+    tracker = lazylights.DeliveryTracker(resent.append, retries=2,
+                                         retry_delay=0.01, tick=0.005)
+    thr = lazylights._spawn(tracker.run)
+    try:
+        on = tracker.track(BULB_1, lazylights.REQ_SET_POWER_STATE, '2s',
+                           b'\x00\x01')
+        color = tracker.track(BULB_2, lazylights.REQ_SET_LIGHT_STATE,
+                              'xHHHHI', 1, 2, 3, 4, 0)
+        power = lazylights.get_codec(lazylights.RESP_POWER_STATE).record
+
+        # Stale state doesn't count as an acknowledgement.
+        tracker.acknowledge(BULB_1, lazylights.RESP_POWER_STATE, power(0))
+        eq_(False, on.done())
+        tracker.acknowledge(BULB_1, lazylights.RESP_POWER_STATE, power(1))
+        assert on.result(0) >= 0.0
+
+        assert_raises(lazylights.SendException, color.result, 1.0)
+    finally:
+        tracker.stop()
+        thr.join()
+
+    eq_([BULB_2, BULB_2], [delivery.mac for delivery in resent
+                           if delivery.packet_type ==
+                           lazylights.REQ_SET_LIGHT_STATE])
+    stats = tracker.stats()
+    eq_((1, 1, 0), (stats['delivered'], stats['failed'],
+                    stats['outstanding']))
+    eq_(on.result(), stats['latency_p99'])
+
+
+def test_reliable_light_state_asks_for_acknowledgement():
+    lifx = _fake_lifx([BULB_1], [BULB_1])
+    thr = lazylights._spawn(lifx.tracker.run)
+    try:
+        deliveries = lifx.send(lazylights.REQ_SET_LIGHT_STATE, BULB_1,
+                               'xHHHHI', 5, 6, 7, 3500, 0, reliable=True)
+        assert deliveries[BULB_1].result(1) < 0.2
+    finally:
+        lifx.tracker.stop()
+        thr.join()
+        for sender_thr in lifx.sender.threads:
+            sender_thr.join()
+    eq_(0, lifx.tracker.retransmits)
+    eq_([lazylights.REQ_SET_LIGHT_STATE, lazylights.REQ_GET_LIGHT_STATE],
+        [header.packet_type for header in lifx.sender.sent])
+
+
+class _Recorder(object):
+    def __init__(self):
+        self.events = []
+
+    def put(self, event, *args):
+        self.events.append((event, args))
+
+
+def test_receiver_drains_datagrams_and_stops_promptly():
+    callbacks = _Recorder()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    receiver = lazylights.PacketReceiver(('127.0.0.1', port), callbacks)
+    thr = lazylights._spawn(receiver.run)
+    power = build_packet(lazylights.RESP_POWER_STATE, GATEWAY, BULB_1,
+                         'H', 1)
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as out:
+        for _ in range(20):
+            out.sendto(power, ('127.0.0.1', port))
+            out.sendto(b'junk', ('127.0.0.1', port))
+            out.sendto(OFF_PACKET, ('127.0.0.1', port))
+            # Datagrams sent before the receiver binds are lost, so wait
+            # for a whole round to arrive.
+            events = [event for event, _ in callbacks.events]
+            if lazylights.RESP_POWER_STATE in events[:-1]:
+                break
+            thr.join(0.05)
+    receiver.stop()
+    thr.join(1.0)
+    eq_(False, thr.is_alive())
+
+    first = events.index(lazylights.RESP_POWER_STATE)
+    event, (header, payload, rest, addr) = callbacks.events[first]
+    eq_(BULB_1, header.mac)
+    eq_(1, payload.is_on)
+    event, (header, payload, rest, addr) = callbacks.events[first + 1]
+    eq_(lazylights.EVENT_UNKNOWN, event)
+    eq_(b'\x00\x00', rest)
+
+
+def test_callbacks_keep_order_per_bulb_off_the_dispatch_thread():
+    callbacks = lazylights.Callbacks(lazylights.Logger(False), workers=4)
+    release = threading.Event()
+    seen = []
+
+    def builtin(bulb, n):
+        seen.append(('builtin', bulb.mac, n))
+
+    def slow(bulb, n):
+        if bulb.mac == BULB_1:
+            release.wait(5.0)
+        seen.append(('user', bulb.mac, n))
+
+    callbacks.register('state', builtin)
+    callbacks.register('state', slow, inline=False)
+    thr = lazylights._spawn(callbacks.run)
+    bulbs = [lazylights.Bulb(b'one', BULB_1), lazylights.Bulb(b'two', BULB_2)]
+    for n in range(3):
+        for bulb in bulbs:
+            callbacks.put('state', bulb, n)
+
+    # The slow handler for one bulb holds up neither the inline callbacks
+    # nor (unless they share a worker) the other bulb's.
+    for _ in range(100):
+        if len([item for item in seen if item[0] == 'builtin']) == 6:
+            break
+        thr.join(0.01)
+    eq_([(mac, n) for n in range(3) for mac in (BULB_1, BULB_2)],
+        [item[1:] for item in seen if item[0] == 'builtin'])
+    release.set()
+    callbacks.stop()
+    thr.join()
+
+    for mac in (BULB_1, BULB_2):
+        eq_([0, 1, 2], [n for kind, bulb, n in seen
+                        if kind == 'user' and bulb == mac])
+    latency = dict((name.split('.')[-1], stats)
+                   for name, stats in callbacks.latency().items())
+    eq_(6, latency['slow']['calls'])
+    eq_(6, latency['builtin']['calls'])
+    assert latency['slow']['max'] >= 0.0
+
+
+def test_callbacks_name_each_handler_apart():
+    class Handler(object):
+        def on_event(self):
+            pass
+
+    callbacks = lazylights.Callbacks(lazylights.Logger(False))
+    first, second = Handler(), Handler()
+    handlers = [lambda: None, lambda: None, first.on_event, second.on_event]
+    for handler in handlers + [first.on_event]:
+        callbacks.register('event', handler)
+    callbacks.dispatch('event')
+
+    # Registering the same method again shares its name; the others differ.
+    latency = dict((name.split('.')[-1], stats['calls'])
+                   for name, stats in callbacks.latency().items())
+    eq_({'<lambda>': 1, '<lambda>#2': 1, 'on_event': 2, 'on_event#2': 1},
+        latency)
+
+
+def test_packets_routed_to_each_bulbs_gateway():
+    gateway_2 = b'\x22\x22\x22\x22\x22\x22'
+    service = lazylights.get_codec(lazylights.RESP_GATEWAY).record
+    lifx = lazylights.Lifx()
+    thr = lazylights._spawn(lifx.sender.run)
+    socks = []
+    try:
+        for mac in (GATEWAY, gateway_2):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            socks.append(sock)
+            sock.bind(('127.0.0.1', 0))
+            sock.settimeout(1.0)
+            addr = sock.getsockname()
+            header = lazylights.Header(0, 0, lazylights.ALL_BULBS, mac, 0,
+                                       lazylights.RESP_GATEWAY)
+            lifx._on_gateway(header, service(lazylights.SERVICE_UDP,
+                                             addr[1]), None, addr)
+        eq_(GATEWAY, lifx.gateway.mac)
+        eq_(2, len(lifx.gateways))
+
+        power = lazylights.get_codec(lazylights.RESP_POWER_STATE).record
+        header = lazylights.Header(0, 0, BULB_2, gateway_2, 0,
+                                   lazylights.RESP_POWER_STATE)
+        lifx._on_power_state(header, power(0), None, None)
+
+        lifx.send(lazylights.REQ_SET_POWER_STATE, BULB_2, '2s', b'\x00\x01')
+        lifx.send(lazylights.REQ_GET_LIGHT_STATE, lazylights.ALL_BULBS, '')
+        lifx.sender.stop()
+        thr.join(1.0)
+
+        first = [parse_packet(socks[0].recv(1024))[0]]
+        second = [parse_packet(socks[1].recv(1024))[0] for _ in range(2)]
+    finally:
+        for sock in socks:
+            sock.close()
+    eq_([(GATEWAY, lazylights.ALL_BULBS)],
+        [(sent.gateway, sent.mac) for sent in first])
+    eq_(sorted([(gateway_2, BULB_2), (gateway_2, lazylights.ALL_BULBS)]),
+        sorted((sent.gateway, sent.mac) for sent in second))
+
+
+def test_discovery_cache_round_trip_and_expiry():
+    directory = tempfile.mkdtemp()
+    try:
+        now = [1000.0]
+        cache = lazylights.DiscoveryCache(os.path.join(directory, 'cache'),
+                                          ttl=60, clock=lambda: now[0])
+        eq_(None, cache.load())
+
+        gateway = lazylights.Gateway('10.0.0.2', 56700, GATEWAY)
+        bulbs = {BULB_1: (lazylights.Bulb(b'Desk', BULB_1), GATEWAY)}
+        cache.save([gateway], bulbs)
+        eq_(([gateway], bulbs), cache.load())
+
+        now[0] += 61
+        eq_(None, cache.load())
+        cache.clear()
+        eq_([], os.listdir(directory))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_unwritable_discovery_cache_is_not_fatal():
+    directory = tempfile.mkdtemp()
+    try:
+        # The temporary file can be written, but not renamed over a
+        # directory that's in the way.
+        path = os.path.join(directory, 'cache')
+        os.makedirs(os.path.join(path, 'in-the-way'))
+        cache = lazylights.DiscoveryCache(path)
+        gateway = lazylights.Gateway('127.0.0.1', 56700, GATEWAY)
+        assert_raises((IOError, OSError), cache.save, [gateway], {})
+
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        target = logging.getLogger('lazylights.test.cache')
+        target.addHandler(handler)
+        lifx = _fake_lifx([BULB_1], [BULB_1])
+        lifx.logger = lazylights.Logger(target=target)
+        lifx.cache = cache
+        lifx._save_cache()
+        eq_([logging.WARNING], [record.levelno for record in records])
+        eq_(['cache'], os.listdir(directory))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_connect_warm_starts_from_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = lazylights.DiscoveryCache(os.path.join(directory, 'cache'))
+        gateway = lazylights.Gateway('127.0.0.1', 56700, GATEWAY)
+        cache.save([gateway], {
+            BULB_1: (lazylights.Bulb(b'one', BULB_1), GATEWAY),
+            BULB_2: (lazylights.Bulb(b'two', BULB_2), GATEWAY)})
+
+        lifx = lazylights.Lifx(num_bulbs=2, cache=cache)
+        lifx.sender = FakeSender(lifx, [BULB_1, BULB_2])
+        lifx.connect(attempts=2, delay=0.5)
+        eq_([gateway], lifx.sender.gateways)
+        eq_(gateway, lifx.gateway)
+        eq_(set([BULB_1, BULB_2]), set(lifx.bulbs))
+
+        # The bulbs answer, so the cache is confirmed (with the labels they
+        # report) rather than rediscovered.
+        lifx.revalidation.join(2.0)
+        eq_(False, lifx.revalidation.is_alive())
+        eq_(set([lazylights.Bulb(b'', BULB_1), lazylights.Bulb(b'', BULB_2)]),
+            set(bulb for bulb, _ in cache.load()[1].values()))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_background_discovery_adds_and_removes_bulbs():
+    lifx = _fake_lifx([BULB_2], [BULB_1])
+    lifx.num_bulbs, lifx.wait_for_bulbs = 1, False
+    added, removed = [], []
+    lifx.on_bulb_added(added.append)
+    lifx.on_bulb_removed(removed.append)
+    callback_thr = lazylights._spawn(lifx.callbacks.run)
+
+    broadcast = lazylights.BROADCAST_ADDRESS
+    lazylights.BROADCAST_ADDRESS = ('127.0.0.1', 9)
+    try:
+        thr = lazylights._spawn(lifx.discover_forever, interval=0.02,
+                                max_interval=0.02, misses=2)
+        for _ in range(100):
+            if removed:
+                break
+            thr.join(0.02)
+        lifx.stop()
+        thr.join(1.0)
+    finally:
+        lazylights.BROADCAST_ADDRESS = broadcast
+        lifx.callbacks.stop()
+        callback_thr.join()
+
+    eq_(False, thr.is_alive())
+    eq_([BULB_1], [bulb.mac for bulb in added])
+    eq_([BULB_2], [bulb.mac for bulb in removed])
+    eq_([BULB_1], list(lifx.bulbs))
+
+
+def test_get_light_state_reads_through_cache():
+    lifx = _fake_lifx([BULB_1, BULB_2], [BULB_1, BULB_2])
+    now = [0.0]
+    lifx.light_state = lazylights.StateCache(clock=lambda: now[0])
+
+    eq_(set([BULB_1, BULB_2]), set(lifx.get_light_state(max_age=10)))
+    eq_([lazylights.ALL_BULBS], [header.mac for header in lifx.sender.sent])
+
+    # Fresh enough: answered from the cache.
+    del lifx.sender.sent[:]
+    now[0] = 5.0
+    eq_(4, lifx.get_light_state(BULB_1, max_age=10)[BULB_1].kelvin)
+    eq_([], lifx.sender.sent)
+
+    # Only the stale bulb is asked.
+    lifx.light_state[BULB_2] = lifx.light_state[BULB_2]
+    now[0] = 12.0
+    eq_(set([BULB_1, BULB_2]), set(lifx.get_light_state(max_age=10)))
+    eq_([BULB_1], [header.mac for header in lifx.sender.sent])
+    eq_({'size': 2, 'hits': 2, 'misses': 3}, lifx.light_state.stats())
+    for thr in lifx.sender.threads:
+        thr.join()
+
+
+def test_light_state_table_updates_rows_in_place():
+    record = lazylights.get_codec(lazylights.RESP_LIGHT_STATE).record
+    table = lazylights.LightStateTable()
+    table.update(BULB_1, record(1, 2, 3, 4, 0, 0xffff, b'one', b''), 10.0)
+    table.update(BULB_2, record(5, 6, 7, 8, 0, 0, b'two', b''), 11.0)
+    columns = table.snapshot()
+
+    table.update(BULB_1, record(9, 2, 3, 4, 0, 0, b'one', b''), 12.0)
+    eq_(2, len(table))
+    eq_([9, 5], list(columns.hue))
+    eq_([12.0, 11.0], list(columns.time))
+    eq_((9, 2, 3, 4, 0, 0, 12.0), table.get(BULB_1))
+
+    table.remove(BULB_1)
+    eq_([BULB_2], columns.macs)
+    eq_([5], list(columns.hue))
+    eq_((5, 6, 7, 8, 0, 0, 11.0), table.get(BULB_2))
+    eq_(None, table.get(BULB_1))
+
+
+def test_groups_indexed_by_label_tags_and_list():
+    lifx = _fake_lifx([], [])
+    codec = lazylights.get_codec(lazylights.RESP_LIGHT_STATE)
+
+    def receive(mac, label, tags):
+        packet = codec.pack(GATEWAY, mac, 1, 2, 3, 4, 0, 1, label,
+                            struct.pack('<Q', tags))
+        lifx._on_light_state(*codec.unpack_from(packet) + (None, None))
+
+    lifx.define_group('desks', label='Desk')
+    lifx.define_group('floor3', tags=0x4)
+    lifx.define_group('pair', macs=[BULB_1, BULB_2])
+    receive(BULB_1, b'Desk lamp', 0x4)
+    receive(BULB_2, b'Hall', 0x6)
+    eq_([BULB_1], lifx.groups['desks'])
+    eq_(set([BULB_1, BULB_2]), set(lifx.groups['floor3']))
+
+    # Relabelling or retagging a bulb moves it between groups.
+    receive(BULB_1, b'Shelf', 0x1)
+    eq_([], lifx.groups['desks'])
+    eq_([BULB_2], lifx.groups['floor3'])
+    lifx.define_group('desks', label='Desk|Shelf')
+    eq_([BULB_1], lifx.groups['desks'])
+
+    lifx.set_light_state_raw(1, 2, 3, 4, group='pair',
+                             refresh=lazylights.REFRESH_NONE)
+    eq_([2], lifx.sender.bursts)
+    eq_(set([(lazylights.REQ_SET_LIGHT_STATE, BULB_1),
+             (lazylights.REQ_SET_LIGHT_STATE, BULB_2)]),
+        set((header.packet_type, header.mac)
+            for header in lifx.sender.sent))
+
+    with lifx.lock:
+        lifx._forget(BULB_2)
+    eq_([], lifx.groups['floor3'])
+    eq_(2, len(lifx.groups['pair']))
+    assert_raises(KeyError, lifx.set_power_state, True, group='nope')
+    assert_raises(ValueError, lifx.define_group, 'both', label='Desk',
+                  tags=0x1)
+
+
+def test_histogram_buckets_by_upper_bound():
+    histogram = lazylights.Histogram((0.01, 0.1))
+    for value in (0.005, 0.01, 0.05, 2.0):
+        histogram.observe(value)
+    eq_({'count': 4, 'sum': 2.065,
+         'buckets': [(0.01, 2), (0.1, 1), (None, 1)]}, histogram.stats())
+
+
+def test_effects_engine_sends_keyframes_with_durations():
+    lifx = _fake_lifx([BULB_1, BULB_2], [])
+    now = [100.0]
+    engine = lazylights.EffectsEngine(lifx, rate=10, clock=lambda: now[0])
+    red, blue = (0, 1.0, 1.0, 3500), (240, 1.0, 1.0, 3500)
+
+    pulse = engine.play(lazylights.Pulse(red, blue, 2.0, cycles=1))
+    eq_({BULB_1: red + (1000,), BULB_2: red + (1000,)}, engine.tick())
+    eq_({}, engine.tick(100.5))
+    eq_(False, pulse.done())
+
+    # A late tick sends the keyframe with what's left of its transition.
+    eq_({BULB_1: blue + (750,), BULB_2: blue + (750,)}, engine.tick(101.25))
+    eq_(False, pulse.done())
+
+    # It's finished once the last transition is over.
+    eq_({}, engine.tick(102.0))
+    eq_(True, pulse.result(0))
+
+    cycle = lazylights.ColorCycle(1.0, 0.5, 3500, 4.0, steps=4, spread=180)
+    future = engine.play(cycle, [BULB_1, BULB_2])
+    eq_({BULB_1: (90.0, 1.0, 0.5, 3500, 1000),
+         BULB_2: (270.0, 1.0, 0.5, 3500, 1000)}, engine.tick())
+    engine.cancel(future)
+    eq_(False, future.result(0))
+    eq_({}, engine.tick(110.0))
+    eq_(3, len([header for header in lifx.sender.sent
+                if header.packet_type == lazylights.REQ_SET_LIGHT_STATE
+                and header.mac == BULB_1]))
+
+    # An animation started later takes over the bulbs it shares.
+    green = (120, 1.0, 1.0, 3500)
+    now[0] = 200.0
+    pulse = engine.play(lazylights.Pulse(red, blue, 2.0, cycles=1))
+    eq_({BULB_1: red + (1000,), BULB_2: red + (1000,)}, engine.tick())
+    now[0] = 200.5
+    fade = engine.play(lazylights.Fade(green, 10.0), BULB_1)
+    eq_({BULB_1: green + (10000,)}, engine.tick())
+    eq_({BULB_2: blue + (1000,)}, engine.tick(201.0))
+    engine.play(lazylights.Fade(green, 1.0), BULB_2)
+    eq_(False, pulse.result(0))
+    engine.cancel(fade)
+
+    # Running, the engine ticks until the animation is done.
+    engine = lazylights.EffectsEngine(lifx, rate=100)
+    thr = lazylights._spawn(engine.run)
+    fade = engine.play(lazylights.Fade(blue, 0.05), BULB_2)
+    eq_(True, fade.result(1.0))
+    engine.stop()
+    thr.join(1.0)
+    eq_(False, thr.is_alive())
@@ -0,0 +1,60 @@
+"""
+Tests for the lazylights daemon and its clients, against the simulated
+gateway.
+"""
+from contextlib import closing
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_
+
+import lazylights
+from lazylights_daemon import (DAEMON_SNAPSHOT_END, Daemon, DaemonClient,
+                               _split_packets)
+from test_lazylights_sim import _simulated
+
+
+def test_split_packets_keeps_partial_packet():
+    codec = lazylights.get_codec(DAEMON_SNAPSHOT_END)
+    packet = codec.pack(lazylights.ALL_BULBS, lazylights.ALL_BULBS, 3)
+    buf = bytearray(packet * 2 + packet[:5])
+    eq_([packet, packet], _split_packets(buf))
+    eq_(packet[:5], bytes(buf))
+
+
+def test_clients_share_one_daemon():
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'lazylights.sock')
+    try:
+        with _simulated(3) as (sim, lifx):
+            daemon = Daemon(path, lifx)
+            thr = lazylights._spawn(daemon.run)
+            try:
+                assert daemon.is_serving.wait(5)
+                watcher = DaemonClient(path, timeout=2)
+                worker = DaemonClient(path, timeout=2)
+                with closing(watcher), closing(worker):
+                    watcher.subscribe()
+                    eq_(set(sim.bulbs), set(worker.snapshot()))
+
+                    mac = sorted(sim.bulbs)[1]
+                    worker.set_light_state_raw(1, 2, 3, 4, mac)
+                    worker.get_light_state(mac)
+
+                    # The subscriber sees the bulb report its new state.
+                    while True:
+                        header, payload = watcher.receive(2)
+                        if (header.packet_type ==
+                                lazylights.RESP_LIGHT_STATE and
+                                header.mac == mac and
+                                tuple(payload[:4]) == (1, 2, 3, 4)):
+                            break
+                    eq_((1, 2, 3, 4), sim.bulbs[mac].light_state()[:4])
+                    eq_((1, 2, 3, 4), tuple(worker.snapshot()[mac][:4]))
+            finally:
+                daemon.stop()
+                thr.join()
+        assert not os.path.exists(path)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,192 @@
+"""
+Tests for lazylights against the simulated gateway.
+"""
+from contextlib import closing, contextmanager
+import socket
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_
+
+import lazylights
+from lazylights_sim import (RECEIVED, SENT, Simulator, read_capture,
+                            replay, write_capture)
+
+
+def _free_port():
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def _simulator(num_bulbs, **kwargs):
+    """
+    Runs a Simulator, with discovery broadcasts going to it, and yields it
+    along with the local port it replies to.
+    """
+    port = _free_port()
+    sim = Simulator(num_bulbs, reply_port=port, **kwargs)
+    sim_thr = lazylights._spawn(sim.run)
+    broadcast = lazylights.BROADCAST_ADDRESS
+    lazylights.BROADCAST_ADDRESS = sim.addr
+    try:
+        yield sim, port
+    finally:
+        lazylights.BROADCAST_ADDRESS = broadcast
+        sim.stop()
+        sim_thr.join()
+
+
+@contextmanager
+def _simulated(num_bulbs, **kwargs):
+    """
+    Runs a Simulator, and yields it along with a Lifx set up to talk to it.
+    """
+    with _simulator(num_bulbs, **kwargs) as (sim, port):
+        lifx = lazylights.Lifx(num_bulbs, discover=False)
+        lifx.receiver = lazylights.PacketReceiver(('127.0.0.1', port),
+                                                  lifx.callbacks)
+        yield sim, lifx
+
+
+def test_connect_and_set_state_through_simulator():
+    with _simulated(20, latency=0.001) as (sim, lifx):
+        with lifx.run():
+            eq_(sim.gateway, lifx.gateway)
+            eq_(set(sim.bulbs), set(lifx.bulbs))
+
+            mac = sorted(sim.bulbs)[3]
+            responses = lifx.set_light_state_raw(1, 2, 3, 4, mac, timeout=2)
+            eq_((1, 2, 3, 4), tuple(responses[mac][:4]))
+            eq_((1, 2, 3, 4), sim.bulbs[mac].light_state()[:4])
+
+            responses = lifx.set_power_state(True, timeout=2)
+            eq_(20, len(responses))
+            eq_(set([0xffff]), set(bulb.power for bulb in sim.bulbs.values()))
+
+
+def test_superseded_changes_resolve_through_sender():
+    with _simulated(3) as (sim, lifx):
+        with lifx.run():
+            mac = sorted(sim.bulbs)[0]
+            # More changes than the sender's burst lets through at once, so
+            # some wait their turn and are replaced by later ones.
+            futures = [lifx.set_light_state_raw_async(i, 0, 0, 3500, mac,
+                                                      timeout=2)
+                       for i in range(10)]
+            results = [future.result(3)[mac] for future in futures]
+            assert lifx.sender.stats()['dropped'] > 0
+    eq_(9, results[-1].hue)
+    for i, result in enumerate(results[:-1]):
+        assert result is None or result.hue == i, (i, result)
+    eq_(9, sim.bulbs[mac].light_state()[0])
+
+
+def test_async_lifx_through_simulator():
+    if lazylights.asyncio is None:
+        raise SkipTest('asyncio is not available')
+    loop = lazylights.asyncio.new_event_loop()
+    with closing(loop), _simulator(5, latency=0.001) as (sim, port):
+        lifx = lazylights.AsyncLifx(5, loop=loop, addr=('127.0.0.1', port))
+        run = loop.run_until_complete
+        try:
+            run(lifx.connect(delay=0.1))
+            eq_(sim.gateway, lifx.gateway)
+            eq_(set(sim.bulbs), set(lifx.bulbs))
+
+            mac = sorted(sim.bulbs)[1]
+            responses = run(lifx.set_light_state_raw(1, 2, 3, 4, mac,
+                                                     timeout=2))
+            eq_((1, 2, 3, 4), tuple(responses[mac][:4]))
+            eq_((1, 2, 3, 4), sim.bulbs[mac].light_state()[:4])
+
+            responses = run(lifx.set_power_state(True, timeout=2))
+            eq_(5, len(responses))
+            eq_(set([0xffff]), set(bulb.power for bulb in sim.bulbs.values()))
+
+            scene = dict((mac, (120, 1.0, 0.5, 3500, 0)) for mac in sim.bulbs)
+            eq_(dict((mac, True) for mac in sim.bulbs),
+                run(lifx.apply_scene(scene, timeout=2)))
+            eq_(set([lazylights._raw_color(120, 1.0, 0.5)]),
+                set(tuple(bulb.light_state()[:3])
+                    for bulb in sim.bulbs.values()))
+        finally:
+            lifx.close()
+
+
+def test_simulator_drops_packets():
+    with _simulated(100, loss=0.5, seed=1) as (sim, lifx):
+        packet = lazylights.build_packet(lazylights.REQ_GET_LIGHT_STATE,
+                                         sim.gateway_mac,
+                                         lazylights.ALL_BULBS, '')
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
+            for _ in range(3):
+                s.sendto(packet, sim.addr)
+            for _ in range(100):
+                if sim.received == 3:
+                    break
+                lifx.receiver.is_shutdown.wait(0.01)
+    eq_(3, sim.received)
+    assert sim.dropped > 0
+    assert 0 < sim.sent < 300
+
+
+def test_capture_round_trip_and_replay():
+    capture = StringIO()
+    with _simulated(3, capture=capture) as (sim, lifx):
+        with lifx.run():
+            lifx.set_light_state_raw(1, 2, 3, 4, timeout=2)
+
+    capture.seek(0)
+    records = list(read_capture(capture))
+    directions = set(direction for _, direction, _ in records)
+    eq_(set([SENT, RECEIVED]), directions)
+    eq_(sorted(record[0] for record in records),
+        [record[0] for record in records])
+
+    again = StringIO()
+    write_capture(again, records)
+    eq_(capture.getvalue(), again.getvalue())
+
+    # Replaying what was sent to the bulbs sets their state again.
+    with _simulated(3) as (sim, lifx):
+        count, _ = replay(records, sim.addr, speed=None)
+        eq_(len([record for record in records if record[1] == SENT]), count)
+        for _ in range(100):
+            if sim.received == count:
+                break
+            lifx.receiver.is_shutdown.wait(0.01)
+        eq_(set([(1, 2, 3, 4)]),
+            set(bulb.light_state()[:4] for bulb in sim.bulbs.values()))
+
+
+def test_stats_and_metrics_hook():
+    reports = []
+    with _simulated(5) as (sim, lifx):
+        lifx.metrics_interval = 0.02
+        lifx.on_metrics(reports.append)
+        with lifx.run():
+            lifx.set_light_state_raw(1, 2, 3, 4, timeout=2)
+            with closing(socket.socket(socket.AF_INET,
+                                       socket.SOCK_DGRAM)) as s:
+                s.sendto(b'runt', lifx.receiver._addr)
+            for _ in range(100):
+                if len(reports) > 1 and reports[-1]['dropped']['runts']:
+                    break
+                lifx.receiver.is_shutdown.wait(0.01)
+            stats = lifx.stats()
+
+    sent = stats['sent']
+    eq_(1, sent[lazylights.REQ_SET_LIGHT_STATE]['packets'])
+    eq_(0x31, sent[lazylights.REQ_SET_LIGHT_STATE]['bytes'])
+    assert stats['received'][lazylights.RESP_LIGHT_STATE]['packets'] >= 10
+    eq_(1, stats['dropped']['runts'])
+    eq_(0, stats['unknown'])
+    eq_(5, stats['rtt'][lazylights.RESP_LIGHT_STATE]['count'])
+    eq_(set(['callbacks', 'sender', 'scheduled', 'logger']),
+        set(stats['queues']))
+    assert reports and set(reports[0]) == set(stats)